@@ -170,8 +170,8 @@ class MythThumbnailFileCache(FileCache):
     def reap(self):
         '''Delete thumbnails which no longer have an associated recording'''
         active = set([self.resolver.hash(r) for r in self.domainCache.getAllRecordings()])
-        ondisk = set(os.listdir(self.rootDir))
-        delta = ondisk.difference(active)
+        # partially transferred files (and their checkpoints) share the hash of their recording
+        delta = [f for f in os.listdir(self.rootDir) if f.split('.')[0] not in active]
 
         if delta:
             c = 0
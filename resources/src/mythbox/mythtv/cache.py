@@ -43,6 +43,7 @@ class DomainCache(object):
             
         elif id == Event.SCHEDULER_RAN:
             self.getUpcomingRecordings(force=True, lazy=True)
+            self.getRecordedCounts(force=True, lazy=True)
             
         elif event['id'] == Event.RECORDING_DELETED:
             self.getAllRecordings(force=True, lazy=True)
@@ -56,10 +57,32 @@ class DomainCache(object):
         don't have the ugliness of managing a separate synchronization lock/method'''
         return self.process('recordingSchedules', self.db().getRecordingSchedules, force, lazy)
 
+    @synchronized
+    @inject_db
+    def getRecordedCounts(self, force=False, lazy=False):
+        return self.process('recordedCounts', self.db().getRecordedCounts, force, lazy)
+
     @synchronized
     @inject_conn
-    def getAllRecordings(self, force=False, lazy=False):
-        return self.process('allRecordings', self.conn().getAllRecordings, force, lazy)
+    def getAllRecordings(self, force=False, lazy=False, firstBatch=None, onFirstBatch=None):
+        """
+        @param onFirstBatch: when the recordings have to be fetched, called with the first 
+               firstBatch recordings as soon as they're off the wire so a window can render 
+               them while the rest are still arriving. Must not use this thread's connection.
+        """
+        return self.process('allRecordings', lambda: self.fetchAllRecordings(firstBatch, onFirstBatch), force, lazy)
+
+    def fetchAllRecordings(self, firstBatch, onFirstBatch):
+        if onFirstBatch is None:
+            return self.conn().getAllRecordings()
+        from mythbox.mythtv.domain import RecordedProgram
+        programs = []
+        for program in self.conn().iterAllRecordings():
+            programs.append(program)
+            if len(programs) == firstBatch:
+                onFirstBatch(programs[:])
+        programs.sort(key=RecordedProgram.dateSortKey, reverse=True)
+        return programs
 
     @synchronized
     @inject_conn
@@ -17,8 +17,13 @@
 #
 
 import datetime
+import itertools
 import logging
+import os
+import pickle
+import Queue
 import re
+import select
 import socket
 import thread
 import threading
@@ -31,7 +36,7 @@ from mythbox.mythtv import protocol
 from mythbox.mythtv.db import inject_db
 from mythbox.mythtv.enums import TVState, Upcoming
 from mythbox.mythtv.protocol import ProtocolException
-from mythbox.util import timed, threadlocals, safe_str
+from mythbox.util import timed, safe_str
 
 log     = logging.getLogger('mythbox.core')     # mythtv core logger
 wirelog = logging.getLogger('mythbox.wire')     # wire level protocol logger
@@ -48,6 +53,15 @@ def createChainId():
     return "live-%s-%s" % (socket.gethostname(), time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()))
 
 
+# Connection checked out by the outermost @inject_conn call on the current thread
+connLocal = threading.local()
+
+
+def currentConn():
+    """Bolted on to objects as self.conn() by @inject_conn"""
+    return connLocal.conn
+
+
 @decorator
 def inject_conn(func, *args, **kwargs):
     """
@@ -57,161 +71,671 @@ def inject_conn(func, *args, **kwargs):
     To use:
       1. Decorate method with @inject_conn
       2. Within method, use self.conn() to obtain a reference to the Connection.
+      
+    Only the outermost decorated call on a thread checks a Connection out of the 
+    pool. Nested calls just use it so they cost next to nothing.
     """
     self = args[0]
-    result = None
     
     # if dependency already injected via constructor, do nothing 
-    if hasattr(self, '_conn') and self._conn: 
+    if getattr(self, '_conn', None):
         return func(*args, **kwargs)
     
-    connPool = pool.pools['connPool']
+    if getattr(self, 'conn', None) is not currentConn:
+        self.conn = currentConn
     
+    if getattr(connLocal, 'conn', None) is not None:
+        return func(*args, **kwargs)
+    return _callWithConn(func, args, kwargs, retry=True)
+
+
+def _callWithConn(func, args, kwargs, retry):
+    connPool = pool.pools['connPool']
+    conn = connLocal.conn = connPool.checkout()
+    if ilog.isEnabledFor(logging.DEBUG):
+        ilog.debug('--> injected conn %s into thread %s' % (conn, thread.get_ident()))
+    try:
+        try:        
+            return func(*args, **kwargs)
+        except socket.error, se:
+            # 104 - Connection reset by peer, [Errno 54] Connection reset by peer
+            # 32  - Broken pipe
+            # 9   - Bad file descriptor
+            # 111 - Connection refused, 113 - No route to host (give up)
+            _discardConn(connPool, conn)
+            conn = None
+            if retry and not isinstance(se, socket.timeout) and se.errno in (104, 32, 54, 9):
+                connLocal.conn = None
+                log.debug('-- TRY AGAIN --')
+                return _callWithConn(func, args, kwargs, retry=False)
+            raise
+        except:
+            log.exception('conn catchall')
+            raise
+    finally:
+        if conn is not None:
+            connPool.checkin(conn)
+        connLocal.conn = None
+
+
+def _discardConn(connPool, conn):
+    """Discard connections that have timed out since we no longer know if they are usable/functional"""
+    ilog.error('Discarding conn on thread %s' % thread.get_ident())
     
-    def allocate_threadlocal():
-        '''Create thread local storage if not already allocated'''
-        if threadlocals.has_key(tlsKey):
-            ilog.debug('threading.local() already allocated for %s' % tlsKey)
-        else:
-            threadlocals[tlsKey] = threading.local()
-            threadlocals[tlsKey].level = 0
-            ilog.debug('Allocating threading.local() to thread %s'  % tlsKey)
+    # only this conn - the idle ones in the pool are validated on checkout if they've been sitting around
+    try:
+        connPool.discard(conn)
+    except Exception, e: 
+        log.warn('While discarding: %s', str(e))
 
 
-    def bolt_on_accessor():
-        '''Bolt-on getter method so client can access connection as self.conn()'''
-        def conn_accessor():
-            # can't use tlsKey -- out of scope at runtime -- find better way to do this!
-            return threadlocals['c' + str(thread.get_ident())].conn
-        self.conn = conn_accessor  
+class ClientException(Exception): 
+    """Thrown when the mythtv client behaves inappropriately"""
+    pass
 
-        
-    def checkout():
-        '''Only acquire resource once per thread'''
-        threadlocals[tlsKey].level += 1
-        if threadlocals[tlsKey].level == 1:
-            # not acquired - store conn in thread local storage
-            threadlocals[tlsKey].conn = connPool.checkout()
-            threadlocals[tlsKey].discarded = False
-            ilog.debug('Going to acquire resource at level %d' % threadlocals[tlsKey].level)
-            ilog.debug('--> injected conn %s into %s' % (threadlocals[tlsKey].conn, threadlocals[tlsKey]))
-        else:
-            # already acquired
-            ilog.debug('Skipping acquire resource -- at level %d' % threadlocals[tlsKey].level)
 
+class ServerException(Exception): 
+    """Thrown in response to error conditions from the mythtv backend"""
+    pass
+
+  
+class MessageReader(object):
+    """
+    Reads length prefixed replies off a myth protocol socket into a reusable buffer.
+    
+    Replies to QUERY_RECORDINGS run into the megabytes so the buffer is grown on 
+    demand and kept around for the life of the owning Connection instead of 
+    concatenating a new string for every chunk received.
+    """
+    
+    def __init__(self, initialSize=65536):
+        self.buf = bytearray(initialSize)
+        
+    def read(self, sock):
+        """
+        @return: reply split into a list of unicode fields or u'OK'
+        """
+        header = self.recv(sock, 8)
+        if header.upper() == 'OK':
+            return u'OK'
 
-    def discard():
-        ilog.error('discard called')
-        # discard only once
-        if not threadlocals[tlsKey].discarded:
-            # discard connections that have timed out since we no longer know if they are usable/functional
-            ilog.error('Discarding conn on thread %s\n\n' % tlsKey)
+        n = 0
+        if len(header) > 0:
+            n = int(header)
             
-            # discard current conn and all remaining in pool by shrinking (since they're probably all hosed too) 
-            try:
-                connPool.discard(threadlocals[tlsKey].conn)
-            except Exception, e: 
-                log.warn('While discarding: %s', str(e))
+        received = self.recv_into(sock, n)
+        return unicode(buffer(self.buf, 0, received), 'utf-8').split(protocol.separator)
 
-            try:
-                connPool.shrink()
-            except Exception, e:
-                log.warn('While shrinking after discard: %s', str(e))
+    def iterFields(self, sock, chunkSize=65536):
+        """
+        Incremental version of read() which yields each field of a reply as soon as 
+        it has been received instead of waiting for the entire reply. 
+        
+        @return: generator of reply fields as unicode
+        @attention: If the generator is closed before being exhausted, the remainder
+                    of the reply is drained from the socket to keep it usable. 
+        """
+        header = self.recv(sock, 8)
+        if header.upper() == 'OK':
+            yield u'OK'
+            return
+        
+        remaining = 0
+        if len(header) > 0:
+            remaining = int(header)
             
-            del threadlocals[tlsKey]
-        else:
-            ilog.error('Conn %s already discarded. Skipping..' % tlsKey)
+        sep = protocol.separator.encode('utf-8')
+        start = end = 0   # buf[start:end] holds the partially received field 
+        try:
+            while remaining > 0:
+                if end == len(self.buf):
+                    if start > 0:
+                        # compact
+                        self.buf[:end-start] = self.buf[start:end]
+                        end -= start
+                        start = 0
+                    else:
+                        self.buf.extend(bytearray(len(self.buf)))
+                n = sock.recv_into(memoryview(self.buf)[end:], min(len(self.buf) - end, remaining, chunkSize))
+                if n == 0:
+                    break # eof
+                remaining -= n
+                scanFrom = max(start, end - len(sep) + 1)
+                end += n
+                i = self.buf.find(sep, scanFrom, end)
+                while i != -1:
+                    yield unicode(buffer(self.buf, start, i - start), 'utf-8')
+                    start = i + len(sep)
+                    i = self.buf.find(sep, start, end)
+            yield unicode(buffer(self.buf, start, end - start), 'utf-8')
+        except GeneratorExit:
+            self.skip(sock, remaining)
+            raise
+
+    def skip(self, sock, numBytes):
+        """Receive and throw away numBytes"""
+        while numBytes > 0:
+            n = self.recv_into(sock, min(numBytes, len(self.buf)))
+            if n == 0:
+                break # eof
+            numBytes -= n
 
+    def recv(self, sock, numBytes):
+        """
+        @return: up to numBytes as a str. Less is returned if the remote end closes.
+        """
+        received = self.recv_into(sock, numBytes)
+        return str(buffer(self.buf, 0, received))
     
-    def tryAgain():
-        log.debug('-- TRY AGAIN BEGIN --')
-        
-        @inject_conn
-        def blah(*args, **kwargs):
-            return func(*args, **kwargs)
+    def recv_into(self, sock, numBytes):
+        """
+        Receive exactly numBytes into the start of the buffer, growing it if necessary. 
         
-        ta_result = blah(*args, **kwargs)
-        log.debug('-- TRY AGAIN END --')
-        return ta_result
+        @return: number of bytes received which is less than numBytes if the remote end closes
+        """
+        if numBytes > len(self.buf):
+            self.buf = bytearray(max(numBytes, len(self.buf) * 2))
+        view = memoryview(self.buf)
+        received = 0
+        while received < numBytes:
+            n = sock.recv_into(view[received:numBytes], numBytes - received)
+            if n == 0:
+                break # eof
+            received += n
+        return received
 
 
-    def shouldGiveUp(error):
-        # 111 - Connection refused
-        # 113 - No route to host
-        return error.errno in (111, 113)
+class ReplyFuture(object):
+    """
+    Handle to the reply of a request queued on a Pipeline. Asking for the result
+    sends every request queued so far and reads their replies.
+    """
 
+    def __init__(self, pipeline, decode):
+        self._pipeline = pipeline
+        self._decode = decode
+        self._done = False
+        self._value = None
+        self._error = None
 
-    def shouldReconnect(error):
-        # 104 - Connection reset by peer  
-        # 32  - Broken pipe
-        # [Errno 54] Connection reset by peer
-        # 9, 'Bad file descriptor'
-        return error.errno in (104, 32, 54, 9) 
+    def done(self):
+        """
+        @return: True if the reply has been read (or failed), False otherwise
+        """
+        return self._done
 
+    def result(self):
+        """
+        @return: the decoded reply
+        @raise Exception: whatever reading or decoding the reply raised
+        """
+        if not self._done:
+            self._pipeline.flush()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _resolve(self, reply):
+        try:
+            self._value = self._decode(reply)
+        except Exception, e:
+            self._error = e
+        self._done = True
+
+    def _fail(self, error):
+        self._error = error
+        self._done = True
+
+
+class Pipeline(object):
+    """
+    Writes queued requests to the backend command socket back-to-back and matches
+    up the replies in order so that N queries cost one round trip instead of N.
+
+        pipeline = conn.pipeline()
+        states = [pipeline.getTunerStatus(t) for t in tuners]
+        for state in states:
+            print state.result()  # first call to result() sends them all
+
+    Not thread safe - use from the thread that owns the Connection.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = []   # [(msg, ReplyFuture)]
+
+    def request(self, msg, decode=None):
+        """
+        @param msg: request fields
+        @type msg: str[]
+        @param decode: callable which converts the reply (list of fields) into the result
+        @rtype: ReplyFuture
+        """
+        future = ReplyFuture(self, [decode, lambda reply: reply][decode is None])
+        self.pending.append((msg, future))
+        return future
+
+    def flush(self):
+        """
+        Send all queued requests in a single write and read their replies.
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        s = self.conn.cmdSock
+        self.conn._sendMsgs(s, [msg for msg, future in pending])
+        for i, (msg, future) in enumerate(pending):
+            try:
+                reply = self.conn._readMsg(s)
+            except Exception, e:
+                # replies to everything behind a failed read are lost along with the socket
+                for msg, f in pending[i:]:
+                    f._fail(e)
+                raise
+            future._resolve(reply)
+
+    def getTunerStatus(self, tuner):
+        return self.request(['QUERY_REMOTEENCODER %d' % tuner.tunerId, 'GET_STATE'], lambda reply: int(reply[0]))
+
+    def getCurrentRecording(self, tuner):
+        conn = self.conn
+        def decode(reply):
+            from mythbox.mythtv.domain import RecordedProgram
+            return RecordedProgram(reply, conn.settings, conn.translator, conn.platform, conn.protocol, [conn, None][conn._db is None])
+        return self.request(['QUERY_RECORDER %d' % tuner.tunerId, 'GET_CURRENT_RECORDING'], decode)
+
+    def getFramesWritten(self, tuner):
+        return self.request(['QUERY_RECORDER %d' % tuner.tunerId, 'GET_FRAMES_WRITTEN'], self.conn.protocol.readLong)
+
+    def getTunerFilePosition(self, tuner):
+        return self.request(['QUERY_RECORDER %d' % tuner.tunerId, 'GET_FILE_POSITION'], self.conn.protocol.readLong)
+
+    def getTunerFrameRate(self, tuner):
+        return self.request(['QUERY_RECORDER %d' % tuner.tunerId, 'GET_FRAMERATE'], lambda reply: float(reply[0]))
+
+    def getNumFreeTuners(self):
+        return self.request(['GET_FREE_RECORDER_COUNT'], lambda reply: int(reply[0]))
+
+    def getLoad(self):
+        return self.request(['QUERY_LOAD'], lambda reply: {'1':reply[0], '5':reply[1], '15':reply[2]})
+
+    def getUptime(self):
+        def decode(reply):
+            try:
+                return datetime.timedelta(seconds=int(reply[0]))
+            except:
+                return None
+        return self.request(['QUERY_UPTIME'], decode)
+
+    def getDiskUsage(self):
+        readLong = self.conn.protocol.readLong
+        def decode(reply):
+            ok = reply.pop(0)
+            hostname = reply.pop(0)
+            directory = reply.pop(0)
+            _ = reply.pop(0)
+            _ = reply.pop(0)
+            totalSpace = readLong(reply, remove=True)
+            usedSpace = readLong(reply, remove=True)
+
+            return {
+                'hostname' : hostname,
+                'dir'      : directory,
+                'total'    : totalSpace,
+                'used'     : usedSpace,
+                'free'     : totalSpace - usedSpace,
+            }
+        return self.request(['QUERY_FREE_SPACE'], decode)
+
+
+class FileTransfer(object):
+    """
+    Pulls bytes of a file on a backend through a FileTransfer data socket by issuing
+    REQUEST_BLOCK on a command socket.
+
+    The request for the next block is kept in flight while the current block drains
+    so the data socket doesn't sit idle for a round trip between blocks. Blocks are
+    received into a reusable buffer and the block size adapts to the measured
+    throughput so that each block takes roughly blockSecs to arrive.
+    """
+
+    minBlockSize = 64 * 1024
+    maxBlockSize = 20000000   # 20MB
+    blockSecs = 0.5
+
+    def __init__(self, conn, commandSocket, transferId, dataSocket, blockSize=256*1024, window=2):
+        """
+        @param conn: Connection used to build/send requests
+        @param commandSocket: socket REQUEST_BLOCK and SEEK are sent on
+        @param transferId: id of the transfer returned by ANN FileTransfer
+        @param dataSocket: socket announced with ANN FileTransfer
+        @param blockSize: size of the first block requested in bytes
+        @param window: max number of block requests in flight
+        """
+        self.conn = conn
+        self.commandSocket = commandSocket
+        self.transferId = transferId
+        self.dataSocket = dataSocket
+        self.blockSize = blockSize
+        self.window = window
+        self.position = 0
+        self.reader = MessageReader(initialSize=256)  # own reader so transfers can run on other threads
+        self.buf = bytearray(256 * 1024)
+
+    def _sendRequest(self, msg):
+        self.conn._sendMsg(self.commandSocket, msg)
+        return self.reader.read(self.commandSocket)
+
+    def seek(self, offset):
+        """
+        Position the transfer at offset bytes from the start of the file.
+        @raise ServerException: if the backend did not seek to offset
+        """
+        msg = ['QUERY_FILETRANSFER %s' % self.transferId, 'SEEK']
+        self.conn.protocol.writeLong(offset, msg)
+        msg.append('0')   # SEEK_SET
+        self.conn.protocol.writeLong(0, msg)
+        reply = self._sendRequest(msg)
+        if self.conn.protocol.readLong(reply) != offset:
+            raise ServerException('Seek to %d failed: %s' % (offset, reply))
+        self.position = offset
+
+    def copyTo(self, fh, numBytes, progress=None):
+        """
+        Write the next numBytes bytes of the file to fh at its current position.
+
+        @param progress: callable passed the number of bytes written after each block
+        @return: number of bytes written. Less than numBytes if the backend hit eof.
+        @rtype: int
+        """
+        start = time.time()
+        unrequested = numBytes
+        inflight = []
+        written = 0
+        eof = False
+
+        try:
+            while (unrequested > 0 and not eof) or inflight:
+                while unrequested > 0 and not eof and len(inflight) < self.window:
+                    size = min(self.blockSize, unrequested)
+                    self.conn._sendMsg(self.commandSocket, ['QUERY_FILETRANSFER %s' % self.transferId, 'REQUEST_BLOCK', '%d' % size])
+                    inflight.append(size)
+                    unrequested -= size
+
+                size = inflight.pop(0)
+                if eof:
+                    # backend already ran out of file - just collect the replies still due
+                    self.reader.read(self.commandSocket)
+                    continue
+                
+                blockStart = time.time()
+                received = self._receiveBlock(fh, size)
+                written += received
+                self.position += received
+                wirelog.debug('requested %d bytes received %d' % (size, received))
+                if progress:
+                    progress(received)
+                if received < size:
+                    eof = True
+                else:
+                    self._adapt(size, time.time() - blockStart)
+        finally:
+            elapsed = time.time() - start
+            wirelog.info('transferred %d bytes in %2.2f secs (%d bytes/sec)' % (written, elapsed, written / max(elapsed, 0.001)))
+        return written
+
+    def _receiveBlock(self, fh, size):
+        """
+        Write the block at the head of the window to fh and consume its reply.
         
-    def checkin():
-        if threadlocals[tlsKey].level == 1:
-            if not threadlocals[tlsKey].discarded:
-                ilog.debug('--> removed conn %s from %s at level %d' % (threadlocals[tlsKey].conn, threadlocals[tlsKey], threadlocals[tlsKey].level))
-                connPool.checkin(threadlocals[tlsKey].conn)
-                threadlocals[tlsKey].conn = None
-                threadlocals[tlsKey].discarded = None
-                del threadlocals[tlsKey]
-            else:
-                ilog.debug('skipped chekin at level %d because discarded' % threadlocals[tlsKey].level)
-        else:
-            ilog.debug('skipping checkin at level %d' % threadlocals[tlsKey].level)
-            threadlocals[tlsKey].level -= 1
-    
-    
-    def createKey():
-        k = 'c' + str(thread.get_ident())
-        ilog.debug('tlskey = %s' % k)
-        return k
-
-    tlsKey = createKey()
-    allocate_threadlocal()
-    checkout()
-    bolt_on_accessor()
-    
-    try:        
-        result = func(*args, **kwargs)
-    except socket.timeout, te:
-        discard()
-        raise
-    except socket.error, se:
-        if shouldReconnect(se):
-            discard()
-            return tryAgain()
-        elif shouldGiveUp(se):
-            discard()
-            raise
-        else:
-            raise
-    except:
-        log.exception('conn catchall')
-        checkin()
-        raise
-    else:
-        checkin()
-        
-    return result
+        @return: number of bytes the backend sent for the block. Less than size at eof.
+        """
+        view = memoryview(self.buf)
+        received = 0
+        sent = None
+        while sent is None or received < sent:
+            if sent is None:
+                if received < size:
+                    # select ignores the socket timeout so apply it here or a stalled backend hangs the transfer
+                    timeout = self.dataSocket.gettimeout()
+                    readable = select.select([self.dataSocket, self.commandSocket], [], [], timeout)[0]
+                    if not readable:
+                        raise socket.timeout('No data from backend for %s secs' % timeout)
+                if received == size or self.dataSocket not in readable:
+                    # the reply follows the data so a reply with no data pending means a short block
+                    sent = max(0, int(self.reader.read(self.commandSocket)[0]))
+                    continue
+            n = self.dataSocket.recv_into(view, min(len(self.buf), [sent, size][sent is None] - received))
+            if n == 0:
+                break # eof
+            fh.write(view[:n])
+            received += n
+        return received
 
+    def _adapt(self, size, elapsed):
+        bytesPerSec = size / max(elapsed, 0.001)
+        self.blockSize = int(min(self.maxBlockSize, max(self.minBlockSize, bytesPerSec * self.blockSecs)))
 
-class ClientException(Exception): 
-    """Thrown when the mythtv client behaves inappropriately"""
-    pass
+    def close(self):
+        try:
+            self.dataSocket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.dataSocket.close()
 
 
-class ServerException(Exception): 
-    """Thrown in response to error conditions from the mythtv backend"""
-    pass
+class TransferCheckpoint(object):
+    """
+    Sidecar to a partially transferred file which records the identity of the backend
+    file and how far each byte range of it has made it to disk so an interrupted
+    transfer can pick up where it left off.
+    """
+
+    def __init__(self, path, identity, ranges):
+        """
+        @param path: path of the checkpoint file
+        @param identity: identifies the backend file. Ex: (backendPath, hostname, filesize)
+        @param ranges: [[offset, end]] where offset is the next byte of the range to transfer
+        """
+        self.path = path
+        self.identity = identity
+        self.ranges = ranges
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create(path, identity, numBytes, numRanges):
+        """
+        @return: checkpoint for a fresh transfer of numBytes split into numRanges contiguous ranges
+        """
+        rangeSize = (numBytes + numRanges - 1) / numRanges
+        ranges = [[start, min(start + rangeSize, numBytes)] for start in xrange(0, numBytes, rangeSize)]
+        return TransferCheckpoint(path, identity, ranges)
+
+    @staticmethod
+    def load(path, identity):
+        """
+        @return: checkpoint saved at path if it is for the same backend file, None otherwise
+        """
+        try:
+            f = open(path, 'rb')
+            try:
+                saved = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return None
+        if saved.get('identity') != identity:
+            return None
+        return TransferCheckpoint(path, identity, saved['ranges'])
+
+    def save(self):
+        f = open(self.path, 'wb')
+        try:
+            pickle.dump({'identity': self.identity, 'ranges': self.ranges}, f)
+        finally:
+            f.close()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def advance(self, i, numBytes):
+        """Record numBytes more of range i as written and save"""
+        self.lock.acquire()
+        try:
+            self.ranges[i][0] += numBytes
+            self.save()
+        finally:
+            self.lock.release()
+
+    def remaining(self):
+        """
+        @return: indexes of ranges that aren't finished
+        @rtype: int[]
+        """
+        return [i for i, (offset, end) in enumerate(self.ranges) if offset < end]
+
+    def bytesRemaining(self):
+        return sum([end - offset for offset, end in self.ranges])
+
+
+def parallelCopy(transfers, destPath, checkpoint):
+    """
+    Copy the unfinished ranges of a checkpoint into destPath with the given transfers
+    running concurrently. Each range is written at its own offset in destPath and
+    progress is saved to the checkpoint as blocks arrive.
+
+    @param transfers: FileTransfer[] all open on the same backend file
+    @param destPath: existing partial file
+    @return: True if every range was copied in full, False otherwise
+    @rtype: bool
+    @raise Exception: first error any of the transfers ran into, after all have stopped
+    """
+    # transfers start on the ranges in order (the first one is usually already at offset 0)
+    # and then help out with whatever is left
+    remaining = checkpoint.remaining()
+    todo = Queue.Queue()
+    for i in remaining[len(transfers):]:
+        todo.put(i)
+    errors = []
+
+    def copyRanges(transfer, i):
+        fh = file(destPath, 'r+b')
+        try:
+            while not errors and i is not None:
+                offset, end = checkpoint.ranges[i]
+                if transfer.position != offset:
+                    transfer.seek(offset)
+                fh.seek(offset)
+                def progress(numBytes):
+                    fh.flush()
+                    checkpoint.advance(i, numBytes)
+                if transfer.copyTo(fh, end - offset, progress) < end - offset:
+                    break # eof
+                try:
+                    i = todo.get_nowait()
+                except Queue.Empty:
+                    i = None
+        except Exception, e:
+            log.exception('Transfer to %s failed' % destPath)
+            errors.append(e)
+        fh.close()
+
+    first = remaining + [None] * len(transfers)
+    workers = [threading.Thread(target=copyRanges, args=(t, first[i]), name='FileTransfer %d' % i) for i, t in enumerate(transfers) if i > 0]
+    for w in workers:
+        w.start()
+    copyRanges(transfers[0], first[0])
+    for w in workers:
+        w.join()
+    if errors:
+        raise errors[0]
+    return not checkpoint.remaining()
+
+
+
+class ProtocolVersionCache(object):
+    """
+    Process-wide cache of the protocol version spoken by each master backend. Persisted
+    in the cache dir so that the flurry of connections made on startup doesn't need a
+    throwaway socket to induce a reject just to find out which version to send.
+    """
+
+    lock = threading.RLock()
+    filename = 'protocol_versions.pickle'
+    path = None       # file versions were loaded from
+    versions = {}     # {(hostname, ipAddress, port): version}
+
+    @classmethod
+    def get(cls, platform, backend, probe):
+        """
+        @param probe: callable which asks the backend for its version. Only called on a miss.
+        @return: protocol version spoken by backend
+        @rtype: int
+        """
+        cls.lock.acquire()
+        try:
+            versions = cls._load(platform)
+            key = cls._identity(backend)
+            if key not in versions:
+                cls.put(platform, backend, probe())
+            return versions[key]
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def put(cls, platform, backend, version):
+        cls.lock.acquire()
+        try:
+            cls._load(platform)[cls._identity(backend)] = version
+            cls._save()
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def _identity(cls, backend):
+        return (backend.hostname, backend.ipAddress, backend.port)
+
+    @classmethod
+    def _load(cls, platform):
+        try:
+            path = os.path.join(platform.getCacheDir(), cls.filename)
+        except Exception:
+            path = None   # nowhere to persist to - cache for the life of the process only
+        if path != cls.path:
+            cls.path = path
+            cls.versions = {}
+            try:
+                if path and os.path.exists(path):
+                    f = open(path, 'rb')
+                    try:
+                        cls.versions = pickle.load(f)
+                    finally:
+                        f.close()
+            except Exception:
+                log.exception('Loading protocol versions from %s' % path)
+        return cls.versions
+
+    @classmethod
+    def _save(cls):
+        if not cls.path:
+            return
+        try:
+            f = open(cls.path, 'wb')
+            try:
+                pickle.dump(cls.versions, f)
+            finally:
+                f.close()
+        except Exception:
+            log.exception('Error saving protocol versions to %s' % cls.path)
+
 
-  
 class Connection(object):
     """Connection to MythTV Backend.
     TODO: Fix quirkiness -- establishes new conn to slave if target backend isn't the master"""
     
+    parallelTransferMinBytes = 10 * 1024 * 1024  # don't bother with extra streams for anything smaller
+    
     def __init__(self, settings, translator, platform, bus, db=None):
         """
         @param db: None means use @inject_db
@@ -223,11 +747,19 @@ class Connection(object):
         self.bus = bus
         self.bus.register(self)  # interested in SCHEDULER_RAN event to invalidate upcoming recordings
         self._db = db
+        self.reader = MessageReader()
         self.db_init()
 
     def db(self):
         return self._db
     
+    def pipeline(self):
+        """
+        @return: Pipeline for batching requests on the command socket into a single round trip
+        @rtype: Pipeline
+        """
+        return Pipeline(self)
+
     @inject_db    
     def db_init(self):
         self.master = self.db().getMasterBackend()
@@ -242,26 +774,12 @@ class Connection(object):
         @param announce: Playback, Monitor, or None (to not announce anything)  
         @return: socket to backend
         """
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if slaveBackend == None:
             backend = self.master
         else:
             backend = self.db().toBackend(slaveBackend)
             
-        s.connect((backend.ipAddress, backend.port))
-        
-        if not protocol.serverVersion:
-            protocol.serverVersion = self.getServerVersion()
-        
-        # Protocol version has to be sent on each new connection
-
-        try:
-            self.protocol = protocol.protocols[protocol.serverVersion]
-        except KeyError:
-            raise ProtocolException('Unsupported protocol: %s' % protocol.serverVersion)
-
-        #serverVersion = 
-        self.negotiateProtocol(s, protocol.serverVersion, self.protocol.protocolToken())
+        s = self._connectAndNegotiate(backend)
 
         if announce:
             if announce == 'Playback':
@@ -272,9 +790,50 @@ class Connection(object):
                 raise ClientException('Unsupported announce command: %s' % announce)
         return s
     
+    def _openSocket(self, backend):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((backend.ipAddress, backend.port))
+        return s
+
+    def _connectAndNegotiate(self, backend):
+        """
+        Protocol version has to be sent on each new connection. The version comes from
+        ProtocolVersionCache and is only probed for again if the backend rejects it.
+        
+        @return: socket to backend which has negotiated the protocol version
+        """
+        version = ProtocolVersionCache.get(self.platform, self.master, self.getServerVersion)
+        s = self._openSocket(backend)
+        try:
+            self._negotiateVersion(s, version)
+        except ProtocolException, pe:
+            s.close()
+            serverVersion = getattr(pe, 'protocolVersion', None)
+            if serverVersion is None or serverVersion == version:
+                raise
+            # backend was upgraded (or downgraded) since the version was cached. The reject 
+            # carries the version it wants so there's no need for another probe.
+            log.info('Backend rejected cached protocol version %s, retrying with %s' % (version, serverVersion))
+            ProtocolVersionCache.put(self.platform, self.master, serverVersion)
+            s = self._openSocket(backend)
+            self._negotiateVersion(s, serverVersion)
+        return s
+
+    def _negotiateVersion(self, s, version):
+        try:
+            self.protocol = protocol.protocols[version]
+        except KeyError:
+            raise ProtocolException('Unsupported protocol: %s' % version)
+        protocol.serverVersion = version
+        self.negotiateProtocol(s, version, self.protocol.protocolToken())
+
     def getServerVersion(self):
-        # TODO: Optimize to static method proteced by a class level lock so only done once
-        #       and not multiple times on a flurry of new connection instances on startup
+        """
+        Probe for the protocol version of the master backend by inducing a reject on a
+        throwaway socket. Prefer ProtocolVersionCache.get() which only probes on a miss.
+        
+        @rtype: int
+        """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((self.master.ipAddress, self.master.port))
         try:
@@ -288,6 +847,20 @@ class Connection(object):
             sock.close()
         return serverVersion
         
+    def isAlive(self):
+        """
+        @return: True if the command socket still gets replies from the backend, False otherwise
+        """
+        try:
+            # nothing should be waiting to be read on an idle command socket. If there is,
+            # it's eof because the backend went away or junk from an abandoned request.
+            if select.select([self.cmdSock], [], [], 0)[0]:
+                return False
+            return len(self._sendRequest(self.cmdSock, ['QUERY_UPTIME'])) > 0
+        except Exception, e:
+            log.debug('Connection %s is dead: %s' % (self, e))
+            return False
+        
     def close(self):
         if self.cmdSock:
             self._sendMsg(self.cmdSock, ['DONE'])
@@ -383,24 +956,21 @@ class Connection(object):
         """
         For a tuner that is recording, return the number of frames written as an int
         """
-        reply = self._sendRequest(self.cmdSock, ['QUERY_RECORDER %d' % tuner.tunerId, 'GET_FRAMES_WRITTEN'])
-        return self.protocol.readLong(reply)
+        return self.pipeline().getFramesWritten(tuner).result()
 
     @timed
     def getTunerFilePosition(self, tuner):
         """
         For a tuner that is recording, return the current position in the file as an int
         """
-        reply = self._sendRequest(self.cmdSock, ['QUERY_RECORDER %d' % tuner.tunerId, 'GET_FILE_POSITION'])
-        return self.protocol.readLong(reply)
+        return self.pipeline().getTunerFilePosition(tuner).result()
 
     @timed
     def getTunerFrameRate(self, tuner):
         """
         For a tuner that is recording, return the framerate as a float
         """
-        reply = self._sendRequest(self.cmdSock, ['QUERY_RECORDER %d' % tuner.tunerId, 'GET_FRAMERATE'])
-        return float(reply[0])
+        return self.pipeline().getTunerFrameRate(tuner).result()
 
     @timed 
     def getCurrentRecording(self, tuner):
@@ -408,10 +978,7 @@ class Connection(object):
         @return: For a tuner that is recording, return the current Program
         @rtype: RecordedProgram
         """
-        reply = self._sendRequest(self.cmdSock, ['QUERY_RECORDER %d' % tuner.tunerId, 'GET_CURRENT_RECORDING'])
-        from mythbox.mythtv.domain import RecordedProgram
-        program = RecordedProgram(reply, self.settings, self.translator, self.platform, self.protocol, [self, None][self._db is None])
-        return program
+        return self.pipeline().getCurrentRecording(tuner).result()
         
     @inject_db
     def getTunerShowing(self, showName):
@@ -444,12 +1011,11 @@ class Connection(object):
         """
         @rtype: TVSTate enum
         """
-        reply = self._sendRequest(self.cmdSock, ['QUERY_REMOTEENCODER %d' % tuner.tunerId, 'GET_STATE'])
-        return int(reply[0])
+        return self.pipeline().getTunerStatus(tuner).result()
 
     @timed
     def getNumFreeTuners(self):
-        return int(self._sendRequest(self.cmdSock, ['GET_FREE_RECORDER_COUNT'])[0])
+        return self.pipeline().getNumFreeTuners().result()
 
     @timed
     def getNextFreeTuner(self, afterTunerId):
@@ -533,12 +1099,7 @@ class Connection(object):
             reply = self._sendRequest(self.cmdSock, command)
             return reply[0] == '1'
         else:
-            log.debug('Tuner is on a slave..creating new connection')
-            bs = self.connect(slaveBackend=tuner.getBackend().ipAddress)
-            reply = self._sendRequest(bs, command)
-            self._sendMsg(bs, ['DONE'])
-            bs.shutdown(socket.SHUT_RDWR)
-            bs.close()
+            reply = self._sendSlaveRequest(tuner.getBackend(), command)
             return reply[0] == '1'
                         
     @timed
@@ -611,7 +1172,7 @@ class Connection(object):
         msg.append('%d' % 640)
         msg.append('%d' % 360)
         
-        # if a slave backend, establish a new connection otherwise reuse existing connection to master backend.
+        # if a slave backend, use a pooled connection to it otherwise reuse existing connection to master backend.
         backend = self.db().toBackend(backendHost)
         
         if backend is None:
@@ -621,11 +1182,8 @@ class Connection(object):
             result = self._isOk(reply)
         else:
             try:
-                s = self.connect(slaveBackend=backend.ipAddress)
-                reply = self._sendRequest(s, msg)
+                reply = self._sendSlaveRequest(backend, msg)
                 result = self._isOk(reply)
-                s.shutdown(socket.SHUT_RDWR)
-                s.close()
             except socket.error, se:
                 if backend.slave:
                     log.error('Slave down, rerouting to master')
@@ -697,7 +1255,7 @@ class Connection(object):
 #        msg.append('')  # trailing separator
         msg.insert(0, 'QUERY_PIXMAP_LASTMODIFIED')
 
-        # if a slave backend, establish a new connection otherwise reuse existing connection to master backend.
+        # if a slave backend, use a pooled connection to it otherwise reuse existing connection to master backend.
         backend = self.db().toBackend(backendHost)
 
         if backend is None:
@@ -705,10 +1263,7 @@ class Connection(object):
         elif backend == self.master:
             reply = self._sendRequest(self.cmdSock, msg)
         else: 
-            s = self.connect(slaveBackend=backend.ipAddress)
-            reply = self._sendRequest(s, msg)
-            s.shutdown(socket.SHUT_RDWR)
-            s.close()
+            reply = self._sendSlaveRequest(backend, msg)
         
         if reply == None or len(reply) == 0 or reply[0] == 'BAD':
             dt = None
@@ -723,22 +1278,22 @@ class Connection(object):
         @return: Programs ordered by title. Not much else of the returned data is of any use. 
                  The good stuff is in getUpcomingRecordings()
         """
-        scheduledRecordings = []
-        reply = self._sendRequest(self.cmdSock, ['QUERY_GETALLSCHEDULED'])
-        cnt = int(reply[0])
-        offset = 1
-        from mythbox.mythtv.domain import RecordedProgram
-        for i in range(cnt):
-            scheduledRecordings.append(
-                RecordedProgram(
-                    reply[offset:(offset+self.protocol.recordSize())],
-                    self.settings, 
-                    self.translator,
-                    self.platform,
-                    self.protocol,
-                    [self, None][self._db is None]))
-            offset += self.protocol.recordSize()
-        return scheduledRecordings
+        return list(self.iterScheduledRecordings())
+
+    def iterScheduledRecordings(self):
+        """
+        Streaming version of getScheduledRecordings()
+        
+        @return: generator of RecordedProgram decoded as they arrive off the wire
+        @attention: Exhaust or close() before issuing another request on this connection
+        """
+        fields = self._streamRequest(self.cmdSock, ['QUERY_GETALLSCHEDULED'])
+        try:
+            cnt = int(fields.next())
+            for program in self._decodePrograms(fields, cnt):
+                yield program
+        finally:
+            fields.close()
 
     def onEvent(self, event):
         pass
@@ -748,54 +1303,53 @@ class Connection(object):
         @type filter: UPCOMING_*
         @rtype: RecordedProgram[]
         """
-        upcoming = []
-        reply = self._sendRequest(self.cmdSock, ['QUERY_GETALLPENDING', '2'])
-        
-        log.debug('getUpcomingRecordings reply begin= %s' % safe_str(reply[:80]))
-        log.debug('getUpcomingRecordings reply end  = %s' % safe_str(reply[-80:]))
-        
-        numRows = int(reply[1])
-        offset = 2
+        return list(self.iterUpcomingRecordings(filter))
 
-        from mythbox.mythtv.domain import RecordedProgram
-        for i in xrange(numRows):
-            program = RecordedProgram(
-                    reply[offset:offset+self.protocol.recordSize()],
-                    self.settings, 
-                    self.translator,
-                    self.platform,
-                    self.protocol,
-                    [self, None][self._db is None])
-            if program.getRecordingStatus() in filter:
-                upcoming.append(program)
-            offset += self.protocol.recordSize()
-        return upcoming
+    def iterUpcomingRecordings(self, filter=Upcoming.SCHEDULED):
+        """
+        Streaming version of getUpcomingRecordings()
+        
+        @type filter: UPCOMING_*
+        @return: generator of RecordedProgram decoded as they arrive off the wire
+        @attention: Exhaust or close() before issuing another request on this connection
+        """
+        fields = self._streamRequest(self.cmdSock, ['QUERY_GETALLPENDING', '2'])
+        try:
+            hasConflicts = fields.next()
+            numRows = int(fields.next())
+            log.debug('iterUpcomingRecordings numRows = %s hasConflicts = %s' % (numRows, hasConflicts))
+            for program in self._decodePrograms(fields, numRows):
+                if program.getRecordingStatus() in filter:
+                    yield program
+        finally:
+            fields.close()
 
     @timed
     def getAllRecordings(self):
         """
         @return: RecordedProgram[]  (most recently recorded first)
         """
-        reply = self._sendRequest(self.cmdSock, self.protocol.genQueryRecordingsCommand())   
-        numPrograms = int(reply.pop(0))
-        programs = [] 
-        offset = 0
-        recordSize = self.protocol.recordSize()
         from mythbox.mythtv.domain import RecordedProgram
-        for i in xrange(numPrograms):
-            # use of self._db intentional 
-            programs.append(RecordedProgram(
-                reply[offset:offset+recordSize], 
-                self.settings, 
-                self.translator, 
-                self.platform,
-                self.protocol, 
-                [self, None][self._db is None],
-                [self._db, None][self._db is None])) 
-            offset += recordSize
-        programs = filter(lambda p: p.getRecordingGroup() not in [ 'LiveTV', 'Deleted' ], programs)
-        programs.sort(key=RecordedProgram.starttimeAsTime, reverse=True)
+        programs = list(self.iterAllRecordings())
+        programs.sort(key=RecordedProgram.dateSortKey, reverse=True)
         return programs
+
+    def iterAllRecordings(self):
+        """
+        Streaming version of getAllRecordings()
+        
+        @return: generator of RecordedProgram in the order sent by the backend (unsorted)
+        @attention: Exhaust or close() before issuing another request on this connection
+        """
+        fields = self._streamRequest(self.cmdSock, self.protocol.genQueryRecordingsCommand())
+        try:
+            numPrograms = int(fields.next())
+            # use of self._db intentional
+            for program in self._decodePrograms(fields, numPrograms, [self._db, None][self._db is None]):
+                if program.getRecordingGroup() not in ('LiveTV', 'Deleted',):
+                    yield program
+        finally:
+            fields.close()
     
     @timed
     def getRecordings(self, recordingGroup='default', title='all shows'):
@@ -808,25 +1362,45 @@ class Connection(object):
         @type title: string
         @rtype: RecordedProgram[]
         """
-        # TODO: Optimize so it doesn't get all recordings and filters locally
-        programs = []
-        offset = 0
-        reply = self._sendRequest(self.cmdSock, self.protocol.genQueryRecordingsCommand())   
-        numRows = int(reply.pop(0))
+        return list(self.iterRecordings(recordingGroup, title))
+
+    def iterRecordings(self, recordingGroup='default', title='all shows'):
+        """
+        Streaming version of getRecordings()
         
+        @return: generator of RecordedProgram decoded as they arrive off the wire
+        @attention: Exhaust or close() before issuing another request on this connection
+        """
+        # TODO: Optimize so it doesn't get all recordings and filters locally
         recordingGroup = recordingGroup.upper()
         title = title.upper()
+        fields = self._streamRequest(self.cmdSock, self.protocol.genQueryRecordingsCommand())
+        try:
+            numRows = int(fields.next())
+            for p in self._decodePrograms(fields, numRows):
+                if  recordingGroup in ('ALL GROUPS', p.getRecordingGroup().upper(),) and \
+                    title in ('ALL SHOWS', p.title().upper(),):
+                    yield p
+        finally:
+            fields.close()
+
+    def _decodePrograms(self, fields, numPrograms, db=None):
+        """
+        @param fields: iterator of reply fields positioned at the start of the first record
+        @return: generator of RecordedProgram
+        """
         from mythbox.mythtv.domain import RecordedProgram
-        
-        for i in xrange(numRows):
-            response = reply[offset:offset+self.protocol.recordSize()]
-            # use of self._db intentional
-            p = RecordedProgram(response, self.settings, self.translator, self.platform, self.protocol, [self, None][self._db is None])
-            if  recordingGroup.upper() in ('ALL GROUPS', p.getRecordingGroup().upper(),) and \
-                title.upper() in ('ALL SHOWS', p.title().upper(),):
-                programs.append(p) 
-            offset += self.protocol.recordSize()
-        return programs
+        recordSize = self.protocol.recordSize()
+        conn = [self, None][self._db is None]
+        for i in xrange(numPrograms):
+            yield RecordedProgram(
+                list(itertools.islice(fields, recordSize)), 
+                self.settings, 
+                self.translator, 
+                self.platform, 
+                self.protocol, 
+                conn, 
+                db)
 
     @timed
     def getRecording(self, channelId, startTime):
@@ -898,7 +1472,7 @@ class Connection(object):
         if len(reply) == 0:
             return commBreaks
         
-        numRecs = int(reply.pop(0))
+        numRecs = int(reply[0])
         
         if numRecs in (-1,0,):
             return commBreaks        
@@ -907,20 +1481,21 @@ class Connection(object):
             raise ClientException, 'Expected an even number of comm break records but got %s instead' % numRecs
         
         fps = program.getFPS()
+        from mythbox.mythtv.domain import frames2seconds, CommercialBreak
         
+        pos = 1  # index of the next field in reply - cheaper than popping off the front of the list
         for i in xrange(0, numRecs, 2):  # skip by 2's - start/end come in pairs
 
-            commFlagStart = int(reply.pop(0))
+            commFlagStart = int(reply[pos])
             if commFlagStart != COMM_START:
                 raise ProtocolException, 'Expected COMM_START for record %s but got %s instead' % ((i+1), commFlagStart)
-            frameStart = self.protocol.readLong(reply, remove=True)
+            frameStart, pos = self.protocol.readLongAt(reply, pos + 1)
 
-            commFlagEnd = int(reply.pop(0))
+            commFlagEnd = int(reply[pos])
             if commFlagEnd != COMM_END:
                 raise ProtocolException, 'Expected COMM_END for record %s but got %s instead' %((i+2), commFlagEnd)            
-            frameEnd = self.protocol.readLong(reply, remove=True)
+            frameEnd, pos = self.protocol.readLongAt(reply, pos + 1)
 
-            from mythbox.mythtv.domain import frames2seconds, CommercialBreak
             commBreaks.append(CommercialBreak(frames2seconds(frameStart, fps), frames2seconds(frameEnd, fps)))
                         
         log.debug('%s commercials in %s' %(len(commBreaks), safe_str(program.title())))
@@ -932,41 +1507,21 @@ class Connection(object):
         @return: Disk usage stats for master backend only. Numbers are ints in units of byte.
         @todo: Update so support multiple storage groups. For now, just return the stats on the first storage group
         """
-        reply = self._sendRequest(self.cmdSock, ['QUERY_FREE_SPACE'])
-        ok = reply.pop(0)
-        hostname = reply.pop(0)
-        directory = reply.pop(0)
-        _ = reply.pop(0)
-        _ = reply.pop(0)
-        totalSpace = self.protocol.readLong(reply, remove=True)
-        usedSpace = self.protocol.readLong(reply, remove=True)
-
-        return {
-            'hostname' : hostname,
-            'dir'      : directory,
-            'total'    : totalSpace,
-            'used'     : usedSpace,     
-            'free'     : totalSpace - usedSpace,    
-        }
+        return self.pipeline().getDiskUsage().result()
     
     def getLoad(self):
         """
         @rtype: {str:str} with keys '1', '5', '15'
         @return: Backend load for the last 1/5/15 minutes
         """
-        reply = self._sendRequest( self.cmdSock, ['QUERY_LOAD'])
-        return {'1':reply[0], '5':reply[1], '15':reply[2]}
+        return self.pipeline().getLoad().result()
 
     def getUptime(self):
         """
         @rtype: datetime.timedelta
         @return: Uptime of the backend. If a non-unix based host, returns None
         """
-        uptime = self._sendRequest(self.cmdSock, ['QUERY_UPTIME'])[0]
-        try:
-            return datetime.timedelta(seconds=int(uptime))
-        except:
-            return None
+        return self.pipeline().getUptime().result()
 
     @inject_db
     def getGuideDataStatus(self):
@@ -1069,8 +1624,7 @@ class Connection(object):
         @param max: Max number of bytes to transfer. None == unlimited
         @rtype: bool
         """
-        rc = True
-        closeCommandSocket = False
+        slaveBackend = None
         
         if backendHost ==  None:
             backendHost = self.master.ipAddress
@@ -1086,68 +1640,142 @@ class Connection(object):
         else:
             log.debug('Requesting file from slave backend: %s' % backend.ipAddress)
             try:
-                commandSocket = self.connect(announce='Playback', slaveBackend=backend.ipAddress)
+                commandSocket = self._checkoutSlaveSocket(backend)
             except socket.error, se:
                 if backend.slave:
                     log.error('XXX slave %s is not available...trying master' % backend)
                     return self.transferFile(backendPath, destPath, self.db().getMasterBackend().ipAddress, numBytes)
-            closeCommandSocket = True 
+                raise
+            slaveBackend = backend
         
+        try:
+            rc = self._transferFile(backend, commandSocket, backendPath, destPath, numBytes)
+        except:
+            if slaveBackend:
+                self._discardSlaveSocket(slaveBackend, commandSocket)
+            raise
+        if slaveBackend:
+            self._checkinSlaveSocket(slaveBackend, commandSocket)
+        return rc
+
+    def _transferFile(self, backend, commandSocket, backendPath, destPath, numBytes):
+        rc = True
         try: 
             reply,dataSocket = self.annFileTransfer(backend.hostname, backendPath)
         except ServerException:
             return False
         
-        filename = reply.pop(0)
+        transferId = reply.pop(0)
         filesize = self.protocol.readLong(reply, remove=True)
         
-        log.debug('path = %s\tfile = %s\tsize = %s' % (backendPath, filename, filesize))
-        
-        if filesize == 0:
-            rc = False
-        else:
-            if numBytes:
-                filesize = min(numBytes, filesize)
-            
-            maxBlockSize = 20000000 # 20MB
-            remainingBytes = filesize
-            fh = file(destPath, 'w+b')
-            maxReceived = 0
-            
-            while remainingBytes > 0:
-                blockSize = min(remainingBytes, maxBlockSize)
-                requestBlockMsg = ['QUERY_FILETRANSFER ' + filename, 'REQUEST_BLOCK', '%s' % blockSize]
-                self._sendMsg(commandSocket, requestBlockMsg)
-                
-                blockTransferred = 0
-                while blockTransferred < blockSize:
-                    expectedBytes = blockSize - blockTransferred
-                    wirelog.debug('waiting for %d bytes' % expectedBytes)
-                    data = dataSocket.recv(expectedBytes)
-                    actualBytes = len(data)
-                    maxReceived = max(maxReceived, actualBytes)
-                    wirelog.debug('received %d bytes' % actualBytes)
-                    blockTransferred += actualBytes
-                    if actualBytes > 0:
-                        fh.write(data)
-                        wirelog.debug('wrote %d bytes' % actualBytes)
+        log.debug('path = %s\ttransfer = %s\tsize = %s' % (backendPath, transferId, filesize))
+        transfer = FileTransfer(self, commandSocket, transferId, dataSocket)
+        extraTransfers = []
+        try:
+            if filesize == 0:
+                rc = False
+            else:
+                if numBytes:
+                    filesize = min(numBytes, filesize)
                 
-                reply = self._readMsg(commandSocket)
-                wirelog.debug('reply = %s'%reply)
-                remainingBytes = remainingBytes - blockSize
+                # transfer into a partial file + checkpoint so an interrupted transfer can be resumed
+                partialPath = destPath + '.partial'
+                identity = (backendPath, backend.hostname, filesize)
+                checkpoint = TransferCheckpoint.load(partialPath + '.checkpoint', identity)
+                if checkpoint and os.path.exists(partialPath):
+                    log.debug('Resuming transfer of %s with %d bytes remaining' % (backendPath, checkpoint.bytesRemaining()))
+                else:
+                    streams = 1
+                    if filesize >= self.parallelTransferMinBytes:
+                        streams = self.settings.getTransferStreams(backend.hostname)
+                    checkpoint = TransferCheckpoint.create(partialPath + '.checkpoint', identity, filesize, streams)
+                    fh = file(partialPath, 'w+b')
+                    fh.truncate(filesize)
+                    fh.close()
+                    checkpoint.save()
+
+                if len(checkpoint.remaining()) > 1:
+                    streams = self.settings.getTransferStreams(backend.hostname)
+                    extraTransfers = self._openFileTransfers(backend, backendPath, min(streams, len(checkpoint.remaining())) - 1)
+                rc = parallelCopy([transfer] + extraTransfers, partialPath, checkpoint)
+
+                if rc:
+                    checkpoint.remove()
+                    if os.path.exists(destPath):
+                        os.remove(destPath)
+                    os.rename(partialPath, destPath)
+                wirelog.debug('transferFile rc = %d' % rc)
+        finally:
+            for t in extraTransfers:
+                t.close()
+                try:
+                    t.commandSocket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                t.commandSocket.close()
+            transfer.close()
+        return rc
 
-            fh.close()
-            wirelog.debug('transferFile rc = %d' % rc)
-            wirelog.debug('max rcz size = %d' % maxReceived)
+    def _checkoutSlaveSocket(self, backend):
+        """
+        @return: command socket announced for Playback to the given slave backend. Pooled 
+                 when the slavePool is available, otherwise a new connection.
+        """
+        slavePool = pool.pools.get('slavePool')
+        if slavePool is None:
+            return self.connect(announce='Playback', slaveBackend=backend.ipAddress)
+        return slavePool.checkout(backend.ipAddress)
 
-        dataSocket.shutdown(socket.SHUT_RDWR)
-        dataSocket.close()
-        
-        if closeCommandSocket:
-            commandSocket.shutdown(socket.SHUT_RDWR)
-            commandSocket.close()
-        
-        return rc
+    def _checkinSlaveSocket(self, backend, s):
+        slavePool = pool.pools.get('slavePool')
+        if slavePool is None:
+            closeSlaveSocket(s)
+        else:
+            slavePool.checkin(backend.ipAddress, s)
+
+    def _discardSlaveSocket(self, backend, s):
+        """Throw away a slave socket which may be left in an unknown state"""
+        slavePool = pool.pools.get('slavePool')
+        if slavePool is None:
+            closeSlaveSocket(s)
+        else:
+            slavePool.discard(backend.ipAddress, s)
+
+    def _sendSlaveRequest(self, backend, msg):
+        """
+        @return: reply to msg sent to the given slave backend on a pooled connection
+        """
+        s = self._checkoutSlaveSocket(backend)
+        try:
+            reply = self._sendRequest(s, msg)
+        except:
+            self._discardSlaveSocket(backend, s)
+            raise
+        self._checkinSlaveSocket(backend, s)
+        return reply
+
+    def _openFileTransfers(self, backend, backendPath, count):
+        """
+        Open additional FileTransfers to backendPath, each over its own command socket
+        so they can be driven concurrently. 
+
+        @return: up to count FileTransfers. Fewer if the backend refuses any more. 
+        @rtype: FileTransfer[]
+        """
+        transfers = []
+        for i in xrange(count):
+            try:
+                commandSocket = self.connect(announce='Playback', slaveBackend=backend.ipAddress)
+                try:
+                    reply, dataSocket = self.annFileTransfer(backend.hostname, backendPath)
+                except:
+                    commandSocket.close()
+                    raise
+            except (socket.error, ServerException), e:
+                log.warn('Could only open %d of %d extra streams to %s: %s' % (len(transfers), count, backend.hostname, e))
+                break
+            transfers.append(FileTransfer(self, commandSocket, reply[0], dataSocket))
+        return transfers
 
     def _buildMsg(self, msg):
         msg = protocol.separator.join(msg)
@@ -1155,28 +1783,7 @@ class Connection(object):
         return '%-8d%s' % (len(msg), msg)
 
     def _readMsg(self, s):
-        retMsg = self.recv_all(s, 8)
-        #wirelog.debug("REPLY: %s"%retMsg)
-        reply = u''
-        if retMsg.upper() == u'OK':
-            return u'OK'
-        #wirelog.debug('retMsg: [%d] %s' % (len(retMsg), safe_str(retMsg)))
-
-        n = 0
-        if len(retMsg) > 0:
-            n = int(retMsg)
-
-        #wirelog.debug("reply len: %d" % n)
-        i = 0
-        while i < n:
-            #wirelog.debug (" i=%d n=%d " % (i,n))
-            r = self.recv_all(s, n - i)
-            reply += r.decode('utf-8')
-            i +=  len(r)
-            #wirelog.debug("total read = %d" % i)
-
-        #wirelog.debug('read  <- %s' % safe_str(reply[:80]))
-        return reply.split(protocol.separator)
+        return self.reader.read(s)
 
     def recv_all(self, socket, bytes):
         """Receive an exact number of bytes.
@@ -1185,35 +1792,20 @@ class Connection(object):
         dependning on what's in the OS buffer.  MSG_WAITALL is not available
         on all platforms, but this should work everywhere.  This will return
         less than the requested amount if the remote end closes.
-    
-        This isn't optimized and is intended mostly for use in testing.
-        """
-        b = ''
-        while len(b) < bytes:
-            left = bytes - len(b)
-            new = socket.recv(left)
-#            try:
-#                new = socket.recv(left)
-#            except Exception, e:
-#                if str(e) == "(9, 'Bad file descriptor')" or str(e) == "(10054, 'Connection reset by peer')":
-#                    log.warn('Lost connection resetting')
-#                    try:
-#                        self.close()
-#                    except Exception, e:
-#                        log.exception('noclose')
-#                    self.db_init()
-#                    return b
-#                raise
-            if new == '':
-                break # eof
-            b += new
-        return b
+        """
+        return self.reader.recv(socket, bytes)
     
     def _sendMsg(self, s, req):
-        msg = self._buildMsg(req)
+        self._sendMsgs(s, [req])
+
+    def _sendMsgs(self, s, reqs):
+        """
+        Send one or more requests in a single write without waiting for any replies.
+        """
+        msg = ''.join(map(self._buildMsg, reqs))
         wirelog.debug('write -> %s' % safe_str(msg[:80]))
         try:
-            s.send(msg)
+            s.sendall(msg)
         except Exception, e:
             if str(e) == "(10053, 'Software caused connection abort')" or str(e) == "[Errno 10053] An established connection was aborted by the software in your host machine":
                 log.warn('Lost connection resetting')
@@ -1229,6 +1821,13 @@ class Connection(object):
         self._sendMsg(s, msg)
         reply = self._readMsg(s)
         return reply
+
+    def _streamRequest(self, s, msg):
+        """
+        @return: generator of reply fields which are decoded as they arrive
+        """
+        self._sendMsg(s, msg)
+        return self.reader.iterFields(s)
         
     def _isOk(self, msg):
         """
@@ -1248,19 +1847,14 @@ class EventConnection(Connection):
         Connection.__init__(self, *args, **kwargs)
 
     def connect(self):
+        s = self._connectAndNegotiate(self.master)
+        self.annEvent(s)
+        return s
+
+    def _openSocket(self, backend):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.settimeout(None)
-        s.connect((self.master.ipAddress, self.master.port))
-        if not protocol.serverVersion:
-            protocol.serverVersion = self.getServerVersion()
-        
-        try:
-            self.protocol = protocol.protocols[protocol.serverVersion]
-        except KeyError:
-            raise ProtocolException('Unsupported protocol: %s' % protocol.serverVersion)
-
-        self.negotiateProtocol(s, protocol.serverVersion, self.protocol.protocolToken())
-        self.annEvent(s)
+        s.connect((backend.ipAddress, backend.port))
         return s
 
     def readEvent(self):
@@ -1290,6 +1884,9 @@ class OfflineConnection(Connection):
     def getServerVersion(self):
         return 65
 
+    def isAlive(self):
+        return True
+    
     def close(self):
         pass
     
@@ -1299,10 +1896,64 @@ class OfflineConnection(Connection):
     def getAllRecordings(self):
         return []
 
+    def iterAllRecordings(self):
+        return iter([])
+    
     def getUpcomingRecordings(self, filter=Upcoming.SCHEDULED):
         return []
+
+    def iterUpcomingRecordings(self, filter=Upcoming.SCHEDULED):
+        return iter([])
     
 
+def closeSlaveSocket(s):
+    try:
+        s.sendall('%-8d%s' % (len('DONE'), 'DONE'))
+        s.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    s.close()
+
+
+class SlaveSocketFactory(pool.PoolableFactory):
+    """
+    Creates command sockets announced for Playback to a slave backend so the handshake
+    is paid once per pooled socket instead of once per request. 
+    """
+    
+    def __init__(self, ipAddress):
+        self.ipAddress = ipAddress
+        
+    def create(self):
+        # do the handshake with the Connection this thread already has if any. Checking 
+        # out a second one could wait forever on a full connPool.
+        conn = getattr(connLocal, 'conn', None)
+        if conn is not None:
+            return conn.connect(announce='Playback', slaveBackend=self.ipAddress)
+        connPool = pool.pools['connPool']
+        conn = connPool.checkout()
+        try:
+            return conn.connect(announce='Playback', slaveBackend=self.ipAddress)
+        finally:
+            connPool.checkin(conn)
+    
+    def destroy(self, s):
+        closeSlaveSocket(s)
+
+    def validate(self, s):
+        # an idle socket with something to read has been closed by the backend
+        return not select.select([s], [], [], 0)[0]
+
+
+def createSlavePool(maxIdleSecs=60):
+    """
+    @return: pool of command sockets to slave backends keyed by ip address. Sockets idle 
+             for more than maxIdleSecs are closed.
+    @rtype: KeyedPool
+    """
+    return pool.KeyedPool(lambda ipAddress: pool.EvictingPool(SlaveSocketFactory(ipAddress), maxAgeSecs=maxIdleSecs, reapEverySecs=10, validateAfterSecs=0))
+
+
 class ConnectionFactory(pool.PoolableFactory):
     
     def __init__(self, *args, **kwargs):
@@ -1323,3 +1974,6 @@ class ConnectionFactory(pool.PoolableFactory):
         conn.close()
         del conn
 
+    def validate(self, conn):
+        return conn.isAlive()
+
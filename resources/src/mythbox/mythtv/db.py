@@ -20,13 +20,20 @@ import datetime
 import logging
 import mysql.connector as MySQLdb # pure python mysql client
 import odict
+import os
+import pickle
+import re
 import string
+import thread
+import threading
+import time
 
-from mythbox.mythtv.enums import RecordingStatus, JobType
+from mythbox.mythtv.enums import RecordingStatus, JobType, MarkType
 from decorator import decorator
 from mythbox import pool
+from mythbox.bus import Event
 from mythbox.pool import PoolableFactory
-from mythbox.util import timed, threadlocals, safe_str
+from mythbox.util import timed, safe_str, sync_instance
 from mysql.connector import errors
         
 log = logging.getLogger('mythbox.core')
@@ -51,6 +58,428 @@ def quote(someValue):
         return "'" + str(someValue) + "'"
 
 
+class Statement(object):
+    """
+    Named sql statement with pyformat placeholders. Ex: %(chanId)s
+
+    Values are converted, escaped, and quoted by the connector when the statement
+    is executed instead of being formatted into the sql by hand. A list or tuple
+    binds as a comma separated list of values for use in an 'in (...)' clause.
+    Execution counts and timings are kept across all connections.
+    """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.count = 0
+        self.totalSecs = 0.0
+        self.maxSecs = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, secs):
+        self._lock.acquire()
+        try:
+            self.count += 1
+            self.totalSecs += secs
+            self.maxSecs = max(self.maxSecs, secs)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        @return: count, totalSecs, avgSecs, and maxSecs of executions so far
+        @rtype: dict
+        """
+        return {
+            'count'     : self.count,
+            'totalSecs' : self.totalSecs,
+            'avgSecs'   : self.totalSecs / max(self.count, 1),
+            'maxSecs'   : self.maxSecs}
+
+    def __repr__(self):
+        return 'Statement(%s)' % self.name
+
+
+# Statement by name
+statements = odict.odict()
+
+
+def statement(name, sql):
+    """
+    @return: Statement registered under name
+    @rtype: Statement
+    """
+    s = statements[name] = Statement(name, sql)
+    return s
+
+
+def columnIndex(cursor):
+    """
+    @return: column name -> position in the rows of the statement last executed on cursor
+    @rtype: dict(str, int)
+    """
+    return dict([(field[0], i) for i, field in enumerate(cursor.description)])
+
+
+def queryStats():
+    """
+    @return: stats of each statement executed at least once by name
+    @rtype: dict(str, dict)
+    """
+    return dict([(name, s.stats()) for name, s in statements.items() if s.count])
+
+
+class PreparedStatement(object):
+    """
+    Statement readied for execution on a specific connection.
+
+    The connector doesn't support server side prepared statements so the sql is
+    encoded and split into literal fragments and parameter names once per
+    connection. Executing only has to convert the values and splice them in.
+    """
+
+    placeholder = re.compile(r'%\((\w+)\)s')
+
+    def __init__(self, conn, statement):
+        self.conn = conn
+        self.statement = statement
+        sql = statement.sql
+        if isinstance(sql, unicode):
+            sql = sql.encode(conn.charset)
+        parts = self.placeholder.split(sql)
+        self.fragments = [f.replace('%%', '%') for f in parts[0::2]]
+        self.names = parts[1::2]
+
+    def bind(self, params):
+        """
+        @return: sql with params spliced in
+        @rtype: str
+        @raise KeyError: if a parameter of the statement is missing from params
+        """
+        sql = [self.fragments[0]]
+        for name, fragment in zip(self.names, self.fragments[1:]):
+            sql.append(self.literal(params[name]))
+            sql.append(fragment)
+        return ''.join(sql)
+
+    def literal(self, value):
+        if isinstance(value, (list, tuple)):
+            if not value:
+                return 'NULL'  # 'in ()' is a syntax error
+            return ','.join(map(self.literal, value))
+        converter = self.conn.converter
+        return converter.quote(converter.escape(converter.to_mysql(value)))
+
+    def execute(self, cursor, params):
+        """
+        @return: all rows returned by the statement. Empty for statements other than selects.
+        @rtype: tuple[]
+        """
+        start = time.time()
+        try:
+            cursor.execute(self.bind(params))
+            if cursor.with_rows:
+                return cursor.fetchall()
+            return []
+        finally:
+            self.statement.record(time.time() - start)
+
+    def stream(self, cursor, params):
+        """
+        Generator of the rows returned by a select statement read off the unbuffered 
+        cursor one at a time so they can be consumed while the rest are still arriving. 
+        Rows left unread when the consumer stops early are drained so the connection can
+        run the next statement. The execution is recorded once all rows have been read.
+        """
+        start = time.time()
+        try:
+            cursor.execute(self.bind(params))
+            for row in cursor:
+                yield row
+        finally:
+            if cursor.with_rows and cursor._have_unread_result():
+                cursor.fetchall()
+            self.statement.record(time.time() - start)
+
+
+def toFramerate(fpsActual, fpsDuration):
+    """
+    @param fpsActual: last seek mark / program length in secs
+    @param fpsDuration: last seek mark / recording length in secs
+    @return: fps as a float or defaults to 29.97 if problems occur
+    """
+    fps = float(29.97)
+    try:
+        log.debug('FPS actual   %s' % fpsActual)
+        log.debug('FPS duration %s' % fpsDuration)
+        
+        holder = float(fpsDuration)
+        if holder is not None and holder > 0:
+            fps = holder
+        else:
+            fps = float(fpsActual)
+    except TypeError, te:
+        log.warn('Decimal to float conversion failed for "%s" with error %s. Returning default of 29.97' % (fps, safe_str(te)))
+    
+    # since we're deriving an approximation from the recordedseek table, just fudge to the
+    # most obvious correct values
+    if fps >= 28.0 and fps <= 32.0:
+        fps = float(29.97)
+    elif fps >= 57.0 and fps <= 62.0:
+        fps = float(59.94)
+    elif fps >= 22.0 and fps <= 26.0:
+        fps = float(24.0)
+    return fps
+
+
+def recordingKey(program):
+    """
+    @return: (chanid, starttime) of program's row in the recorded table. Unlike 
+             recstarttimeAsTime() the seconds are kept so recordings which differ only 
+             in seconds aren't confused.
+    @rtype: (int, datetime.datetime)
+    """
+    return (program.getChannelId(), datetime.datetime.fromtimestamp(program.recstarttimets()))
+
+
+class FramerateCache(object):
+    """
+    Process-wide cache of the framerate of finished recordings keyed by (chanid, starttime).
+    Persisted in the cache dir since deriving a framerate from recordedseek is expensive 
+    and it doesn't change once a recording has finished. Recordings without a seek table 
+    aren't cached since one may still be built for them.
+    """
+
+    lock = threading.RLock()
+    filename = 'framerates.pickle'
+    path = None       # file framerates were loaded from
+    framerates = {}   # {(chanid, starttime): fps}
+    unresolved = {}   # {(chanid, starttime): time.time()} of recordings last found without a seek table
+    retryAfterSecs = 10 * 60
+
+    key = staticmethod(recordingKey)
+
+    @classmethod
+    def get(cls, platform, program):
+        """
+        @return: cached fps of program or None if not cached
+        @rtype: float
+        """
+        cls.lock.acquire()
+        try:
+            return cls._load(platform).get(cls.key(program))
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def put(cls, platform, program, fps):
+        cls.lock.acquire()
+        try:
+            cls._load(platform)[cls.key(program)] = fps
+            cls._save()
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def resolve(cls, platform, db, programs):
+        """
+        Cache the framerates of all finished recordings in programs that aren't cached yet
+        with a single query. Recordings without seek marks aren't looked up again for 
+        retryAfterSecs. Entries for recordings no longer in programs are dropped.
+
+        @param programs: all recordings
+        @type programs: RecordedProgram[]
+        @return: number of framerates added to the cache
+        @rtype: int
+        """
+        finished = [cls.key(p) for p in programs if p.getRecordingStatus() == RecordingStatus.RECORDED]
+        now = time.time()
+        cls.lock.acquire()
+        try:
+            framerates = cls._load(platform)
+            missing = [key for key in finished if key not in framerates and now - cls.unresolved.get(key, 0) > cls.retryAfterSecs]
+        finally:
+            cls.lock.release()
+        if not missing:
+            return 0
+        
+        resolved = db.getFramerates()
+        
+        cls.lock.acquire()
+        try:
+            framerates = cls._load(platform)
+            keep = set(finished)
+            for key in framerates.keys():
+                if key not in keep:
+                    del framerates[key]
+            added = 0
+            for key in missing:
+                if key in resolved:
+                    framerates[key] = resolved[key]
+                    cls.unresolved.pop(key, None)
+                    added += 1
+                else:
+                    cls.unresolved[key] = now
+            cls._save()
+            return added
+        finally:
+            cls.lock.release()
+
+    @classmethod
+    def _load(cls, platform):
+        try:
+            path = os.path.join(platform.getCacheDir(), cls.filename)
+        except Exception:
+            path = None   # nowhere to persist to - cache for the life of the process only
+        if path != cls.path:
+            cls.path = path
+            cls.framerates = {}
+            cls.unresolved = {}
+            try:
+                if path and os.path.exists(path):
+                    f = open(path, 'rb')
+                    try:
+                        cls.framerates = pickle.load(f)
+                    finally:
+                        f.close()
+            except Exception:
+                log.exception('Loading framerates from %s' % path)
+        return cls.framerates
+
+    @classmethod
+    def _save(cls):
+        if not cls.path:
+            return
+        try:
+            f = open(cls.path, 'wb')
+            try:
+                pickle.dump(cls.framerates, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except Exception:
+            log.exception('Error saving framerates to %s' % cls.path)
+
+
+class SettingsSnapshot(object):
+    """
+    In-memory copy of the global rows of the settings table plus the rows of every
+    backend host, shared by all MythDatabase connections. Loaded in a single query
+    on first use and again once it is older than ttlSecs or has been invalidated
+    by a settings change.
+    """
+
+    def __init__(self, ttlSecs=60):
+        self.ttlSecs = ttlSecs
+        self.loadedAt = None
+        self.globals = {}  # data by value for rows w/o a hostname
+        self.hosts = {}    # data by value by hostname
+
+    def isStale(self):
+        return self.loadedAt is None or time.time() - self.loadedAt > self.ttlSecs
+
+    @sync_instance
+    def invalidate(self):
+        self.loadedAt = None
+
+    @sync_instance
+    def refresh(self, db):
+        """Reload from the settings table if stale"""
+        if not self.isStale():
+            return
+        globals, hosts = {}, {}
+        for value, data, hostname in db.loadSettings():
+            if hostname is None:
+                globals[value] = data
+            else:
+                hosts.setdefault(hostname, {})[value] = data
+        self.globals, self.hosts = globals, hosts
+        self.loadedAt = time.time()
+        log.debug('Loaded %d global settings and settings of hosts %s' % (len(globals), hosts.keys()))
+
+    def hasHost(self, hostname):
+        return hostname in self.hosts
+
+    def get(self, key, hostname=None):
+        """
+        @return: setting of the given host. Without a hostname, the global setting 
+                 or else the setting of any host which has it. None if not found.
+        """
+        if hostname:
+            return self.hosts.get(hostname, {}).get(key)
+        if key in self.globals:
+            return self.globals[key]
+        for settings in self.hosts.values():
+            if key in settings:
+                return settings[key]
+        return None
+
+    def byHost(self, key):
+        """
+        @return: setting of every host which has it
+        @rtype: dict(hostname, data)
+        """
+        return dict([(hostname, settings[key]) for hostname, settings in self.hosts.items() if key in settings])
+
+    def onEvent(self, event):
+        if event['id'] == Event.MYTH_SETTINGS_CHANGED or \
+           (event['id'] == Event.SETTING_CHANGED and event['tag'].startswith('mysql_')):
+            self.invalidate()
+
+
+# Shared by every MythDatabase. Registered with the event bus by HomeWindow.
+settingsSnapshot = SettingsSnapshot()
+
+
+class MarkupCache(object):
+    """
+    Commercial break marks of every recording loaded from the recordedmarkup table in a
+    single query instead of a backend round trip per recording. Loaded in the background
+    by the recordings window and dropped when the backend starts or updates commercial
+    flagging. Lookups never wait on the database.
+    
+    Bookmarks aren't cached since any frontend can move them at any time.
+    """
+
+    def __init__(self):
+        self.marks = None  # {(chanid, starttime): [(type, frame)]} in frame order
+
+    key = staticmethod(recordingKey)
+
+    @sync_instance
+    def load(self, db):
+        """
+        @return: marks of all recordings, loaded if not already
+        @rtype: dict((chanid, starttime), (type, frame)[])
+        """
+        if self.marks is None:
+            self.marks = db.getRecordedMarkup()
+            log.debug('Loaded markup of %d recordings' % len(self.marks))
+        return self.marks
+
+    def get(self, program):
+        """
+        @return: COMM_START and COMM_END marks of program in frame order or None if the 
+                 cache isn't loaded or the recording has no commercial break marks
+        @rtype: (type, frame)[]
+        """
+        allMarks = self.marks  # read once - may be invalidated by another thread
+        if allMarks is None:
+            return None
+        return allMarks.get(self.key(program))
+
+    @sync_instance
+    def invalidate(self):
+        self.marks = None
+
+    def onEvent(self, event):
+        if event['id'] in (Event.COMMFLAG_START, Event.COMMFLAG_UPDATE):
+            self.invalidate()
+
+
+# Shared by every recording. Registered with the event bus by HomeWindow.
+markupCache = MarkupCache()
+
+
 class MythDatabaseFactory(PoolableFactory):
     
     def __init__(self, *args, **kwargs):
@@ -70,6 +499,18 @@ class MythDatabaseFactory(PoolableFactory):
         db.close()
         del db
 
+    def validate(self, db):
+        return db.isAlive()
+
+
+# MythDatabase checked out by the outermost @inject_db call on the current thread
+dbLocal = threading.local()
+
+
+def currentDb():
+    """Bolted on to objects as self.db() by @inject_db"""
+    return dbLocal.db
+
 
 @decorator
 def inject_db(func, *args, **kwargs):
@@ -78,69 +519,43 @@ def inject_db(func, *args, **kwargs):
 
     To use:
           1. Decorate method with @inject_db
-          2. Within method, use self.db() to obtain a reference to the database."""
+          2. Within method, use self.db() to obtain a reference to the database.
+          
+    Only the outermost decorated call on a thread checks a MythDatabase out of 
+    the pool. Nested calls just use it so they cost next to nothing."""
     self = args[0]
-    result = None
     
     # bypass injection if dependency passed in via constructor
-    if hasattr(self, '_db') and self._db:
+    if getattr(self, '_db', None):
         return func(*args, **kwargs)
 
-    dbPool = pool.pools['dbPool']
-    
-    # Create thread local storage if not already allocated
-    import thread
-    tlsKey = thread.get_ident()
-    try:
-        threadlocals[tlsKey]
-        ilog.debug('threading.local() already allocated')
-    except KeyError:
-        import threading
-        threadlocals[tlsKey] = threading.local()
-        ilog.debug('Allocating threading.local() to thread %d'  % tlsKey)
-
-    # Bolt-on getter method so client can access db.
-    def db_accessor():
-        return threadlocals[thread.get_ident()].db 
-    self.db = db_accessor  
-
-    # Only acquire resource once per thread
-    try:
-        if threadlocals[tlsKey].db == None:
-            raise AttributeError # force allocation
-        alreadyAcquired = True; 
-        ilog.debug('Skipping acquire resource')
-    except AttributeError:
-        alreadyAcquired = False
-        ilog.debug('Going to acquire resource')
+    if getattr(self, 'db', None) is not currentDb:
+        self.db = currentDb
 
+    if getattr(dbLocal, 'db', None) is not None:
+        return func(*args, **kwargs)
+
+    dbPool = pool.pools['dbPool']
+    db = dbLocal.db = dbPool.checkout()
+    if ilog.isEnabledFor(logging.DEBUG):
+        ilog.debug('--> injected db %s into thread %s' % (db, thread.get_ident()))
     try:
-        if not alreadyAcquired:
-            # store db in thread local storage
-            threadlocals[tlsKey].db = dbPool.checkout()
-            threadlocals[tlsKey].discarded = False
-            ilog.debug('--> injected db %s into %s' % (threadlocals[tlsKey].db, threadlocals[tlsKey]))
-        
         # TODO: Recover from broken pipe (for example, after suspend/resume cycle)
         #       File "mysql-connector-python/mysql/connector/connection.py", line 71, in send
         #           raise errors.OperationalError('%s' % e)
         #           OperationalError: (32, 'Broken pipe')
         #    InterfaceError: 2013: Lost connection to MySQL server during query         
-
         try:
-            result = func(*args, **kwargs)
+            return func(*args, **kwargs)
         except errors.InterfaceError, ie:
             log.error(str(ie))
             log.error('\n\n\t\tDiscarding stale db conn...\n\n')
-            dbPool.discard(threadlocals[tlsKey].db)
-            threadlocals[tlsKey].discarded = True
-            
+            dbPool.discard(db)
+            db = None
     finally:
-        if not alreadyAcquired and not threadlocals[tlsKey].discarded:
-            ilog.debug('--> removed db %s from %s' % (threadlocals[tlsKey].db, threadlocals[tlsKey]))
-            dbPool.checkin(threadlocals[tlsKey].db)
-            threadlocals[tlsKey].db = None
-    return result
+        if db is not None:
+            dbPool.checkin(db)
+        dbLocal.db = None
 
 
 @decorator
@@ -162,6 +577,7 @@ class MythDatabase(object):
         # Static data cached on demand
         self._master = None
         self._slaves = None
+        self._prepared = {}  # PreparedStatement by statement name for self.conn
         self.initWithSettings(*args)
 
     def initWithSettings(self, settings, translator=None, domainCache=None):
@@ -192,12 +608,73 @@ class MythDatabase(object):
             return rowDict
         else:
             raise Exception, 'Unknown row type: %s' % type(row)
+
+    @staticmethod
+    def toRecords(cursor, rows):
+        """
+        Wrap rows in Records that share a single column name -> index map instead
+        of building a dict per row.
+
+        @rtype: Record[]
+        """
+        from mythbox.mythtv.domain import Record
+        index = columnIndex(cursor)
+        return [Record(index, row) for row in rows]
+        
+    def isAlive(self):
+        """
+        @return: True if the MySQL server still answers a ping on this connection, False otherwise
+        """
+        try:
+            return self.conn.is_connected()
+        except Exception, e:
+            log.debug('MySQL connection is dead: %s' % e)
+            return False
         
     def close(self):
         if self.conn:
             log.debug('Closing myth db connection')
             self.conn.close()
             del self.conn
+        self._prepared = {}
+
+    def prepare(self, statement):
+        """
+        @return: statement readied for this connection. Cached for the life of the connection.
+        @rtype: PreparedStatement
+        """
+        try:
+            return self._prepared[statement.name]
+        except KeyError:
+            prepared = self._prepared[statement.name] = PreparedStatement(self.conn, statement)
+            return prepared
+
+    def query(self, statement, **params):
+        """
+        Execute a statement on self.cursor.
+
+        @return: rows returned by the statement
+        @rtype: tuple[]
+        """
+        return self.prepare(statement).execute(self.cursor, params)
+
+    def streamRecords(self, statement, **params):
+        """
+        Execute a select statement on self.cursor and stream the rows back as Records
+        sharing one column index.
+
+        @rtype: generator of Record
+        """
+        from mythbox.mythtv.domain import Record
+        index = None
+        rows = self.prepare(statement).stream(self.cursor, params)
+        try:
+            for row in rows:
+                if index is None:
+                    index = columnIndex(self.cursor)
+                yield Record(index, row)
+        finally:
+            rows.close()
 
     def getBackends(self):
         backends = [self.getMasterBackend()]
@@ -212,57 +689,26 @@ class MythDatabase(object):
         log.warn('Host %s could not be mapped to a backend. Returning master backend %s instead.' % (hostnameOrIpAddress, master.hostname))
         return master
             
-    @inject_cursor
     def getMasterBackend(self):
         if not self._master:
-            sql = """
-                select 
-                    a.data as ipaddr,
-                    b.data as port,
-                    c.hostname as hostname
-                from 
-                    settings a, 
-                    settings b,
-                    settings c
-                where 
-                    a.value = 'MasterServerIP' and
-                    b.value = 'MasterServerPort' and
-                    c.value = 'BackendServerIP' and
-                    c.data  = a.data
-                """
-                    
-            self.cursor.execute(sql)
-            rows = map(lambda r: self.toDict(self.cursor, r), self.cursor.fetchall())
+            settings = self.settingsSnapshot()
+            ipaddr = settings.get('MasterServerIP')
             from mythbox.mythtv.domain import Backend
-            for row in rows:
-                self._master = Backend(row['hostname'], row['ipaddr'], row['port'],  True)
+            for hostname, data in settings.byHost('BackendServerIP').items():
+                if data == ipaddr:
+                    self._master = Backend(hostname, ipaddr, settings.get('MasterServerPort'), True)
         return self._master
     
-    @inject_cursor
     def getSlaveBackends(self):
         if self._slaves is None:
-            sql = """
-                select  
-                    a.data as ipaddr,  
-                    a.hostname as hostname,
-                    b.data as port
-                from 
-                    settings a,
-                    settings b,
-                    settings c
-                where 
-                    a.value = 'BackendServerIP' and
-                    b.value = 'BackendServerPort' and
-                    a.hostname = b.hostname and
-                    c.data != a.data and
-                    c.value = 'MasterServerIP'        
-                """
-            self.cursor.execute(sql)
-            rows = map(lambda r: self.toDict(self.cursor, r), self.cursor.fetchall())
+            settings = self.settingsSnapshot()
+            masterIp = settings.get('MasterServerIP')
+            ports = settings.byHost('BackendServerPort')
             from mythbox.mythtv.domain import Backend
             self._slaves = []
-            for row in rows:
-                self._slaves.append(Backend(row['hostname'], row['ipaddr'], row['port'],  False))
+            for hostname, ipaddr in sorted(settings.byHost('BackendServerIP').items()):
+                if ipaddr != masterIp and hostname in ports:
+                    self._slaves.append(Backend(hostname, ipaddr, ports[hostname], False))
         return self._slaves
         
     @timed
@@ -292,10 +738,8 @@ class MythDatabase(object):
                 ch.chanid
             """
         self.cursor.execute(sql)
-        rows = map(lambda r: self.toDict(self.cursor, r), self.cursor.fetchall())
         from mythbox.mythtv.domain import Channel
-        channels = map(lambda rd: Channel(rd), rows)
-        return channels
+        return [Channel(record) for record in self.toRecords(self.cursor, self.cursor.fetchall())]
 
     @inject_cursor
     def getRecordingProfileNames(self):
@@ -382,11 +826,7 @@ class MythDatabase(object):
         titlegroups[0][1] = grpcnt
         return titlegroups
 
-    @inject_cursor
-    def getFramerate(self, recording):
-        '''Returns fps as a float or defaults to 29.97 if problems occur'''
-
-        sql = '''        
+    framerateSql = statement('getFramerate', '''
             select 
                 rs.mark/time_to_sec(timediff(r.progend,r.progstart)) as fps_actual,
                 rs.mark/time_to_sec(timediff(r.endtime,r.starttime)) as fps_duration
@@ -394,38 +834,79 @@ class MythDatabase(object):
                 recorded r, 
                 recordedseek rs
             where
-                r.chanid = %d 
-            and r.starttime={ts '%s'}
+                r.chanid = %(chanId)s
+            and r.starttime = %(startTime)s
             and r.chanid = rs.chanid
             and r.starttime = rs.starttime
             order by rs.mark desc
             limit 1 
-            ''' % (recording.getChannelId(), recording.starttimeAsTime())       
-        fps = float(29.97)
-        self.cursor.execute(sql)
-        for row in self.cursor.fetchall():
-            row = self.toDict(self.cursor, row)
-            try:
-                log.debug('FPS actual   %s' % row['fps_actual'])
-                log.debug('FPS duration %s' % row['fps_duration'])
-                
-                holder = float(row['fps_duration'])
-                if holder is not None and holder > 0:
-                    fps = holder
-                else:
-                    fps = float(row['fps_actual'])
-            except TypeError, te:
-                log.warn('Decimal to float conversion failed for "%s" with error %s. Returning default of 29.97' % (fps, safe_str(te)))
-        
-        # since we're deriving an approximation from the recordedseek table, just fudge to the
-        # most obvious correct values
-        if fps >= 28.0 and fps <= 32.0:
-            fps = float(29.97)
-        elif fps >= 57.0 and fps <= 62.0:
-            fps = float(59.94)
-        elif fps >= 22.0 and fps <= 26.0:
-            fps = float(24.0)
+            ''')
+
+    def getFramerate(self, recording):
+        '''Returns fps as a float or defaults to 29.97 if problems occur'''
+        fps = self.findFramerate(recording)
+        if fps is None:
+            return toFramerate(None, None)
         return fps
+
+    @inject_cursor
+    def findFramerate(self, recording):
+        """
+        @return: fps as a float or None if the recording doesn't have a seek table (yet)
+        """
+        for fpsActual, fpsDuration in self.query(self.framerateSql, chanId=recording.getChannelId(), startTime=recording.starttimeAsTime()):
+            return toFramerate(fpsActual, fpsDuration)
+        return None
+
+    frameratesSql = statement('getFramerates', '''
+            select 
+                r.chanid,
+                r.starttime,
+                rs.mark/time_to_sec(timediff(r.progend,r.progstart)) as fps_actual,
+                rs.mark/time_to_sec(timediff(r.endtime,r.starttime)) as fps_duration
+            from 
+                recorded r, 
+                (select chanid, starttime, max(mark) as mark from recordedseek group by chanid, starttime) rs
+            where
+                r.chanid = rs.chanid
+            and r.starttime = rs.starttime
+            ''')
+
+    @timed
+    @inject_cursor
+    def getFramerates(self):
+        """
+        Same as getFramerate(..) for every recording with a seek table in a single grouped query.
+        
+        @rtype: dict((chanid, starttime), float)
+        """
+        return dict([((int(chanId), startTime), toFramerate(fpsActual, fpsDuration)) 
+                     for chanId, startTime, fpsActual, fpsDuration in self.query(self.frameratesSql)])
+
+    recordedMarkupSql = statement('getRecordedMarkup', """
+            select chanid, starttime, type, mark 
+            from   recordedmarkup 
+            where  type in (%(types)s) 
+            order by chanid, starttime, mark
+            """)
+
+    @timed
+    @inject_cursor
+    def getRecordedMarkup(self):
+        """
+        @return: Commercial break marks of every recording in frame order
+        @rtype: dict((chanid, starttime), (type, frame)[])
+        """
+        types = [MarkType.COMM_START, MarkType.COMM_END]
+        markup = {}
+        key, marks = None, None
+        for chanId, startTime, markType, frame in self.prepare(self.recordedMarkupSql).stream(self.cursor, {'types': types}):
+            # rows come grouped by recording so only look up the list when the recording changes
+            if key is None or key[0] != chanId or key[1] != startTime:
+                key = (chanId, startTime)
+                marks = markup.setdefault((int(chanId), startTime), [])
+            marks.append((int(markType), long(frame)))
+        return markup
     
     @timed
     @inject_cursor
@@ -465,19 +946,7 @@ class MythDatabase(object):
                 translator=self.translator)) 
         return tuners
 
-    @timed
-    @inject_cursor
-    def getTVGuideData(self, startTime, endTime, channels):
-        """
-        @type startTime: datetime.datetime 
-        @type endTime: datetime.datetime
-        @type channels: Channel[] 
-        @rtype: dict(Channel, TVProgram[])
-        """
-        strStartTime = startTime.strftime("%Y%m%d%H%M%S")
-        strEndTime = endTime.strftime("%Y%m%d%H%M%S")
-
-        sql = """
+    tvGuideSql = statement('getTVGuideData', """
             select
                 c.chanid,
                 c.channum,
@@ -500,42 +969,49 @@ class MythDatabase(object):
                 channel c, 
                 program p
             where c.visible = 1
-                and c.chanid in (%s)
+                and c.chanid in (%(chanIds)s)
                 and c.chanid = p.chanid
+                and p.starttime <  %(end)s
+                and p.endtime   >  %(start)s
                 and p.starttime != p.endtime
-                and 
-                (   
-                       (p.endtime   >  %s and p.endtime   <= %s) 
-                    or (p.starttime >= %s and p.starttime <  %s) 
-                    or (p.starttime <  %s and p.endtime   >  %s) 
-                    or (p.starttime =  %s and p.endtime   =  %s)
-                )
             order by 
                 c.chanid, 
                 p.starttime
-                """ % (','.join(map(lambda c: str(c.getChannelId()), channels)),
-                       strStartTime, strEndTime,
-                       strStartTime, strEndTime,
-                       strStartTime, strEndTime,
-                       strStartTime, strEndTime)
-        shows = []
-        self.cursor.execute(sql)
-        from mythbox.mythtv.domain import TVProgram
-        for row in self.cursor.fetchall():
-            shows.append(TVProgram(self.toDict(self.cursor, row), self.translator))
+                """)
 
-        channelById = odict.odict()  # dict(int, Channel)
-        showsByChannel = {}          # dict(Channel, TVProgram[])
+    @timed
+    @inject_cursor
+    def getTVGuideData(self, startTime, endTime, channels):
+        """
+        @type startTime: datetime.datetime 
+        @type endTime: datetime.datetime
+        @type channels: Channel[] 
+        @rtype: dict(Channel, TVProgram[])
+        @note: Programs overlapping [startTime, endTime) are returned. Zero length programs are skipped.
+        """
+        channelById = {}     # dict(int, Channel)
+        showsByChannel = {}  # dict(Channel, TVProgram[])
         for c in channels:
             channelById[c.getChannelId()] = c
             showsByChannel[c] = []
-                    
-        for s in shows:
-            showsByChannel[channelById[s.getChannelId()]].append(s)
-            
-        for shows in showsByChannel.values():
-            shows.sort(key=lambda x: x.starttimeAsTime())
-            
+
+        # served from the local guide mirror when it is enabled and up to date
+        from mythbox.mythtv import mirror
+        if mirror.guideMirror and mirror.guideMirror.covers(self, startTime, endTime):
+            records = mirror.guideMirror.getTVGuideRecords(startTime, endTime, channelById.keys())
+        else:
+            records = self.streamRecords(self.tvGuideSql, chanIds=channelById.keys(), start=startTime, end=endTime)
+
+        # rows arrive ordered by chanid, starttime so each channel's programs are 
+        # contiguous and already in date order
+        from mythbox.mythtv.domain import TVProgram
+        currentChanId, shows = None, None
+        for record in records:
+            chanId = record['chanid']
+            if chanId != currentChanId:
+                currentChanId = chanId
+                shows = showsByChannel[channelById[int(chanId)]]
+            shows.append(TVProgram(record, self.translator))
         return showsByChannel
         
     def getTVGuideDataFlattened(self, startTime, endTime, channels):
@@ -546,31 +1022,108 @@ class MythDatabase(object):
             flattened.extend(showsByChannel[channel])
         return flattened
         
+    guideChannelsSql = statement('getGuideChannels', """
+            select chanid, channum, callsign, icon, name, visible from channel
+            """)
+
+    @inject_cursor
+    def getGuideChannels(self):
+        """
+        @return: channel rows for the guide mirror
+        @rtype: (chanid, channum, callsign, icon, name, visible)[]
+        """
+        return self.query(self.guideChannelsSql)
+
+    guideChecksumsSql = statement('getGuideChecksums', """
+            select 
+                chanid, 
+                date(starttime) as day, 
+                count(*),
+                sum(crc32(concat_ws('|', starttime, endtime, title, subtitle, description, showtype, 
+                    originalairdate, category, category_type, seriesid, programid, hdtv)))
+            from   program
+            where  starttime >= %(start)s 
+               and starttime <  %(end)s
+            group by chanid, date(starttime)
+            """)
+
+    @timed
     @inject_cursor
+    def getGuideChecksums(self, startTime, endTime):
+        """
+        @return: number of programs and a checksum of their contents by channel and day 
+                 for programs starting in [startTime, endTime)
+        @rtype: dict((chanid, datetime.date), (count, checksum))
+        """
+        return dict([((int(chanId), day), (int(count), long(checksum))) 
+                     for chanId, day, count, checksum in self.query(self.guideChecksumsSql, start=startTime, end=endTime)])
+
+    guideProgramsSql = statement('getGuidePrograms', """
+            select 
+                chanid, starttime, endtime, title, subtitle, description, showtype, 
+                originalairdate, category, category_type, seriesid, programid, hdtv
+            from   program
+            where  chanid in (%(chanIds)s)
+               and starttime >= %(start)s 
+               and starttime <  %(end)s
+            """)
+
+    @timed
+    @inject_cursor
+    def getGuidePrograms(self, chanIds, startTime, endTime):
+        """
+        @return: program rows for the guide mirror of the given channels starting in [startTime, endTime)
+        @rtype: tuple[]
+        """
+        return self.query(self.guideProgramsSql, chanIds=chanIds, start=startTime, end=endTime)
+
+    mythSettingSql = statement('getMythSetting', """
+            select data from settings where value = %(key)s and (%(hostname)s is null or hostname = %(hostname)s)
+            """)
+
+    settingsSql = statement('loadSettings', """
+            select value, data, hostname from settings
+            where hostname is null
+               or hostname in (select hostname from settings where value = 'BackendServerIP')
+            """)
+
+    @inject_cursor
+    def loadSettings(self):
+        """
+        @return: rows for the settings snapshot
+        @rtype: (value, data, hostname)[]
+        """
+        return self.query(self.settingsSql)
+
+    def settingsSnapshot(self):
+        """
+        @return: shared snapshot of the settings table refreshed if stale
+        @rtype: SettingsSnapshot
+        """
+        settingsSnapshot.refresh(self)
+        return settingsSnapshot
+    
     def getMythSetting(self, key, hostname=None):
         """
         @rtype: str
         @return: Setting from the  SETTINGS table or None if not found
         """
-        sql = 'select data from settings where value = "%s" '% key
-        if hostname: 
-            sql += ' and hostname = "%s"' % hostname
-                   
-        result = None
-        self.cursor.execute(sql)
-        for row in self.cursor.fetchall():
-            row = self.toDict(self.cursor, row)
-            result = row['data']
-        return result
-        
-    @timed
+        settings = self.settingsSnapshot()
+        if hostname and not settings.hasHost(hostname):
+            return self.queryMythSetting(key, hostname)
+        return settings.get(key, hostname)
+
     @inject_cursor
-    def getRecordingSchedules(self, chanId='', scheduleId=-1):
+    def queryMythSetting(self, key, hostname):
         """
-        @return: All recording schedules unless a specific channel or schedule id is given.
-        @rtype: RecordingSchedule[]
+        @return: Setting of a host not covered by the settings snapshot or None if not found
         """
-        sql = """
+        result = None
+        for row in self.query(self.mythSettingSql, key=key, hostname=hostname):
+            result = row[0]
+        return result
+        
+    recordingSchedulesSql = statement('getRecordingSchedules', """
             SELECT
                 r.recordid,
                 r.type,
@@ -611,51 +1164,92 @@ class MythDatabase(object):
                 c.channum,
                 c.callsign,
                 c.name as channame,
-                c.icon,
-                (select count(*) from oldrecorded where oldrecorded.title=r.title and oldrecorded.recstatus = %d) as numRecorded
+                c.icon
             FROM
                 record r
             LEFT JOIN channel c ON r.chanid = c.chanid
-            """ % RecordingStatus.RECORDED
-    
-        if chanId != "":
-            sql += "WHERE r.chanid = '%s' "%chanId
-            
-        if scheduleId != -1:
-            if chanId == "":
-                sql+="WHERE "
-            else:
-                sql +="AND "
-            sql += "r.recordid = %d "%scheduleId
-            
-        sql += """
+            WHERE
+                (%(chanId)s is null or r.chanid = %(chanId)s)
+            AND (%(scheduleId)s is null or r.recordid = %(scheduleId)s)
             ORDER BY
                 r.recordid
                 DESC
-            """
-        schedules = []
-        self.cursor.execute(sql)
-        rows = self.cursor.fetchall()
+            """)
+
+    @timed
+    @inject_cursor
+    def getRecordingSchedules(self, chanId='', scheduleId=-1):
+        """
+        @return: All recording schedules unless a specific channel or schedule id is given.
+        @rtype: RecordingSchedule[]
+        @note: Schedules come back without the number of times they've been recorded. See getRecordedCounts()
+        """
+        rows = self.query(self.recordingSchedulesSql,
+            chanId=[chanId, None][chanId == ''],
+            scheduleId=[scheduleId, None][scheduleId == -1])
         from mythbox.mythtv.domain import RecordingSchedule
-        for row in rows:
-            row = self.toDict(self.cursor, row)
-            schedules.append(RecordingSchedule(row, self.translator))
-        return schedules
+        return [RecordingSchedule(record, self.translator) for record in self.toRecords(self.cursor, rows)]
+
+    recordedCountsSql = statement('getRecordedCounts', """
+            select title, count(*) from oldrecorded where recstatus = %(recorded)s group by title
+            """)
+
+    @timed
+    @inject_cursor
+    def getRecordedCounts(self):
+        """
+        @return: Number of times each title has been recorded, counted in a single pass over oldrecorded
+        @rtype: (title, int)[]
+        """
+        return [(title, int(count)) for title, count in self.query(self.recordedCountsSql, recorded=RecordingStatus.RECORDED)]
+
+    updateJobScheduledRunTimeSql = statement('updateJobScheduledRunTime', 
+        "update jobqueue set schedruntime = %(scheduledRunTime)s where id = %(jobId)s and starttime = %(startTime)s")
 
     @inject_cursor
     def updateJobScheduledRunTime(self, job):
-        sql = "update jobqueue set schedruntime = %(scheduledRunTime)s where id = %(jobId)s and starttime = %(startTime)s"
-        log.debug("sql = %s"%sql)
-        args = {
-            'scheduledRunTime': job.scheduledRunTime,
-            'jobId' : job.id,
-            'startTime' : job.startTime
-        }
-        self.cursor.execute(sql, args)
+        self.query(self.updateJobScheduledRunTimeSql, scheduledRunTime=job.scheduledRunTime, jobId=job.id, startTime=job.startTime)
         log.debug('Row count = %s' % self.cursor.rowcount)
 
+    def updateJobScheduledRunTimes(self, jobs):
+        """
+        Save the scheduled run time of many jobs with a single update statement so
+        the job queue is never seen partially reordered.
+
+        @type jobs: Job[]
+        """
+        if not jobs:
+            return
+        sql = 'update jobqueue set schedruntime = case id %s end where (id, starttime) in (%s)' % (
+            ' '.join(['when %s then %s'] * len(jobs)), ','.join(['(%s, %s)'] * len(jobs)))
+        args = []
+        for job in jobs:
+            args.extend((job.id, job.scheduledRunTime))
+        for job in jobs:
+            args.extend((job.id, job.startTime))
+        
+        c = self.conn.cursor(*cursorArgs)
+        try:
+            c.execute(sql, args)
+            log.debug('Rescheduled %d jobs. Row count = %s' % (len(jobs), c.rowcount))
+        finally:
+            c.close()
+
     def addJob(self, job):
         '''Add a new job to the job queue'''        
+        self.addJobs([job])
+
+    def addJobs(self, jobs):
+        """
+        Add new jobs to the job queue with a single multi-row insert. Jobs are
+        assigned the ids they were inserted with, read back by the unique key 
+        (chanid, starttime, type, inserttime) since ids of a multi-row insert are only
+        consecutive for some values of innodb_autoinc_lock_mode.
+
+        @type jobs: Job[]
+        """
+        if not jobs:
+            return
         sql = """INSERT INTO jobqueue (
                     chanid,
                     starttime,
@@ -665,10 +1259,16 @@ class MythDatabase(object):
                     status,
                     comment, 
                     schedruntime)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
+                VALUES %s""" % ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(jobs))
         
         log.debug("sql = %s" % safe_str(sql))
-        args = (job.channelId, job.startTime, job.jobType, job.insertTime, job.hostname, job.jobStatus, job.comment, datetime.datetime.now(),)
+        now = datetime.datetime.now()
+        args = []
+        for job in jobs:
+            if job.insertTime:
+                # mysql rounds fractional seconds when storing a datetime so drop them or the ids can't be read back
+                job.insertTime = job.insertTime.replace(microsecond=0)
+            args.extend((job.channelId, job.startTime, job.jobType, job.insertTime, job.hostname, job.jobStatus, job.comment, now,))
 
         if log.isEnabledFor(logging.DEBUG):
             for i,arg in enumerate(args):
@@ -677,17 +1277,25 @@ class MythDatabase(object):
         c = self.conn.cursor(*cursorArgs)       
         try:
             c.execute(sql, args)
+            # id of the first row of a multi-row insert. The rest are higher and in row order.
+            firstId = c.lastrowid
+            if len(jobs) == 1:
+                ids = [firstId]
+            else:
+                c.execute('select id from jobqueue where id >= %%s and (chanid, starttime, type, inserttime) in (%s) order by id' % (
+                    ','.join(['(%s, %s, %s, %s)'] * len(jobs))), 
+                    [firstId] + [arg for job in jobs for arg in (job.channelId, job.startTime, job.jobType, job.insertTime)])
+                ids = [row[0] for row in c.fetchall()]
         finally:
             c.close()
 
-        if job.id is None:
-            c2 = self.conn.cursor(*cursorArgs)
-            try:
-                c2.execute("select max(id) from jobqueue")
-                job.id = c2.fetchall()[0][0]
+        if len(ids) != len(jobs):
+            log.warn('Read back %d ids for %d new jobs. Job ids not assigned.' % (len(ids), len(jobs)))
+            return
+        for id, job in zip(ids, jobs):
+            if job.id is None:
+                job.id = id
                 log.debug('New job id = %s' % job.id)
-            finally:
-                c2.close()
  
     def getUserJobs(self):
         '''Returns max of 4 user jobs defined in the SETTING table'''
@@ -699,18 +1307,7 @@ class MythDatabase(object):
             userJobs.append(UserJob(jobType, self.getMythSetting(jobDesc), self.getMythSetting(jobCommand)))  
         return userJobs
     
-    @inject_cursor
-    def getJobs(self, program=None, jobType=None, jobStatus=None):
-        """
-        Get jobs from the MythTV job queue matching a program, job type, and/or job status in order of scheduled run time.
-        
-        @type program: RecordedProgram
-        @type jobType: int from enums.JobType
-        @type jobStatus: int from enums.JobStatus
-        @rtype: Job[]
-        """
-        
-        sql = """
+    jobsSql = statement('getJobs', """
             select
                 id, 
                 chanid, 
@@ -726,52 +1323,32 @@ class MythDatabase(object):
                 schedruntime 
             from   
                 jobqueue
-            """
+            where
+                (%(chanId)s is null or (chanid = %(chanId)s and starttime = %(startTime)s))
+            and (%(jobType)s is null or type = %(jobType)s)
+            and (%(jobStatus)s is null or status = %(jobStatus)s)
+            order by 
+                schedruntime, 
+                id
+            """)
+
+    @inject_cursor
+    def getJobs(self, program=None, jobType=None, jobStatus=None):
+        """
+        Get jobs from the MythTV job queue matching a program, job type, and/or job status in order of scheduled run time.
         
-        where = ''
+        @type program: RecordedProgram
+        @type jobType: int from enums.JobType
+        @type jobStatus: int from enums.JobStatus
+        @rtype: Job[]
+        """
+        chanId, startTime = None, None
         if program is not None:
-            where += "chanid = %s " % program.getChannelId()
-            where += "and "
-            where += "starttime = '%s' " % program.starttimeAsTime()
-            
-        if jobType is not None:
-            if program is not None:
-                where += " and "
-            where += "type = %d " % jobType
-        
-        if jobStatus is not None:
-            if program is not None or jobType is not None:
-                where += " and "
-            where += "status = %d " % jobStatus
-                
-        if where != '':
-            sql += " where " + where
+            chanId, startTime = program.getChannelId(), program.starttimeAsTime()
             
-        sql += " order by schedruntime, id"
-        
-        log.debug('%s' % sql)
-        
-        jobs = []
-        self.cursor.execute(sql)
+        rows = self.query(self.jobsSql, chanId=chanId, startTime=startTime, jobType=jobType, jobStatus=jobStatus)
         from mythbox.mythtv.domain import Job
-        for row in self.cursor.fetchall():
-            row = self.toDict(self.cursor, row)
-            jobs.append(Job(
-                id=int(row['id']), 
-                channelId=int(row['chanid']), 
-                startTime=row['starttime'], 
-                insertTime=row['inserttime'], 
-                jobType=row['type'], 
-                cmds=row['cmds'], 
-                flags=row['flags'], 
-                jobStatus=row['status'],
-                statusTime=row['statustime'],
-                hostname=row['hostname'],
-                comment=row['comment'],
-                scheduledRunTime=row['schedruntime'],
-                translator=self.translator,
-                domainCache=self.domainCache))
-        return jobs
+        return [Job.fromRecord(record, self.translator, self.domainCache) for record in self.toRecords(self.cursor, rows)]
 
     def setRecordingAutoexpire(self, program, shouldExpire):
         """
@@ -799,6 +1376,8 @@ class MythDatabase(object):
         #if rc != 1:
         #    raise ClientException, self.conn.getErrorMsg()
 
+    deleteScheduleSql = statement('deleteSchedule', "DELETE FROM record WHERE recordid = %(scheduleId)s")
+
     @timed
     @inject_cursor
     def deleteSchedule(self, schedule):
@@ -808,8 +1387,7 @@ class MythDatabase(object):
         @type schedule: Schedule 
         @return: Number of rows deleted from the 'record' table
         """
-        sql = "DELETE FROM record WHERE recordid = %d" % schedule.getScheduleId()
-        self.cursor.execute(sql)
+        self.query(self.deleteScheduleSql, scheduleId=schedule.getScheduleId())
         return self.cursor.rowcount
     
     @timed
@@ -1008,6 +1586,9 @@ class OfflineDatabase(MythDatabase):
     def initWithSettings(self, settings, translator=None, domainCache=None):
         pass
     
+    def isAlive(self):
+        return True
+    
     def close(self):
         pass
 
@@ -23,9 +23,9 @@ import re
 import time
 
 import mythbox.msg as m
-from mythbox.mythtv.db import inject_db
+from mythbox.mythtv.db import inject_db, FramerateCache, markupCache, toFramerate
 from mythbox.mythtv.enums import CheckForDupesIn, CheckForDupesUsing, \
-    EpisodeFilter, FlagMask, JobStatus, JobType, RecordingStatus, \
+    EpisodeFilter, FlagMask, JobStatus, JobType, MarkType, RecordingStatus, \
     ScheduleType
 from mythbox.util import formatSeconds, formatSize, safe_str
 from odict import odict
@@ -75,6 +75,20 @@ def ctime2MythTime(ctimeLong):
     return time.strftime("%Y%m%d%H%M%S", time.localtime(float(ctimeLong)))
 
 
+def mythTime2DateTime(t):
+    """
+    Converts a MythTV time string into a datetime.
+    
+    @param t: YYYYMMDDHHmmSS or YYYY-MM-DDTHH:mm:SS
+    @rtype: datetime.datetime
+    @note: Seconds are chopped off and are always zero
+    """
+    if str(t[4:5]) == "-":
+        return datetime.datetime(int(t[0:4]), int(t[5:7]), int(t[8:10]), int(t[11:13]), int(t[14:16]))
+    else:
+        return datetime.datetime(int(t[0:4]), int(t[4:6]), int(t[6:8]), int(t[8:10]), int(t[10:12]))
+
+
 def frames2seconds(frames, fps):
     """
     Converts a number of frames (long) to number of seconds (float w/ 2 decimal precision) 
@@ -143,7 +157,13 @@ class Channel(object):
     """
     
     def __init__(self, data):
-        self._data = dict(data)
+        """
+        @param data: dict or Record of a row from the channel table
+        """
+        if isinstance(data, Record):
+            self._data = data
+        else:
+            self._data = dict(data)
         # make sure getIconPath() returns a reasonable value when it is not available
         if not 'icon' in self._data or not self._data['icon'] or self._data['icon'] == "none":
             self._data['icon'] = None
@@ -242,12 +262,79 @@ class Channel(object):
         return channels
         
 
+class Record(object):
+    """
+    Compact, dict-like view over the fields of a single program record as sent 
+    by the backend or a row returned by a database query. Field values are kept 
+    in a plain list or tuple and looked up by name through a name->index table 
+    shared by every record of the same protocol or query.
+    """
+    __slots__ = ('_index', '_values')
+    
+    def __init__(self, index, values):
+        """
+        @param index: field name -> position (see BaseProtocol.fieldIndex() and db.columnIndex())
+        @type index: dict
+        @param values: field values in protocol or column order. A tuple is used as is 
+                       until the first field is set. A list is copied.
+        @type values: list or tuple
+        """
+        self._index = index
+        self._values = values[:len(index)]
+    
+    def __getitem__(self, key):
+        try:
+            return self._values[self._index[key]]
+        except IndexError:
+            raise KeyError(key)
+        
+    def __setitem__(self, key, value):
+        if isinstance(self._values, tuple):
+            self._values = list(self._values)
+        self._values[self._index[key]] = value
+        
+    def __contains__(self, key):
+        return self._index.get(key, len(self._values)) < len(self._values)
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        names = sorted(self._index, key=self._index.__getitem__)
+        return names[:len(self._values)]
+    
+    def values(self):
+        return list(self._values)
+    
+    def items(self):
+        return zip(self.keys(), self._values)
+    
+
 class Program(object):
     """
     Base class which represents a TV show in the MythTV system. 
     - Could be an existing recorded program
     - Could be a yet to be recorded scheduled program. 
     """
+    
+    # parsed times and sort keys are derived on first use and kept for the life of the program.
+    # defaults live on the class so constructing the thousands of programs in a guide stays cheap.
+    _starttimeAsTime = None
+    _endtimeAsTime = None
+    _starttimeAsEpoch = None
+    _endtimeAsEpoch = None
+    _titleSortKey = None
+    _channelSortKey = None
+    
     def __init__(self, translator):
         self.translator = translator
 
@@ -314,41 +401,57 @@ class Program(object):
         @rtype: datetime.datetime
         @note: Seconds are chopped off and are always zero
         """
-        starttime = self.starttime()
-        if str(starttime[4:5]) == "-":
-            return datetime.datetime(
-                int(starttime[0:4]), 
-                int(starttime[5:7]), 
-                int(starttime[8:10]), 
-                int(starttime[11:13]), 
-                int(starttime[14:16]) )
-        else:
-            return datetime.datetime(
-                int(starttime[0:4]), 
-                int(starttime[4:6]), 
-                int(starttime[6:8]), 
-                int(starttime[8:10]), 
-                int(starttime[10:12]) )
+        if self._starttimeAsTime is None:
+            self._starttimeAsTime = mythTime2DateTime(self.starttime())
+        return self._starttimeAsTime
 
     def endtimeAsTime(self):
         """
         @rtype: datetime.datetime
         """
-        endtime = self.endtime()
-        if str(endtime[4:5]) == "-":
-            return datetime.datetime(
-                int(endtime[0:4]), 
-                int(endtime[5:7]), 
-                int(endtime[8:10]), 
-                int(endtime[11:13]), 
-                int(endtime[14:16]) )
-        else: 
-            return datetime.datetime(
-                int(endtime[0:4]), 
-                int(endtime[4:6]), 
-                int(endtime[6:8]), 
-                int(endtime[8:10]), 
-                int(endtime[10:12]) )
+        if self._endtimeAsTime is None:
+            self._endtimeAsTime = mythTime2DateTime(self.endtime())
+        return self._endtimeAsTime
+    
+    def starttimeAsEpoch(self):
+        """
+        @return: starttimeAsTime() in seconds since the epoch
+        @rtype: int
+        """
+        if self._starttimeAsEpoch is None:
+            self._starttimeAsEpoch = int(time.mktime(self.starttimeAsTime().timetuple()))
+        return self._starttimeAsEpoch
+
+    def endtimeAsEpoch(self):
+        """
+        @return: endtimeAsTime() in seconds since the epoch
+        @rtype: int
+        """
+        if self._endtimeAsEpoch is None:
+            self._endtimeAsEpoch = int(time.mktime(self.endtimeAsTime().timetuple()))
+        return self._endtimeAsEpoch
+
+    def dateSortKey(self):
+        """
+        @return: key to sort programs by start time
+        """
+        return self.starttimeAsEpoch()
+    
+    def titleSortKey(self):
+        """
+        @return: key to sort programs by title and then start time
+        """
+        if self._titleSortKey is None:
+            self._titleSortKey = (self.title(), self.starttimeAsEpoch())
+        return self._titleSortKey
+
+    def channelSortKey(self):
+        """
+        @return: key to sort programs by channel number and then start time
+        """
+        if self._channelSortKey is None:
+            self._channelSortKey = (Channel.sortableChannelNumber(self.getChannelNumber(), 0), self.starttimeAsEpoch())
+        return self._channelSortKey
     
     def formattedAirDateTime(self):
         """
@@ -478,7 +581,7 @@ class TVProgram(Program):
     
     def __init__(self, data, translator):
         """
-        @param data: dict returned from MySQL query
+        @param data: dict or Record returned from MySQL query
         """
         Program.__init__(self, translator)
         self._data = data    
@@ -650,9 +753,7 @@ class RecordedProgram(Program):
         self._commercials = None
         self._localPath = None
 
-        self._data = odict()
-        for key, value in zip(self.protocol.recordFields(), data):
-            self._data[key] = value
+        self._data = Record(self.protocol.fieldIndex(), data)
 
     def isMovie(self):
         """
@@ -834,6 +935,13 @@ class RecordedProgram(Program):
         '''
         return ctime2MythTime(self.recstarttimets())
     
+    def recstarttimeAsTime(self):
+        """
+        @rtype: datetime.datetime
+        @note: Seconds are chopped off and are always zero
+        """
+        return mythTime2DateTime(self.recstarttime())
+
     def recendtime(self):
         """
         @return: Scheduled end time of this program according to the tv guide data.
@@ -916,17 +1024,45 @@ class RecordedProgram(Program):
     def hasCommercials(self):
         return len(self.getCommercials()) > 0
 
-    @inject_conn
     def getCommercials(self):
         """
         @rtype: CommercialBreak[]
+        @note: Served from the markup cache. Only asks the backend if the recording isn't in there.
         """
         if not self.isCommFlagged():
             self._commercials = []
         if self._commercials is None:
-            self._commercials = self.conn().getCommercialBreaks(self)
+            marks = markupCache.get(self)
+            if marks is None:
+                self._commercials = self._getCommercialBreaks()
+            else:
+                self._commercials = self._toCommercialBreaks(marks)
         return self._commercials
 
+    def _toCommercialBreaks(self, marks):
+        """
+        Pair each COMM_START with the COMM_END that follows it. Unmatched marks are skipped
+        without throwing off the pairing of the breaks after them.
+        
+        @param marks: (type, frame)[] in frame order
+        @rtype: CommercialBreak[]
+        """
+        fps = self.getFPS()
+        commBreaks = []
+        start = None
+        for markType, frame in marks:
+            if markType == MarkType.COMM_START:
+                start = frame
+            elif markType == MarkType.COMM_END and start is not None:
+                if frame > start:
+                    commBreaks.append(CommercialBreak(frames2seconds(start, fps), frames2seconds(frame, fps)))
+                start = None
+        return commBreaks
+
+    @inject_conn
+    def _getCommercialBreaks(self):
+        return self.conn().getCommercialBreaks(self)
+
     @inject_conn
     def setBookmark(self, seconds):
         """
@@ -997,7 +1133,14 @@ class RecordedProgram(Program):
             return self.db().getFramerate(self)
 
         if self._fps is None:
-            self._fps = self.db().getFramerate(self)
+            self._fps = FramerateCache.get(self._platform, self)
+        if self._fps is None:
+            self._fps = self.db().findFramerate(self)
+            if self._fps is None:
+                # no seek table yet so only hang on to the default for the life of this program
+                self._fps = toFramerate(None, None)
+            else:
+                FramerateCache.put(self._platform, self, self._fps)
         return self._fps
     
     def formattedFileSize(self):
@@ -1033,14 +1176,18 @@ class RecordingSchedule(object):
     """Recording schedule as persisted in the 'record' table."""
     
     def __init__(self, data, translator):
-        self._data = data # dict 
+        """
+        @param data: dict or Record of a row from the record table
+        """
+        self._data = data
         self.translator = translator
+        self._numRecorded = data.get('numRecorded')
         
         if not 'icon' in self._data or not self._data['icon'] or self._data['icon'] == "none":
             self._data['icon'] = None
 
     def __repr__(self):
-        return "%s {recordid=%s, type=%s, title=%s, subtitle=%s, starttime=%s, endtime=%s startdate=%s, enddate=%s, nr=%d}" % (
+        return "%s {recordid=%s, type=%s, title=%s, subtitle=%s, starttime=%s, endtime=%s startdate=%s, enddate=%s, nr=%s}" % (
             type(self).__name__,
             self.getScheduleId(),
             self.formattedScheduleType(),
@@ -1060,13 +1207,20 @@ class RecordingSchedule(object):
     
     def data(self):
         """
-        @return: internal storage dict
-        @rtype: dict
+        @return: internal storage
+        @rtype: dict or Record
         """
         return self._data
 
     def numRecorded(self):
-        return int(self._data['numRecorded'])
+        """
+        @return: number of times the title has been recorded or None if not counted yet
+        @rtype: int
+        """
+        return self._numRecorded
+
+    def setNumRecorded(self, numRecorded):
+        self._numRecorded = numRecorded
     
     def getScheduleId(self):
         """
@@ -1777,13 +1931,20 @@ class Tuner(object):
         return self.conn().getTunerStatus(self)
 
     @inject_conn
-    def formattedTunerStatus(self):
+    def formattedTunerStatus(self, tunerStatus=None, recording=None):
+        """
+        @param tunerStatus: TVState enum if already known, otherwise queried from the backend
+        @param recording: RecordedProgram on the tuner if already known, otherwise queried from the backend
+        """
         t = self.translator.get
-        tunerStatus = self.getTunerStatus()
+        if tunerStatus is None:
+            tunerStatus = self.getTunerStatus()
         tvState = self.conn().protocol.tvState()
         
         if tunerStatus in (tvState.WatchingLiveTV, tvState.WatchingRecording, tvState.RecordingOnly):
-            r = self.conn().getCurrentRecording(self)
+            r = recording
+            if r is None:
+                r = self.conn().getCurrentRecording(self)
         
         if tvState.OK == tunerStatus:
             next = self.getNextScheduledRecording() 
@@ -1827,9 +1988,8 @@ class Tuner(object):
         """
         upcoming = self.domainCache.getUpcomingRecordings()
         upcoming = filter(lambda x: x.getTunerId() == self.tunerId, upcoming)
-        upcoming.sort(key=lambda x: x.starttimeAsTime())
         if len(upcoming) > 0:
-            return upcoming[0]
+            return min(upcoming, key=Program.dateSortKey)
         else:
             return None
  
@@ -1897,6 +2057,28 @@ class Job(object):
         self.scheduledRunTime = scheduledRunTime
         self.translator = translator
 
+    @classmethod
+    def fromRecord(cls, record, translator, domainCache):
+        """
+        @param record: row from the jobqueue table
+        @type record: Record or dict
+        """
+        return Job(
+            id=int(record['id']), 
+            channelId=int(record['chanid']), 
+            startTime=record['starttime'], 
+            insertTime=record['inserttime'], 
+            jobType=record['type'], 
+            cmds=record['cmds'], 
+            flags=record['flags'], 
+            jobStatus=record['status'],
+            statusTime=record['statustime'],
+            hostname=record['hostname'],
+            comment=record['comment'],
+            scheduledRunTime=record['schedruntime'],
+            translator=translator,
+            domainCache=domainCache)
+
     @classmethod
     def fromProgram(cls, program, jobType):
         job = Job(
@@ -1999,19 +2181,17 @@ class Job(object):
         if self.jobStatus != JobStatus.QUEUED:
             raise StatusException('Job %s with status %s is not queued' % (self.id, self.formattedJobStatus()))
         
-        currentPos = self.getPositionInQueue()[0] # pos is 1st in returned tuple
+        jobs = self.db().getJobs(jobStatus=JobStatus.QUEUED)
+        currentPos = jobs.index(self) + 1
         if currentPos == 1:
             log.warn('Job %d is already at the front of the queue' % self.id)
-            
-        jobs = self.db().getJobs(jobStatus=JobStatus.QUEUED)
 
+        # shift the run times of the jobs ahead of this one back by one and save them all at once
         self.scheduledRunTime = jobs[0].scheduledRunTime
-        self.db().updateJobScheduledRunTime(self)            
-        
         for i, job in enumerate(jobs[:currentPos-1]):
             log.debug('moving %d runtime to %d' % (i+1, i))
             job.scheduledRunTime = jobs[i+1].scheduledRunTime
-            self.db().updateJobScheduledRunTime(job)
+        self.db().updateJobScheduledRunTimes([self] + jobs[:currentPos-1])
              
     def __eq__(self, rhs):
         """Equality based on job id only"""
@@ -2028,6 +2208,88 @@ class Job(object):
             self.formattedJobStatus(),
             self.scheduledRunTime)
 
+
+
+class JobQueue(object):
+    """
+    Snapshot of the running and queued jobs in the job queue. Queue positions, recordings, 
+    and backends of the jobs are worked out up front in one pass so reading them doesn't 
+    go back to the database or the backend once per job.
+    """
+
+    def __init__(self, running, queued, recordings, backends):
+        """
+        @param running: Job[] with status RUNNING
+        @param queued: Job[] with status QUEUED in order of scheduled run time
+        @param recordings: RecordedProgram[] to look up the recordings of jobs in
+        @param backends: Backend[] with the master backend first
+        """
+        self.running = running
+        self.queued = queued
+        self._positions = dict([(job.id, i + 1) for i, job in enumerate(queued)])
+
+        recordingsByKey = dict([((r.getChannelId(), r.starttimeAsTime()), r) for r in recordings])
+        backendsByHost = {}
+        for b in reversed(backends):
+            backendsByHost[b.ipAddress.lower()] = backendsByHost[b.hostname.lower()] = b
+        
+        self._programs = {}
+        self._backends = {}
+        for job in running + queued:
+            self._programs[job.id] = recordingsByKey.get((job.channelId, job.startTime))
+            self._backends[job.id] = backendsByHost.get((job.hostname or u'').lower(), backends[0])
+
+    @staticmethod
+    def load(db, domainCache):
+        """
+        @return: snapshot of the job queue with the recordings of jobs resolved from the cached 
+                 recordings. Jobs whose recording isn't cached (LiveTV, deleted, etc) ask the 
+                 backend for just that recording.
+        @rtype: JobQueue
+        """
+        running = db.getJobs(jobStatus=JobStatus.RUNNING)
+        queued = db.getJobs(jobStatus=JobStatus.QUEUED)
+        recordings = list(domainCache.getAllRecordings())
+        keys = set([(r.getChannelId(), r.starttimeAsTime()) for r in recordings])
+        for job in running + queued:
+            key = (job.channelId, job.startTime)
+            if key not in keys:
+                keys.add(key)
+                program = job.getProgram()
+                if program:
+                    recordings.append(program)
+        return JobQueue(running, queued, recordings, db.getBackends())
+
+    def jobs(self):
+        """
+        @return: running jobs followed by queued jobs
+        @rtype: Job[]
+        """
+        return self.running + self.queued
+
+    def getPositionInQueue(self, job):
+        """
+        @return: (position in job queue, size of job queue)
+        @rtype: (int, int)
+        @raise StatusException: when job is not queued
+        """
+        if job.id not in self._positions:
+            raise StatusException('Job %s with status %s is not in the job queue' % (job.id, job.formattedJobStatus()))
+        return (self._positions[job.id], len(self.queued))
+
+    def getProgram(self, job):
+        """
+        @rtype: RecordedProgram or None if the recording could not be found
+        """
+        return self._programs.get(job.id)
+
+    def getBackend(self, job):
+        """
+        @return: backend the job runs on. Defaults to the master backend.
+        @rtype: Backend
+        """
+        return self._backends.get(job.id)
+
                 
 class Backend(object):
     
@@ -482,3 +482,15 @@ class CommercialDetectionType(object):
     
     PREPOSTROLL = 0x00000200                                   # = 512 
     PREPOSTROLL_ALL = PREPOSTROLL | BLANK_FRAME | SCENE_CHANGE # = 515
+
+
+class MarkType(object):
+    """
+    @see: recordedmarkup.type
+    """
+    # from libs/libmythbase/programtypes.h
+    CUT_END     = 0
+    CUT_START   = 1
+    BOOKMARK    = 2
+    COMM_START  = 4
+    COMM_END    = 5
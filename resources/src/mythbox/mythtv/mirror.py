@@ -0,0 +1,241 @@
+#
+#  MythBox for XBMC - http://mythbox.googlecode.com
+#  Copyright (C) 2013 analogue@yahoo.com
+# 
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from mythbox.bus import Event
+from mythbox.mythtv.db import inject_db, columnIndex
+from mythbox.util import run_async, catchall, coalesce, sync_instance, timed
+
+log = logging.getLogger('mythbox.cache')
+
+# GuideMirror used by MythDatabase.getTVGuideData(..). Set up by HomeWindow when enabled in settings.
+guideMirror = None
+
+
+class GuideMirror(object):
+    """
+    Local SQLite copy of the channel and program tables for a rolling window of days
+    so paging through the TV guide doesn't go across the network to MySQL every time.
+
+    Syncing is incremental. Programs are compared with MySQL by channel and day using
+    a count and checksum and only the days that differ are copied over. A sync is done
+    in the background when mythfilldatabase has run since the last one, when the
+    scheduler runs, and when the window rolls over to a new day. Until it finishes, 
+    guide data is read from MySQL as before. Syncs write over their own connection so
+    reading the guide from the mirror never waits for one to finish.
+    """
+
+    daysBehind = 1
+    daysAhead = 14
+    checkEverySecs = 60  # how often to look at mythfilldatabaseLastRunEnd
+
+    schema = [
+        '''create table if not exists channel (
+               chanid integer primary key, channum text, callsign text, icon text, name text, visible integer)''',
+        '''create table if not exists program (
+               chanid integer, starttime timestamp, endtime timestamp, title text, subtitle text, description text, 
+               showtype text, originalairdate date, category text, category_type text, seriesid text, programid text, 
+               hdtv integer)''',
+        '''create index if not exists program_chanid_starttime on program (chanid, starttime)''',
+        '''create table if not exists checksum (
+               chanid integer, day date, count integer, checksum integer, primary key (chanid, day))''',
+        '''create table if not exists sync (key text primary key, value text)''',
+    ]
+
+    tvGuideSql = '''
+        select
+            c.chanid,
+            c.channum,
+            c.callsign,
+            c.icon,
+            c.name as channame,
+            p.starttime,
+            p.endtime,
+            p.title,
+            p.subtitle,
+            p.description,
+            p.showtype,
+            p.originalairdate,
+            p.category,
+            p.category_type,
+            p.seriesid,
+            p.programid,
+            p.hdtv
+        from 
+            channel c, 
+            program p
+        where c.visible = 1
+            and c.chanid in (%s)
+            and c.chanid = p.chanid
+            and p.starttime <  ?
+            and p.endtime   >  ?
+            and p.starttime != p.endtime
+        order by 
+            c.chanid, 
+            p.starttime
+        '''
+
+    def __init__(self, platform):
+        self.path = os.path.join(platform.getCacheDir(), 'guide.sqlite')
+        self.conn = None          # for reads only
+        self.syncLock = threading.Lock()
+        self.current = False      # True once synced this session and nothing has changed since
+        self.lastChecked = 0
+        self.window = None        # (start, end) of the mirrored programs
+        self.lastRunEnd = None    # mythfilldatabaseLastRunEnd as of the last sync
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        # with write ahead logging readers see the last commit while a sync is writing
+        conn.execute('pragma journal_mode=wal')
+        for sql in self.schema:
+            conn.execute(sql)
+        conn.commit()
+        return conn
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = self._open()
+        return self.conn
+
+    def currentWindow(self):
+        """
+        @return: window of days to mirror as of now
+        @rtype: (datetime.datetime, datetime.datetime)
+        """
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        return (today - datetime.timedelta(days=self.daysBehind), today + datetime.timedelta(days=self.daysAhead))
+
+    def covers(self, db, startTime, endTime):
+        """
+        @return: True if guide data for [startTime, endTime) can be read from the mirror. If
+                 the mirror has fallen behind, a sync is started in the background.
+        @note: Programs starting before the window aren't mirrored so the first day of the
+               window is only there to catch programs running over midnight into the second.
+        """
+        if self.current and time.time() - self.lastChecked > self.checkEverySecs:
+            self.lastChecked = time.time()
+            if self.window != self.currentWindow() or self.lastRunEnd != db.getMythSetting('mythfilldatabaseLastRunEnd'):
+                self.current = False
+        if not self.current:
+            self.syncInBackground()
+            return False
+        windowStart, windowEnd = self.window
+        return windowStart + datetime.timedelta(days=1) <= startTime and endTime <= windowEnd
+
+    @sync_instance
+    def getTVGuideRecords(self, startTime, endTime, chanIds):
+        """
+        @return: same rows as MythDatabase.tvGuideSql in chanid, starttime order
+        @rtype: Record[]
+        """
+        from mythbox.mythtv.domain import Record
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute(self.tvGuideSql % ','.join(['%d' % int(chanId) for chanId in chanIds]), (endTime, startTime))
+            index = columnIndex(cursor)
+            return [Record(index, row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    @run_async
+    @catchall
+    @inject_db
+    @coalesce
+    def syncInBackground(self):
+        self.sync(self.db())
+
+    @timed
+    def sync(self, db):
+        """
+        Bring the mirror up to date with MySQL copying over only the days of each channel 
+        which have changed. One sync runs at a time.
+
+        @return: number of programs copied
+        @rtype: int
+        """
+        self.syncLock.acquire()
+        try:
+            return self._sync(db)
+        finally:
+            self.syncLock.release()
+
+    def _sync(self, db):
+        lastRunEnd = db.getMythSetting('mythfilldatabaseLastRunEnd')
+        windowStart, windowEnd = window = self.currentWindow()
+        conn = self._open()
+        try:
+            conn.execute('delete from channel')
+            conn.executemany('insert into channel values (?, ?, ?, ?, ?, ?)', db.getGuideChannels())
+
+            # days which rolled out of the window
+            conn.execute('delete from program where starttime < ? or starttime >= ?', (windowStart, windowEnd))
+            conn.execute('delete from checksum where day < ? or day >= ?', (windowStart.date(), windowEnd.date()))
+
+            remote = db.getGuideChecksums(windowStart, windowEnd)
+            local = dict([((chanId, day), (count, checksum)) for chanId, day, count, checksum in conn.execute('select * from checksum')])
+            changed = [key for key in remote if local.get(key) != remote[key]]
+            removed = [key for key in local if key not in remote]
+
+            changedByDay = {}
+            for chanId, day in changed + removed:
+                dayStart = datetime.datetime.combine(day, datetime.time())
+                conn.execute('delete from program where chanid = ? and starttime >= ? and starttime < ?', (chanId, dayStart, dayStart + datetime.timedelta(days=1)))
+                conn.execute('delete from checksum where chanid = ? and day = ?', (chanId, day))
+                if (chanId, day) in remote:
+                    changedByDay.setdefault(day, []).append(chanId)
+
+            copied = 0
+            for day, chanIds in sorted(changedByDay.items()):
+                dayStart = datetime.datetime.combine(day, datetime.time())
+                rows = db.getGuidePrograms(chanIds, dayStart, dayStart + datetime.timedelta(days=1))
+                conn.executemany('insert into program values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                copied += len(rows)
+            conn.executemany('insert into checksum values (?, ?, ?, ?)', 
+                [(chanId, day, remote[(chanId, day)][0], remote[(chanId, day)][1]) for chanId, day in changed])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        self.window = window
+        self.lastRunEnd = lastRunEnd
+        self.lastChecked = time.time()
+        self.current = True
+        log.debug('Guide mirror synced %d of %d channel days (%d programs)' % (len(changed), len(remote), copied))
+        return copied
+
+    def onEvent(self, event):
+        if event['id'] == Event.SCHEDULER_RAN:
+            self.current = False
+            self.syncInBackground()
+
+    @sync_instance
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
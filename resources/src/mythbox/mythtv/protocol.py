@@ -36,8 +36,21 @@ class ProtocolException(Exception):
 
 class BaseProtocol(object):
     
+    def __init__(self):
+        # recordFields() builds a new list on every call so capture the field
+        # layout once per protocol instead of once per program record
+        self._fieldIndex = dict((name, i) for i, name in enumerate(self.recordFields()))
+        self._recordSize = len(self._fieldIndex)
+        
     def recordSize(self):
-        return len(self.recordFields())
+        return self._recordSize
+    
+    def fieldIndex(self):
+        """
+        @return: record field name -> position of the field in a program record
+        @rtype: dict
+        """
+        return self._fieldIndex
     
     def emptyRecordFields(self):
         return ['episode','inetref','season']
@@ -111,6 +124,13 @@ class Protocol40(BaseProtocol):
             reply.pop(0)
         return d
 
+    def readLongAt(self, reply, i):
+        """
+        @return: long starting at reply[i] and the index of the field after it
+        @rtype: (long, int)
+        """
+        return self.decodeLongLong(int(reply[i+1]), int(reply[i])), i + 2
+
     def writeLong(self, d, request):
         low, high = self.encodeLongLong(d)
         request.append('%d' % high)
@@ -373,6 +393,9 @@ class Protocol66(Protocol65):
         if remove:
             reply.pop(0)
         return d
+
+    def readLongAt(self, reply, i):
+        return long(reply[i]), i + 1
     
     def writeLong(self, d, request):
         request.append('%d' % long(d))
@@ -68,9 +68,15 @@ class MythEventPublisher(object):
                     elif tokens[1].startswith('COMMFLAG_START'):
                         self.bus.publish({'id':Event.COMMFLAG_START})
                             
+                    elif tokens[1].startswith('COMMFLAG_UPDATE'):
+                        self.bus.publish({'id':Event.COMMFLAG_UPDATE})
+                            
                     elif tokens[1].startswith('SCHEDULE_CHANGE'):
                         self.bus.publish({'id':Event.SCHEDULE_CHANGED}) 
 
+                    elif tokens[1].startswith('CLEAR_SETTINGS_CACHE'):
+                        self.bus.publish({'id':Event.MYTH_SETTINGS_CHANGED})
+
             except Exception, e:
                 log.exception(e)
         log.debug('Exiting MythEventPublisher')
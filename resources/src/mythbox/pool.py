@@ -17,7 +17,6 @@
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 
-import datetime
 import logging
 import threading
 import time
@@ -41,41 +40,190 @@ class PoolableFactory(object):
     def destroy(self, resource):
         raise Exception, "Abstract method"
 
+    def validate(self, resource):
+        """
+        @return: True if an idle resource is still usable, False if it should be evicted
+        """
+        return True
+
+
+class PoolTimeout(Exception):
+    """Thrown when a resource could not be checked out of a full pool in time"""
+    pass
+
 
 class Pool(object):
-    """Simple no frills unbounded resource pool"""
+    """
+    Simple no frills resource pool. Unbounded unless given a maxSize in which case 
+    checkouts from a full pool wait their turn (first come, first served) for a 
+    resource to be checked in.
+    """
     
-    def __init__(self, factory):
+    def __init__(self, factory, validateAfterSecs=None, maxSize=None, timeout=None):
         """
         @type factory: PoolableFactory
+        @param validateAfterSecs: resources idle for longer than this are validated on checkout 
+                                  and evicted if no longer usable. None to never validate.
+        @param maxSize: max number of resources in and out of the pool. None for unbounded.
+        @param timeout: default max secs checkout() waits on a full pool. None to wait forever.
         """
         self.factory = factory
+        self.validateAfterSecs = validateAfterSecs
+        self.maxSize = maxSize
+        self.timeout = timeout
         self.isShutdown = False
         self.inn = []
         self.out = []
+        self.reserved = 0       # slots held by checkouts validating or creating a resource
+        self.idleSince = {}
+        self.waiters = []
+        self._sync_lock = threading.RLock()   # shared with @sync_instance 
+        self.changed = threading.Condition(self._sync_lock)
+        self.numValidated = 0
+        self.numEvicted = 0
+        self.numRecreated = 0
+        self.replacementsOwed = 0
+        self.numCreated = 0
+        self.numDestroyed = 0
+        self.numWaits = 0
+        self.numTimeouts = 0
+        self.waitSecs = 0.0
+        self.highWater = 0
+
+    def isFull(self):
+        return self.maxSize is not None and len(self.inn) == 0 and len(self.out) + self.reserved >= self.maxSize
+    
+    def awaitTurn(self, timeout):
+        """Wait in line until this thread is at the head of the queue and the pool has room"""
+        if not self.waiters and not self.isFull():
+            return
+        me = object()
+        self.waiters.append(me)
+        self.numWaits += 1
+        start = time.time()
+        try:
+            while self.waiters[0] is not me or self.isFull():
+                if self.isShutdown: raise Exception, 'Pool shutdown'
+                remaining = None
+                if timeout is not None:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        self.numTimeouts += 1
+                        raise PoolTimeout('Timed out after %s secs waiting for one of %d resources' % (timeout, self.maxSize))
+                self.changed.wait(remaining)
+        finally:
+            self.waiters.remove(me)
+            self.waitSecs += time.time() - start
+            self.changed.notifyAll()   # next in line
+        
+    def checkout(self, timeout=-1):
+        """
+        @param timeout: max secs to wait when the pool is full. Defaults to the pool's timeout.
+        @raise PoolTimeout: if the pool stayed full for longer than timeout secs
+        @note: Only reserving a slot is done under the pool's lock. Resources are validated 
+               and created outside of it so a slow connect doesn't hold up checkins and 
+               other checkouts.
+        """
+        resource, idleSince = self.reserve([timeout, self.timeout][timeout == -1])
+        created = False
+        try:
+            while resource is not None and not self.isUsable(resource, idleSince):
+                self.evict(resource)
+                resource, idleSince = self.nextIdle()
+            if resource is None:
+                log.debug('Creating resource %d' % (self.size()))
+                resource = self.factory.create()
+                created = True
+        except:
+            self.unreserve()
+            raise
+        return self.claim(resource, created)
 
     @sync_instance
-    def checkout(self):
+    def reserve(self, timeout):
+        """
+        Wait for room in the pool and hold a slot for this checkout.
+        @return: (idle resource or None, time it went idle)
+        """
         if self.isShutdown: raise Exception, 'Pool shutdown'
-        if len(self.inn) == 0:
-            log.debug('Creating resource %d' % (len(self.out)+1))
-            resource = self.factory.create()
-        else:
-            resource = self.inn.pop()
+        self.awaitTurn(timeout)
+        self.reserved += 1
+        return self.nextIdle()
+
+    @sync_instance
+    def nextIdle(self):
+        """
+        @return: (most recently checked in resource or None if there isn't one, time it went idle)
+        """
+        if not self.inn:
+            return None, None
+        resource = self.inn.pop()
+        return resource, self.idleSince.pop(resource, None)
+
+    @sync_instance
+    def unreserve(self):
+        """Give back the slot of a checkout that failed"""
+        self.reserved -= 1
+        self.changed.notifyAll()
+
+    @sync_instance
+    def claim(self, resource, created):
+        """Turn the slot held by a checkout into a checked out resource"""
+        self.reserved -= 1
+        if created:
+            self.numCreated += 1
+            if self.replacementsOwed > 0:
+                self.replacementsOwed -= 1
+                self.numRecreated += 1
+        if self.isShutdown:
+            self.changed.notifyAll()
+            self.destroy(resource)
+            raise Exception, 'Pool shutdown'
         self.out.append(resource)
+        self.highWater = max(self.highWater, len(self.out))
         return resource
 
+    def destroy(self, resource):
+        self.numDestroyed += 1
+        self.factory.destroy(resource)
+
+    def isUsable(self, resource, idleSince):
+        """Validate resource if it has been idle for too long to just trust it"""
+        if self.validateAfterSecs is None or idleSince is None or time.time() - idleSince <= self.validateAfterSecs:
+            return True
+        self.numValidated += 1
+        try:
+            return self.factory.validate(resource)
+        except:
+            log.exception('while validating')
+            return False
+    
+    def evict(self, resource):
+        log.debug('Evicting resource %s' % resource)
+        self.numEvicted += 1
+        self.replacementsOwed += 1
+        try:
+            self.destroy(resource)
+        except:
+            log.exception('while evicting')
+        
     @sync_instance
     def checkin(self, resource):
         if self.isShutdown: raise Exception, 'Pool shutdown'
         self.inn.append(resource)
         self.out.remove(resource)
+        self.idleSince[resource] = time.time()
+        self.changed.notifyAll()
 
     @sync_instance
     def discard(self, resource):
+        """Throw away a checked out resource which turned out to be broken"""
         self.out.remove(resource)
+        self.numEvicted += 1
+        self.replacementsOwed += 1
+        self.changed.notifyAll()
         try:
-            self.factory.destroy(resource)
+            self.destroy(resource)
         except:
             log.exception('while discarding')
             
@@ -83,16 +231,39 @@ class Pool(object):
     def shutdown(self):
         for resource in self.inn:
             try:
-                self.factory.destroy(resource)
+                self.destroy(resource)
             except:
                 log.exception('Destroy pooled resource')
         if len(self.out) > 0:
             log.warn('%d pooled resources still out on shutdown' % len(self.out))
         self.isShutdown = True
+        self.changed.notifyAll()
+    
+    @sync_instance
+    def stats(self):
+        """
+        @return: counters for sizing the pool
+        @rtype: dict
+        """
+        return {
+            'size'       : self.size(),
+            'available'  : self.available(),
+            'maxSize'    : self.maxSize,
+            'highWater'  : self.highWater,
+            'created'    : self.numCreated,
+            'destroyed'  : self.numDestroyed,
+            'waits'      : self.numWaits,
+            'waitSecs'   : self.waitSecs,
+            'timeouts'   : self.numTimeouts,
+            'waiting'    : len(self.waiters),
+            'validated'  : self.numValidated,
+            'evicted'    : self.numEvicted,
+            'recreated'  : self.numRecreated,
+        }
     
     @sync_instance
     def size(self):
-        return len(self.inn) + len(self.out)
+        return len(self.inn) + len(self.out) + self.reserved
     
     @sync_instance
     def available(self):
@@ -105,98 +276,244 @@ class Pool(object):
             for r in self.inn[:]:
                 try:
                     self.inn.remove(r)
-                    self.factory.destroy(r)
+                    self.idleSince.pop(r, None)
+                    self.destroy(r)
                 except:
                     log.exception('while shrinking')
 
+    @sync_instance
+    def add(self, resource):
+        """
+        Add a resource freshly created outside of the pool to the available resources.
+        @return: False if the pool has been shutdown or is full (resource not added), True otherwise
+        """
+        if self.isShutdown or (self.maxSize is not None and self.size() >= self.maxSize):
+            return False
+        self.numCreated += 1
+        self.inn.append(resource)
+        self.idleSince[resource] = time.time()
+        self.changed.notifyAll()
+        return True
+    
     @sync_instance
     def grow(self, size):
         if self.isShutdown: raise Exception, 'Pool shutdown'
+        if self.maxSize is not None:
+            size = min(size, self.maxSize)
         if size > self.size():
             delta = size - self.size()
             for i in range(delta):
                 r = self.factory.create()
+                self.numCreated += 1
                 self.inn.append(r)
+                self.idleSince[r] = time.time()
+            self.changed.notifyAll()
 
                 
 class EvictingPool(Pool):
-    """Evicts resources asynchronously based on a configurable maximum age.
-    Surprisingly, I came up empty finding an existing FOSS implementation 
-    where evictions were async."""
+    """
+    Evicts resources which have sat idle in the pool for longer than a configurable 
+    maximum age. Expired resources are evicted lazily on checkout and checkin. While
+    idle resources remain, an optional timer also sweeps once the oldest of them is
+    due so that a quiet pool lets go of its resources without a thread waking up 
+    every second for the life of the process.
+    """
        
-    def __init__(self, factory, maxAgeSecs, reapEverySecs):
-        Pool.__init__(self, factory)
+    def __init__(self, factory, maxAgeSecs, reapEverySecs=None, validateAfterSecs=None, maxSize=None, timeout=None):
+        """
+        @param maxAgeSecs: max secs a resource can sit idle in the pool
+        @param reapEverySecs: min secs between timed sweeps. None to only evict on checkout/checkin.
+        """
+        Pool.__init__(self, factory, validateAfterSecs, maxSize, timeout)
         self.maxAgeSecs = maxAgeSecs
         self.reapEverySecs = reapEverySecs
-        self.dobs = {}
         self.stopReaping = False
         self.numEvictions = 0
-        self.startLock = threading.Event()
-        self.startLock.clear()
-        self.evictorThread = self.evictor()  # TODO: Don't start evictor until something is actually in the pool
-        self.startLock.wait()
-        log.debug('Evictor thread = %s' % self.evictorThread)
+        self.timer = None
         
-    @run_async
-    def evictor(self):
-        log.debug('Evictor started')
-        self.startLock.set()
-        cnt = 1
-        while not self.isShutdown and not self.stopReaping:
-            time.sleep(1)
-            if cnt % self.reapEverySecs == 0:
-                self.reap(cnt)
-            cnt+=1
-        log.debug('Evictor exiting')
-
-    @sync_instance
-    def reap(self, cnt):
-        now = datetime.datetime.now()
-        for r in self.inn:
-            dob = self.dobs[r]
-            evictAfter = dob + datetime.timedelta(seconds=self.maxAgeSecs)
-            
-            #log.debug('Reaper check:')
-            #log.debug('  dob        = %s' % dob)
-            #log.debug('  evictAfter = %s' % evictAfter)
-            #log.debug('  now        = %s' % now)
-            
-            if now > evictAfter:
-                try:
-                    log.debug('Evicting resource %s in sweep %d' % (r, cnt/self.reapEverySecs))
-                    self.inn.remove(r)
-                    self.factory.destroy(r)
-                    del self.dobs[r]
-                    self.numEvictions += 1
-                except:
-                    log.exception('while reaping')
-            
+    @sync_instance
+    def reap(self):
+        """Evict resources which have been idle for longer than maxAgeSecs"""
+        expiredAt = time.time() - self.maxAgeSecs
+        for r in [r for r in self.inn if self.idleSince.get(r, expiredAt) <= expiredAt]:
+            try:
+                log.debug('Evicting resource %s' % r)
+                self.inn.remove(r)
+                self.idleSince.pop(r, None)
+                self.destroy(r)
+                self.numEvictions += 1
+            except:
+                log.exception('while reaping')
+    
+    @sync_instance
+    def scheduleReaper(self):
+        """Start the timer for the next sweep if there are idle resources and it isn't already running"""
+        if self.timer or not self.reapEverySecs or not self.inn or self.isShutdown or self.stopReaping:
+            return
+        oldest = min([self.idleSince.get(r, time.time()) for r in self.inn])
+        delay = max(self.reapEverySecs, oldest + self.maxAgeSecs - time.time())
+        self.timer = threading.Timer(delay, self.onTimer)
+        self.timer.setDaemon(True)
+        self.timer.start()
+
+    @sync_instance
+    def onTimer(self):
+        self.timer = None
+        if not self.isShutdown:
+            self.reap()
+            self.scheduleReaper()
+    
+    def checkout(self, timeout=-1):
+        self.reap()
+        return super(EvictingPool, self).checkout(timeout)
+    
     @sync_instance
     def checkin(self, resource):
         super(EvictingPool, self).checkin(resource)
-        self.dobs[resource] = datetime.datetime.now()
+        self.reap()
+        self.scheduleReaper()
 
     @sync_instance
-    def discard(self, resource):
-        super(EvictingPool, self).discard(resource)
-        if resource in self.dobs:
-            del self.dobs[resource]
-
+    def add(self, resource):
+        added = super(EvictingPool, self).add(resource)
+        self.scheduleReaper()
+        return added
+    
     @sync_instance
     def grow(self, size):
         super(EvictingPool, self).grow(size)
-        now = datetime.datetime.now()
-        for r in self.inn:
-            if not r in self.dobs:
-                self.dobs[r] = now
+        self.scheduleReaper()
                 
-    # SYNC ALERT:
-    #   It is very important that call is not synchronized since we join() on the reaper thread
-    #   which may itself be in synchronized call to reap()
+    @sync_instance
     def shutdown(self):
-        self.isShutdown = True
-        if self.evictorThread.isAlive():
-            log.debug('joining evictor')
-            self.evictorThread.join(self.reapEverySecs * 2) # 2x == fudge factor
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
         super(EvictingPool, self).shutdown()
         log.debug('Total num evictions = %d' % self.numEvictions)
+
+
+class WarmUp(object):
+    """
+    Fills a pool up to a minimum size in the background so the first users of the
+    pool don't have to wait for resources to be created. Resources are created 
+    concurrently since creating one is mostly spent waiting on the network.
+    """
+    
+    def __init__(self, pool, minSize, name='pool'):
+        """
+        @type pool: Pool
+        @param minSize: number of resources the pool should have when warmed up
+        """
+        self.pool = pool
+        self.minSize = minSize
+        self.name = name
+        self.cancelled = False
+        self.numCreated = 0
+        self.elapsed = None    # secs taken to warm up once done
+        self.workers = []
+        self.lock = threading.Lock()
+        
+    def start(self):
+        """
+        @return: self
+        """
+        self.startTime = time.time()
+        self.pending = max(0, self.minSize - self.pool.size())
+        if self.pending == 0:
+            self.elapsed = 0.0
+        else:
+            self.workers = [self.createResource() for i in xrange(self.pending)]
+        return self
+    
+    def cancel(self):
+        """Stop adding resources to the pool. Resources still being created are thrown away."""
+        self.cancelled = True
+        
+    def join(self, timeout=None):
+        for w in self.workers:
+            w.join(timeout)
+        
+    def isDone(self):
+        return self.elapsed is not None
+    
+    @run_async
+    def createResource(self):
+        try:
+            if not self.cancelled:
+                resource = self.pool.factory.create()
+                if self.cancelled or not self.pool.add(resource):
+                    self.pool.factory.destroy(resource)
+                else:
+                    self.lock.acquire()
+                    self.numCreated += 1
+                    self.lock.release()
+        except:
+            log.exception('Warming up %s' % self.name)
+        
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+            if self.pending == 0:
+                self.elapsed = time.time() - self.startTime
+                log.info('Warmed up %s with %d of %d resources in %2.2f secs%s' % (
+                    self.name, self.numCreated, self.minSize, self.elapsed, ['', ' (cancelled)'][self.cancelled]))
+        finally:
+            self.lock.release()
+
+
+class KeyedPool(object):
+    """
+    Pool of pools, one per key, for resources bound to a particular something.
+    Ex: sockets to each of several servers.
+    """
+    
+    def __init__(self, createPool):
+        """
+        @param createPool: callable which returns a new (empty) Pool for the given key
+        """
+        self.createPool = createPool
+        self.pools = {}
+        self.isShutdown = False
+        
+    @sync_instance
+    def pool(self, key):
+        """
+        @return: pool for key, created on first use
+        @rtype: Pool
+        """
+        if self.isShutdown: raise Exception, 'Pool shutdown'
+        if not key in self.pools:
+            self.pools[key] = self.createPool(key)
+        return self.pools[key]
+        
+    def checkout(self, key):
+        return self.pool(key).checkout()
+    
+    def checkin(self, key, resource):
+        self.pool(key).checkin(resource)
+        
+    def discard(self, key, resource):
+        self.pool(key).discard(resource)
+        
+    @sync_instance
+    def shutdown(self):
+        self.isShutdown = True
+        for p in self.pools.values():
+            p.shutdown()
+    
+    @sync_instance
+    def size(self):
+        return sum([p.size() for p in self.pools.values()])
+    
+    @sync_instance
+    def stats(self):
+        """
+        @return: stats of each pool by key
+        @rtype: dict
+        """
+        return dict([(key, p.stats()) for key, p in self.pools.items()])
+    
+    @sync_instance
+    def available(self):
+        return sum([p.available() for p in self.pools.values()])
@@ -59,6 +59,8 @@ class MythSettings(object):
     def isConfirmOnDelete(self): return self.getBoolean('confirm_on_delete')
     
     def isAggressiveCaching(self): return self.getBoolean('aggressive_caching')
+
+    def isGuideMirrorEnabled(self): return self.getBoolean('guide_mirror_enabled')
             
     def setMySqlHost(self, host): self.put('mysql_host', host)
 
@@ -89,6 +91,50 @@ class MythSettings(object):
         """
         return self.get('paths_recordedprefix').split(os.pathsep)
         
+    def getTransferStreams(self, hostname):
+        """
+        @return: Number of concurrent streams used to copy large files from the given backend
+        @rtype: int
+        @note: transfer_streams is a default count optionally followed by per backend 
+               overrides. Ex: 2,slavebox=4,masterbox=1
+        """
+        streams = 1
+        try:
+            for token in (self.get('transfer_streams') or '').split(','):
+                if '=' in token:
+                    host, n = token.split('=', 1)
+                    if host.strip() == hostname:
+                        return max(1, int(n))
+                elif token.strip():
+                    streams = int(token)
+        except ValueError:
+            return 1
+        return max(1, streams)
+    
+    def getPoolMinSize(self):
+        """
+        @return: Number of db and backend connections to open in the background on startup
+        @rtype: int
+        """
+        try:
+            return max(0, int(self.get('pool_min_size')))
+        except (TypeError, ValueError):
+            return 0
+
+    def getPoolMaxSize(self):
+        """
+        @return: Max number of db and backend connections open at once. None for unbounded
+                 which is the default.
+        @rtype: int
+        """
+        try:
+            maxSize = int(self.get('pool_max_size'))
+        except (TypeError, ValueError):
+            return None
+        if maxSize <= 0:
+            return None
+        return maxSize
+        
     def get(self, tag):
         if self.d.has_key(tag):
             return self.d[tag]
@@ -115,8 +161,12 @@ class MythSettings(object):
             'mysql_password'             : 'change_me',
             'mysql_encoding_override'    : 'latin1',
             'streaming_enabled'          : 'True',
+            'transfer_streams'           : '1',
+            'pool_min_size'              : '2',
+            'pool_max_size'              : '0',
             'paths_recordedprefix'       : self.platform.getDefaultRecordingsDir(),
             'aggressive_caching'         : 'True',
+            'guide_mirror_enabled'       : 'False',
             'recorded_view_by'           : '2', 
             'upcoming_view_by'           : '2',
             'confirm_on_delete'          : 'True',
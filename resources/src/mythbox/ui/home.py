@@ -23,10 +23,12 @@ import mythbox.msg as m
 
 from mythbox import pool
 from mythbox.bus import Event
-from mythbox.mythtv.db import MythDatabaseFactory
-from mythbox.mythtv.domain import StatusException
+from mythbox.mythtv.db import MythDatabaseFactory, queryStats, settingsSnapshot, markupCache
+from mythbox.mythtv.domain import StatusException, JobQueue
+from mythbox.mythtv import mirror
 from mythbox.mythtv.enums import JobStatus, JobType
-from mythbox.mythtv.conn import inject_conn, inject_db, ConnectionFactory
+from mythbox.mythtv.mirror import GuideMirror
+from mythbox.mythtv.conn import inject_conn, inject_db, ConnectionFactory, createSlavePool
 from mythbox.settings import SettingsException
 from mythbox.ui.player import MountedPlayer, TrackingCommercialSkipper,\
     StreamingPlayer, NoOpCommercialSkipper
@@ -55,7 +57,10 @@ class HomeWindow(BaseWindow):
         self.t = self.translator.get
         self.lastFocusId = None
         self.shutdownPending = False
+        self.warmUps = []
         self.bus.register(self)
+        self.bus.register(settingsSnapshot, firstDibs=True)
+        self.bus.register(markupCache, firstDibs=True)
         
     def onFocus(self, controlId):
         log.debug('lastfocusid = %s' % controlId)
@@ -175,8 +180,14 @@ class HomeWindow(BaseWindow):
                 return False
             
         if self.settingsOK:
-            pool.pools['dbPool'] = pool.EvictingPool(MythDatabaseFactory(**self.deps), maxAgeSecs=10*60, reapEverySecs=10)
-            pool.pools['connPool'] = pool.Pool(ConnectionFactory(**self.deps))
+            maxSize = self.settings.getPoolMaxSize()
+            pool.pools['dbPool'] = pool.EvictingPool(MythDatabaseFactory(**self.deps), maxAgeSecs=10*60, reapEverySecs=60, validateAfterSecs=30, maxSize=maxSize, timeout=60)
+            pool.pools['connPool'] = pool.Pool(ConnectionFactory(**self.deps), validateAfterSecs=30, maxSize=maxSize, timeout=60)
+            pool.pools['slavePool'] = createSlavePool()
+            
+            # open connections in the background so the first windows don't have to wait for them
+            minSize = self.settings.getPoolMinSize()
+            self.warmUps = [pool.WarmUp(pool.pools[name], minSize, name).start() for name in ('dbPool', 'connPool')]
             
             self.dumpBackendInfo()
             
@@ -185,6 +196,11 @@ class HomeWindow(BaseWindow):
             
             self.mythThumbnailCache.reap()
 
+            if self.settings.isGuideMirrorEnabled():
+                mirror.guideMirror = GuideMirror(self.platform)
+                self.bus.register(mirror.guideMirror)
+                mirror.guideMirror.syncInBackground()
+
             
         return self.settingsOK
         
@@ -204,6 +220,10 @@ class HomeWindow(BaseWindow):
         self.shutdownPending = True
         self.setBusy(True)
         self.bus.deregister(self)
+        self.bus.deregister(settingsSnapshot)
+        self.bus.deregister(markupCache)
+        if mirror.guideMirror:
+            self.bus.deregister(mirror.guideMirror)
         try:
             self.settings.save()
         except:
@@ -220,24 +240,13 @@ class HomeWindow(BaseWindow):
         except:
             log.exception('shutting down publisher')
             
-        xbmc.log('Before reaping')
+        xbmc.log('Before waiting for workers')
         
         try:
-            # HACK ALERT:
-            #   Pool reaper thread is @run_async so we need to 
-            #   allow it to die before we start waiting for the 
-            #   worker threads to exit in waitForWorkersToDie(). 
-            #   pool.shutdown() is the normal way to do it but we can't shut
-            #   down the pools until theads (which may have 
-            #   refs to pooled resources) have all exited.
-            #   
-            # TODO: 
-            #   Fix is to refactor EvictingPool to not use
-            #   the @run_async decorator
-            
-            #for (poolName, poolInstance) in pool.pools.items():
-            #    poolInstance.stopReaping = True
-            pool.pools['dbPool'].stopReaping = True
+            # pools can't be shut down until threads (which may have refs 
+            # to pooled resources) have all exited.
+            for warmUp in self.warmUps:
+                warmUp.cancel()
             
             if hasPendingWorkers():
                 waitForWorkersToDie(30.0) # in seconds
@@ -246,10 +255,16 @@ class HomeWindow(BaseWindow):
 
         xbmc.log('Before pools')
         try:
+            if mirror.guideMirror:
+                mirror.guideMirror.close()
+                
             # print pool stats and shutdown
             for (poolName, poolInstance) in pool.pools.items():
                 log.info('Pool %s: available = %d  size = %d' % (poolName, poolInstance.available(), poolInstance.size()))
+                log.info('Pool %s stats: %s' % (poolName, poolInstance.stats()))
                 poolInstance.shutdown()
+            for (name, stats) in sorted(queryStats().items()):
+                log.info('Query %s stats: %s' % (name, stats))
         except:
             log.exception('Error while shutting down')
 
@@ -364,15 +379,23 @@ class HomeWindow(BaseWindow):
         
     @run_async
     @catchall
+    @inject_conn
     @coalesce
     def renderTuners(self):
         tuners = self.domainCache.getTuners()
         
-        for t in tuners:
+        # query every tuner in one round trip to the backend instead of one per tuner
+        tvState = self.conn().protocol.tvState()
+        busy = (tvState.WatchingLiveTV, tvState.WatchingRecording, tvState.RecordingOnly)
+        pipeline = self.conn().pipeline()
+        statuses = map(pipeline.getTunerStatus, tuners)
+        recordings = [pipeline.getCurrentRecording(t) if s.result() in busy else None for t, s in zip(tuners, statuses)]
+        
+        for t, s, r in zip(tuners, statuses, recordings):
             t.listItem = xbmcgui.ListItem()
             self.setListItemProperty(t.listItem, 'tuner', '%s %s' % (t.tunerType, t.tunerId))
             self.setListItemProperty(t.listItem, 'hostname', t.hostname)
-            self.setListItemProperty(t.listItem, 'status', t.formattedTunerStatus())
+            self.setListItemProperty(t.listItem, 'status', t.formattedTunerStatus(s.result(), r and r.result()))
 
         if len(tuners) > 2:    
             
@@ -412,19 +435,21 @@ class HomeWindow(BaseWindow):
     @coalesce
     def renderJobs(self):
         t = self.translator.get
-        running = self.db().getJobs(program=None, jobType=None, jobStatus=JobStatus.RUNNING)
-        queued = self.db().getJobs(program=None, jobType=None, jobStatus=JobStatus.QUEUED)
+        jobQueue = JobQueue.load(self.db(), self.domainCache)
+        running = jobQueue.running
+        queued = jobQueue.queued
         listItems = []
 
         def getTitle(job):
-            if job.getProgram(): 
-                return job.getProgram().title()
+            program = jobQueue.getProgram(job)
+            if program: 
+                return program.title()
             else:
                 return t(m.UNKNOWN)
 
         def getJobStats(job):
             if job.jobStatus == JobStatus.QUEUED:
-                position, numJobs = job.getPositionInQueue() 
+                position, numJobs = jobQueue.getPositionInQueue(job) 
                 return t(m.QUEUED_N_OF_M) % (position, numJobs)
             elif job.jobStatus == JobStatus.RUNNING:
                 try:
@@ -435,7 +460,7 @@ class HomeWindow(BaseWindow):
                 return job.formattedJobStatus()
         
         def getHostInfo(job):
-            commFlagBackend = self.db().toBackend(job.hostname)
+            commFlagBackend = jobQueue.getBackend(job)
             return [u'', u' %s %s' % (t(m.ON), commFlagBackend.hostname)][commFlagBackend.slave] 
             
         i = 1    
@@ -27,6 +27,7 @@ import xbmc
 import xbmcgui
 import mythbox.msg as m
 
+from mythbox.mythtv.db import inject_db, FramerateCache, markupCache
 from mythbox.ui.recordingdetails import RecordingDetailsWindow
 from mythbox.ui.toolkit import window_busy, BaseWindow, Action
 from mythbox.util import catchall_ui, run_async, timed, catchall, coalesce, safe_str
@@ -43,7 +44,7 @@ ID_SORT_BY_BUTTON         = 251
 ID_RECORDING_GROUP_BUTTON = 253
 
 TITLE_SORT_BY = odict.odict([
-    ('Date',           {'translation_id': m.DATE,          'reverse':True,  'sorter' : lambda r: r.starttimeAsTime() }), 
+    ('Date',           {'translation_id': m.DATE,          'reverse':True,  'sorter' : lambda r: r.dateSortKey() }), 
     ('Title',          {'translation_id': m.TITLE,         'reverse':False, 'sorter' : lambda r: '%s%s' % (safe_str(r.title()), r.originalAirDate())}), 
     ('Orig. Air Date', {'translation_id': m.ORIG_AIR_DATE, 'reverse':True,  'sorter' : lambda r: r.originalAirDate()})])
 
@@ -86,6 +87,7 @@ class RecordingsWindow(BaseWindow):
 
         self.t = self.translator.get
         self.programs = []                       # [RecordedProgram]
+        self.firstScreenful = 25                 # recordings to render before the rest have arrived
         self.allGroupTitle = self.t(m.ALL_RECORDINGS)
         self.activeRenderToken = None
         self.groupsByTitle = odict.odict()       # {unicode:Group}
@@ -218,20 +220,52 @@ class RecordingsWindow(BaseWindow):
             finally:
                 log.debug('--- PRECACHE %d THUMBNAILS END ---' % len(self.programs))
 
+    @run_async
+    @coalesce
+    @inject_db
+    def preCacheFramerates(self):
+        try:
+            added = FramerateCache.resolve(self.platform, self.db(), self.programs[:])
+            log.debug('Cached framerates of %d recordings' % added)
+        except:
+            log.exception('Caching framerates')
+
+    @run_async
+    @coalesce
+    @inject_db
+    def preCacheMarkup(self):
+        # so playback and the recording details window find commercial breaks already loaded
+        try:
+            markupCache.load(self.db())
+        except:
+            log.exception('Caching markup')
+
     @window_busy
     def refresh(self, force=False):
         self.dirty = False
-        self.programs = self.domainCache.getAllRecordings(force=force)
+        self.programs = self.domainCache.getAllRecordings(force=force, firstBatch=self.firstScreenful, onFirstBatch=self.renderFirstScreenful)
         
         if not self.programs:
             xbmcgui.Dialog().ok(self.t(m.INFO), self.t(m.NO_RECORDINGS_FOUND))
             self.close()
             return
-        self.programs.sort(key=TITLE_SORT_BY[self.titleSortBy]['sorter'], reverse=TITLE_SORT_BY[self.titleSortBy]['reverse'])
         
         self.sameBackgroundCache.clear()
         self.preCacheThumbnails()
+        self.preCacheFramerates()
+        self.preCacheMarkup()
+
+        self.groupPrograms()
+        self.render()
 
+    def renderFirstScreenful(self, programs):
+        """Show the recordings received so far while the rest are still coming from the backend"""
+        self.programs = programs
+        self.groupPrograms()
+        self.render()
+
+    def groupPrograms(self):
+        self.programs.sort(key=TITLE_SORT_BY[self.titleSortBy]['sorter'], reverse=TITLE_SORT_BY[self.titleSortBy]['reverse'])
         self.groupsByTitle.clear()
         self.groupsByTitle[self.allGroupTitle] = allRecordingsGroup = Group(self.allGroupTitle)
         [allRecordingsGroup.add(p) for p in self.programs]
@@ -240,8 +274,6 @@ class RecordingsWindow(BaseWindow):
             if not p.title() in self.groupsByTitle:
                 self.groupsByTitle[p.title()] = Group(p.title())
             self.groupsByTitle[p.title()].add(p)
-             
-        self.render()
     
     def applyGroupSort(self):
         self.titleSortBy = 'Date'
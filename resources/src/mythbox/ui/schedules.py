@@ -39,7 +39,7 @@ ID_SORT_BY_BUTTON = 251
 
 SORT_BY = odict.odict([
     ('Title',          {'translation_id': m.TITLE,              'sorter' : lambda rs: safe_str(rs.title())                                 }), 
-    ('# Recorded',     {'translation_id': m.NUM_RECORDED,       'sorter' : lambda rs: '%05d %s' % (rs.numRecorded(), safe_str(rs.title())) }), 
+    ('# Recorded',     {'translation_id': m.NUM_RECORDED,       'sorter' : lambda rs: '%05d %s' % (rs.numRecorded() or 0, safe_str(rs.title())) }), 
     ('Priority',       {'translation_id': m.RECORDING_PRIORITY, 'sorter' : lambda rs: '%05d %s' % (rs.getPriority(), safe_str(rs.title())) })])
 
 
@@ -129,6 +129,27 @@ class SchedulesWindow(BaseWindow):
         self.schedules = self.domainCache.getRecordingSchedules(force=force)
         self.applySort()
         self.render()
+        self.renderNumRecorded(force)
+        
+    @run_async
+    @catchall
+    @inject_db
+    def renderNumRecorded(self, force):
+        """Counting recordings of every title is slow so fill in counts after the schedules are on screen"""
+        # oldrecorded titles can differ from the schedule's in case and surrounding whitespace
+        key = lambda title: (title or u'').lower().strip()
+        counts = {}
+        for title, count in self.domainCache.getRecordedCounts(force=force):
+            counts[key(title)] = counts.get(key(title), 0) + count
+        for s in self.schedules:
+            s.setNumRecorded(counts.get(key(s.title()), 0))
+        if self.closed or xbmc.abortRequested:
+            return
+        if self.sortBy == '# Recorded':
+            self.applySort()
+        else:
+            for s, li in self.listItemsBySchedule.items():
+                self.setListItemProperty(li, 'numRecorded', '%s' % s.numRecorded())
         
     def render(self):
         log.debug('Rendering....')
@@ -144,7 +165,8 @@ class SchedulesWindow(BaseWindow):
                 self.setListItemProperty(li, 'priority', '%s' % s.getPriority())
                 self.setListItemProperty(li, 'poster', 'loading.gif')
                 self.setListItemProperty(li, 'index', str(i+1))
-                self.setListItemProperty(li, 'numRecorded', '%s' % s.numRecorded())                
+                if s.numRecorded() is not None:
+                    self.setListItemProperty(li, 'numRecorded', '%s' % s.numRecorded())
 
                 # protect against deleted channels/tuners
                 if s.getChannelId() in self.channelsById:
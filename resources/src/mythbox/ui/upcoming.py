@@ -27,7 +27,6 @@ import mythbox.msg as m
 
 from mythbox.mythtv.conn import inject_conn
 from mythbox.mythtv.db import inject_db
-from mythbox.mythtv.domain import Channel
 from mythbox.ui.schedules import ScheduleDialog
 from mythbox.ui.toolkit import BaseWindow, window_busy, Action
 from mythbox.util import catchall_ui, run_async, catchall
@@ -43,9 +42,9 @@ ONE_DAY = datetime.timedelta(days=1)
 ONE_WEEK = datetime.timedelta(weeks=1)
 
 SORT_BY = odict.odict([
-    ('Date',   {'translation_id': m.DATE,    'sorter' : lambda x: x.starttimeAsTime() }), 
-    ('Title',  {'translation_id': m.TITLE,   'sorter' : lambda x: '%s %s' % (x.title(), x.starttimeAsTime())}),
-    ('Channel',{'translation_id': m.CHANNEL, 'sorter' : lambda x: Channel.sortableChannelNumber(x.getChannelNumber(), 0)})])
+    ('Date',   {'translation_id': m.DATE,    'sorter' : lambda x: x.dateSortKey() }), 
+    ('Title',  {'translation_id': m.TITLE,   'sorter' : lambda x: x.titleSortKey()}),
+    ('Channel',{'translation_id': m.CHANNEL, 'sorter' : lambda x: x.channelSortKey()})])
 
 class UpcomingRecordingsWindow(BaseWindow):
     
@@ -1,4 +1,12 @@
 
+import os
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on windows
+
 from os.path import join, exists, abspath
 from os import getcwd
 
@@ -18,3 +26,32 @@ def getLogger(loggerName):
     if not logger.handlers:
         logging.basicConfig()
     return logger
+
+def peakMemoryKB(func, *args):
+    """
+    @return: peak resident set growth in KB of running func in a forked child
+    @note: callers should check hasattr(os, 'fork') first since there's no fork on windows
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(r)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            func(*args)
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, '%d' % (after - before))
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            # never fall back into the caller, the child would go on to run the rest of the tests
+            os._exit(status)
+    os.close(w)
+    result = os.read(r, 64)
+    os.close(r)
+    status = os.waitpid(pid, 0)[1]
+    if status != 0:
+        raise Exception('%s failed in forked child with status %d' % (func, status))
+    return int(result)
@@ -18,18 +18,29 @@
 #
 import logging
 import os
+import Queue
+import shutil
+import socket
 import tempfile
+import threading
+import time
 import unittest2 as unittest
 
 from mockito import Mock
+from mockito.mockito import when
+from mythbox import pool
 from mythbox.bus import EventBus
 from mythbox.mythtv.enums import Upcoming
-from mythbox.mythtv.conn import Connection, EventConnection, createChainId, ServerException
+from mythbox.mythtv import protocol
+from mythbox.mythtv.conn import Connection, EventConnection, FileTransfer, MessageReader, createChainId, parallelCopy, ProtocolVersionCache, ServerException, TransferCheckpoint
+from mythbox.mythtv.domain import Backend, RecordedProgram, Tuner
 from mythbox.mythtv.db import MythDatabase
 from mythbox.mythtv.protocol import ProtocolException
 from mythbox.platform import getPlatform
+from mythbox.pool import KeyedPool, Pool
 from mythbox.settings import MythSettings
 from mythbox.util import OnDemandConfig
+from mythboxtest import TEST_PROTOCOL, peakMemoryKB
 
 log = logging.getLogger('mythbox.unittest')
 
@@ -41,6 +52,505 @@ class FunctionsTest(unittest.TestCase):
         self.assertTrue(chainId is not None) 
 
 
+class CannedSocket(object):
+    """Replays a canned reply in chunks no larger than chunkSize like a real socket would"""
+    
+    def __init__(self, data, chunkSize=65536):
+        self.data = data
+        self.chunkSize = chunkSize
+        self.pos = 0
+        self.sent = []
+        
+    def recv(self, numBytes):
+        n = min(numBytes, self.chunkSize, len(self.data) - self.pos)
+        chunk = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return chunk
+    
+    def recv_into(self, buf, numBytes):
+        chunk = self.recv(numBytes)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+def cannedReply(fields):
+    msg = protocol.separator.join(fields).encode('utf-8')
+    return '%-8d%s' % (len(msg), msg)
+
+
+def legacyReadMsg(s):
+    """Pre-MessageReader implementation of Connection._readMsg() kept around to benchmark against"""
+    
+    def recv_all(s, bytes):
+        b = ''
+        while len(b) < bytes:
+            new = s.recv(bytes - len(b))
+            if new == '':
+                break
+            b += new
+        return b
+
+    retMsg = recv_all(s, 8)
+    reply = u''
+    if retMsg.upper() == u'OK':
+        return u'OK'
+    n = 0
+    if len(retMsg) > 0:
+        n = int(retMsg)
+    i = 0
+    while i < n:
+        r = recv_all(s, n - i)
+        reply += r.decode('utf-8')
+        i += len(r)
+    return reply.split(protocol.separator)
+
+
+class MessageReaderTest(unittest.TestCase):
+
+    def test_read_When_reply_has_multiple_fields_Then_split_on_separator(self):
+        fields = [u'3', u'Seinfeld', u'The Soup Nazi \u00e9', u'']
+        reader = MessageReader(initialSize=4)
+        self.assertEqual(fields, reader.read(CannedSocket(cannedReply(fields), chunkSize=3)))
+        
+    def test_read_When_buffer_reused_across_replies_Then_no_stale_data(self):
+        reader = MessageReader()
+        self.assertEqual([u'a' * 1000], reader.read(CannedSocket(cannedReply([u'a' * 1000]))))
+        self.assertEqual([u'b', u'c'], reader.read(CannedSocket(cannedReply([u'b', u'c']))))
+        
+    def test_read_When_remote_end_closes_early_Then_return_what_was_received(self):
+        data = cannedReply([u'abc', u'def'])
+        self.assertEqual([u'abc', u'd'], MessageReader().read(CannedSocket(data[:-2])))
+
+    def test_iterFields_When_separator_straddles_chunks_Then_fields_match_read(self):
+        fields = [u'1', u'Title \u00e9\u00e9', u'', u'x' * 300, u'end']
+        data = cannedReply(fields)
+        for chunkSize in (1, 2, 3, 5, 7, 64, 1024):
+            reader = MessageReader(initialSize=16)
+            self.assertEqual(fields, list(reader.iterFields(CannedSocket(data, chunkSize))))
+            
+    def test_iterFields_When_closed_before_exhausted_Then_remainder_of_reply_drained(self):
+        data = cannedReply([u'%d' % i for i in xrange(1000)]) + cannedReply([u'next', u'reply'])
+        sock = CannedSocket(data, chunkSize=100)
+        reader = MessageReader(initialSize=64)
+        fields = reader.iterFields(sock)
+        self.assertEqual(u'0', fields.next())
+        self.assertEqual(u'1', fields.next())
+        fields.close()
+        self.assertEqual([u'next', u'reply'], reader.read(sock))
+
+    def test_read_performance_against_multi_megabyte_reply(self):
+        # ~5000 recordings worth of QUERY_RECORDINGS reply
+        fields = [u'5000']
+        for i in xrange(5000):
+            fields.extend([u'Title %d' % i, u'Subtitle', u'Description ' * 10] + [u'%d' % i] * 40)
+        data = cannedReply(fields)
+        
+        t1 = time.time()
+        legacy = legacyReadMsg(CannedSocket(data))
+        t2 = time.time()
+        reader = MessageReader()
+        current = reader.read(CannedSocket(data))
+        t3 = time.time()
+        self.assertEqual(legacy, current)
+        
+        log.info('Reply of %d bytes read in %2.3f secs (legacy %2.3f secs)' % (len(data), t3 - t2, t2 - t1))
+        if hasattr(os, 'fork'):
+            log.info('Peak memory growth %d KB (legacy %d KB)' % (
+                peakMemoryKB(MessageReader().read, CannedSocket(data)),
+                peakMemoryKB(legacyReadMsg, CannedSocket(data))))
+        
+
+def unconnectedConnection(cmdSock=None):
+    """@return: Connection wired straight to the given socket, bypassing db_init()/connect()"""
+    conn = Connection.__new__(Connection)
+    conn.settings = Mock()
+    conn.translator = Mock()
+    conn.platform = Mock()
+    conn.protocol = TEST_PROTOCOL
+    conn._db = None
+    conn.reader = MessageReader()
+    conn.cmdSock = cmdSock
+    return conn
+
+
+class FakeFileTransferBackend(object):
+    """
+    Serves QUERY_FILETRANSFER REQUEST_BLOCK and SEEK for an in-memory file over a pair 
+    of local sockets the way mythbackend does: block data goes out on the data socket 
+    followed by the reply on the command socket. Requests are processed in order, each
+    no earlier than latency secs after it was sent to simulate a slow link. When given,
+    bandwidth caps the bytes/sec sent over the data socket and dropAfter is the number 
+    of bytes sent before the backend goes away mid-transfer.
+    """
+    
+    def __init__(self, data, latency=0, bandwidth=None, dropAfter=None):
+        self.data = data
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.dropAfter = dropAfter
+        self.sent = 0
+        self.pos = 0
+        self.requests = []
+        self.commandSocket, self._commandSocket = socket.socketpair()
+        self.dataSocket, self._dataSocket = socket.socketpair()
+        self._queue = Queue.Queue()
+        self._threads = [threading.Thread(target=target) for target in (self._receive, self._process)]
+        for t in self._threads:
+            t.setDaemon(True)
+            t.start()
+        
+    def _receive(self):
+        reader = MessageReader()
+        while True:
+            msg = reader.read(self._commandSocket)
+            self._queue.put((time.time(), msg))
+            if msg == [u'']:
+                break
+    
+    def _reply(self, fields):
+        self._commandSocket.sendall(cannedReply(fields))
+        
+    def _process(self):
+        while True:
+            sent, msg = self._queue.get()
+            if msg == [u'']:
+                self._dataSocket.close()
+                break
+            time.sleep(max(0, sent + self.latency - time.time()))
+            self.requests.append(msg[1])
+            if msg[1] == 'REQUEST_BLOCK':
+                if self.dropAfter is not None and self.sent >= self.dropAfter:
+                    self._dataSocket.close()
+                    self._commandSocket.close()
+                    break
+                block = self.data[self.pos:self.pos + int(msg[2])]
+                self.sent += len(block)
+                self.pos += len(block)
+                if self.bandwidth:
+                    time.sleep(len(block) / float(self.bandwidth))
+                self._dataSocket.sendall(block)
+                self._reply([u'%d' % len(block)])
+            elif msg[1] == 'SEEK':
+                self.pos = TEST_PROTOCOL.readLong(msg[2:4])
+                reply = []
+                TEST_PROTOCOL.writeLong(self.pos, reply)
+                self._reply(reply)
+                
+    def close(self):
+        self.commandSocket.close()
+        self.dataSocket.close()
+        for t in self._threads:
+            t.join(5)
+
+
+class FileTransferTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        self.dest = tempfile.TemporaryFile()
+        
+    def tearDown(self):
+        self.dest.close()
+        
+    def transfer(self, backend, **kwargs):
+        return FileTransfer(unconnectedConnection(), backend.commandSocket, '1', backend.dataSocket, **kwargs)
+        
+    def contents(self):
+        self.dest.seek(0)
+        return self.dest.read()
+    
+    def checkpoint(self, path, numBytes, numRanges):
+        return TransferCheckpoint.create(path + '.checkpoint', ('myth://host/file.mpg', 'host', numBytes), numBytes, numRanges)
+        
+    def test_copyTo_When_file_spans_many_blocks_Then_copy_identical(self):
+        backend = FakeFileTransferBackend(self.data)
+        try:
+            transfer = self.transfer(backend, blockSize=100000)
+            transfer.minBlockSize = 100000
+            transfer.maxBlockSize = 300000
+            self.assertEqual(len(self.data), transfer.copyTo(self.dest, len(self.data)))
+            self.assertEqual(self.data, self.contents())
+            self.assertTrue(backend.requests.count('REQUEST_BLOCK') > 10)
+        finally:
+            backend.close()
+
+    def test_copyTo_When_numBytes_past_eof_Then_stop_at_eof(self):
+        backend = FakeFileTransferBackend(self.data)
+        try:
+            transfer = self.transfer(backend, blockSize=1024 * 1024)
+            self.assertEqual(len(self.data), transfer.copyTo(self.dest, len(self.data) + 5 * 1024 * 1024))
+            self.assertEqual(self.data, self.contents())
+        finally:
+            backend.close()
+
+    def test_seek_Then_copy_from_offset(self):
+        backend = FakeFileTransferBackend(self.data)
+        try:
+            transfer = self.transfer(backend)
+            transfer.seek(1000)
+            self.assertEqual(500, transfer.copyTo(self.dest, 500))
+            self.assertEqual(self.data[1000:1500], self.contents())
+        finally:
+            backend.close()
+
+    def test_copyTo_When_backend_stalls_Then_socket_timeout(self):
+        backend = FakeFileTransferBackend(self.data, latency=1)
+        try:
+            backend.dataSocket.settimeout(0.1)
+            transfer = self.transfer(backend)
+            self.assertRaises(socket.timeout, transfer.copyTo, self.dest, 500)
+        finally:
+            backend.close()
+
+    def test_transferFile_When_copy_fails_Then_transfer_closed(self):
+        backend = FakeFileTransferBackend(self.data)
+        try:
+            conn = unconnectedConnection()
+            reply = [u'1']
+            TEST_PROTOCOL.writeLong(len(self.data), reply)
+            conn.annFileTransfer = lambda hostname, backendPath: (reply, backend.dataSocket)
+            dest = os.path.join(tempfile.gettempdir(), 'nonexistent_dir', 'file.mpg')
+            self.assertRaises(IOError, conn._transferFile, Backend('host', '127.0.0.1', '6543', True), backend.commandSocket, 'file.mpg', dest, 1024)
+            self.assertRaises(socket.error, backend.dataSocket.recv, 1)
+        finally:
+            backend.close()
+
+    def test_copyTo_performance_of_windowed_vs_one_block_at_a_time(self):
+        elapsed = {}
+        for window in (1, 2):
+            backend = FakeFileTransferBackend(self.data, latency=0.02)
+            try:
+                transfer = self.transfer(backend, blockSize=128 * 1024, window=window)
+                transfer.maxBlockSize = 128 * 1024
+                self.dest.seek(0)
+                start = time.time()
+                transfer.copyTo(self.dest, len(self.data))
+                elapsed[window] = time.time() - start
+                self.assertEqual(self.data, self.contents())
+            finally:
+                backend.close()
+        log.info('%d bytes over a 20ms link: one block at a time %2.2f secs, windowed %2.2f secs' % (len(self.data), elapsed[1], elapsed[2]))
+        
+    def test_parallelCopy_When_split_across_streams_Then_reassembled_copy_identical(self):
+        for numStreams, numBytes in ((3, len(self.data)), (4, len(self.data) - 1001), (5, 3)):
+            backends = [FakeFileTransferBackend(self.data) for i in xrange(numStreams)]
+            dest = tempfile.NamedTemporaryFile(delete=False)
+            dest.close()
+            try:
+                checkpoint = self.checkpoint(dest.name, numBytes, numStreams)
+                self.assertTrue(parallelCopy([self.transfer(b) for b in backends], dest.name, checkpoint))
+                self.assertEqual(self.data[:numBytes], open(dest.name, 'rb').read())
+            finally:
+                os.remove(dest.name)
+                checkpoint.remove()
+                for b in backends:
+                    b.close()
+
+    def test_parallelCopy_performance_against_single_stream(self):
+        bandwidth = 4 * 1024 * 1024   # per stream
+        elapsed = {}
+        for numStreams in (1, 4):
+            backends = [FakeFileTransferBackend(self.data, latency=0.005, bandwidth=bandwidth) for i in xrange(numStreams)]
+            dest = tempfile.NamedTemporaryFile(delete=False)
+            dest.close()
+            try:
+                start = time.time()
+                checkpoint = self.checkpoint(dest.name, len(self.data), numStreams)
+                self.assertTrue(parallelCopy([self.transfer(b) for b in backends], dest.name, checkpoint))
+                elapsed[numStreams] = time.time() - start
+                self.assertEqual(self.data, open(dest.name, 'rb').read())
+            finally:
+                os.remove(dest.name)
+                checkpoint.remove()
+                for b in backends:
+                    b.close()
+        log.info('%d bytes at %d bytes/sec per stream: 1 stream %2.2f secs, 4 streams %2.2f secs (%2.1fx)' % (
+            len(self.data), bandwidth, elapsed[1], elapsed[4], elapsed[1] / elapsed[4]))
+
+    def test_parallelCopy_When_backend_drops_mid_transfer_Then_retry_resumes_from_checkpoint(self):
+        dest = tempfile.NamedTemporaryFile(delete=False)
+        dest.close()
+        checkpoint = self.checkpoint(dest.name, len(self.data), 2)
+        try:
+            backends = [FakeFileTransferBackend(self.data, dropAfter=1024 * 1024), FakeFileTransferBackend(self.data)]
+            transfers = [self.transfer(b, blockSize=128 * 1024) for b in backends]
+            for t in transfers:
+                t.maxBlockSize = 128 * 1024
+            try:
+                try:
+                    self.assertFalse(parallelCopy(transfers, dest.name, checkpoint))
+                except socket.error:
+                    pass # depending on timing the drop is seen as a short block or a reset
+            finally:
+                for b in backends:
+                    b.close()
+
+            resumed = TransferCheckpoint.load(checkpoint.path, checkpoint.identity)
+            self.assertEqual([0], resumed.remaining())
+            self.assertTrue(0 < resumed.bytesRemaining() < len(self.data) / 2)
+
+            backend = FakeFileTransferBackend(self.data)
+            try:
+                self.assertTrue(parallelCopy([self.transfer(backend)], dest.name, resumed))
+                self.assertEqual(['SEEK'], [r for r in backend.requests if r != 'REQUEST_BLOCK'])
+                self.assertEqual(resumed.bytesRemaining(), 0)
+                self.assertEqual(self.data, open(dest.name, 'rb').read())
+            finally:
+                backend.close()
+        finally:
+            os.remove(dest.name)
+            checkpoint.remove()
+
+    def test_load_When_checkpoint_for_different_backend_file_Then_none(self):
+        dest = tempfile.NamedTemporaryFile(delete=False)
+        dest.close()
+        checkpoint = self.checkpoint(dest.name, 1000, 1)
+        try:
+            checkpoint.save()
+            self.assertEqual(checkpoint.ranges, TransferCheckpoint.load(checkpoint.path, checkpoint.identity).ranges)
+            self.assertTrue(TransferCheckpoint.load(checkpoint.path, ('myth://host/file.mpg', 'host', 999)) is None)
+            self.assertTrue(TransferCheckpoint.load(dest.name + '.bogus', checkpoint.identity) is None)
+        finally:
+            os.remove(dest.name)
+            checkpoint.remove()
+        
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = unconnectedConnection()
+        self.tuners = [Tuner(i, 'host', 1000, 1000, 'HDHOMERUN', Mock()) for i in (1, 2, 3)]
+        
+    def test_flush_When_many_requests_queued_Then_sent_in_one_write_and_replies_matched_in_order(self):
+        recording = ['0'] * TEST_PROTOCOL.recordSize()
+        recording[TEST_PROTOCOL.fieldIndex()['title']] = u'Seinfeld'
+        self.conn.cmdSock = CannedSocket(cannedReply([u'0']) + cannedReply([u'1']) + cannedReply(recording) + cannedReply([u'0.1', u'0.2', u'0.3']))
+        
+        pipeline = self.conn.pipeline()
+        states = [pipeline.getTunerStatus(t) for t in self.tuners[:2]]
+        current = pipeline.getCurrentRecording(self.tuners[1])
+        load = pipeline.getLoad()
+        self.assertFalse(load.done())
+        
+        self.assertEqual(0, states[0].result())
+        self.assertTrue(load.done())
+        self.assertEqual(1, states[1].result())
+        self.assertTrue(isinstance(current.result(), RecordedProgram))
+        self.assertEqual(u'Seinfeld', current.result().title())
+        self.assertEqual({'1':u'0.1', '5':u'0.2', '15':u'0.3'}, load.result())
+        self.assertEqual(1, len(self.conn.cmdSock.sent))
+        self.assertTrue(self.conn.cmdSock.sent[0].startswith(self.conn._buildMsg(['QUERY_REMOTEENCODER 1', 'GET_STATE'])))
+        
+    def test_result_When_reply_cannot_be_decoded_Then_only_that_result_raises(self):
+        self.conn.cmdSock = CannedSocket(cannedReply([u'bogus']) + cannedReply([u'4']))
+        pipeline = self.conn.pipeline()
+        bad = pipeline.getTunerStatus(self.tuners[0])
+        good = pipeline.getTunerStatus(self.tuners[1])
+        self.assertRaises(ValueError, bad.result)
+        self.assertEqual(4, good.result())
+        
+    def test_getTunerStatus_When_not_pipelined_Then_same_as_before(self):
+        self.conn.cmdSock = CannedSocket(cannedReply([u'3']))
+        self.assertEqual(3, self.conn.getTunerStatus(self.tuners[2]))
+        self.assertEqual([self.conn._buildMsg(['QUERY_REMOTEENCODER 3', 'GET_STATE'])], self.conn.cmdSock.sent)
+
+
+class SlavePoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.created = []
+        def createPool(ipAddress):
+            factory = Mock()
+            def create():
+                self.created.append(CannedSocket(cannedReply([u'1']) + cannedReply([u'0'])))
+                return self.created[-1]
+            factory.create = create
+            return Pool(factory)
+        self.previous = pool.pools.get('slavePool')
+        pool.pools['slavePool'] = KeyedPool(createPool)
+        self.conn = unconnectedConnection()
+        self.slave = Backend('slave', '10.0.0.2', 6543, False)
+        
+    def tearDown(self):
+        if self.previous is None:
+            del pool.pools['slavePool']
+        else:
+            pool.pools['slavePool'] = self.previous
+    
+    def test_sendSlaveRequest_When_many_requests_to_slave_Then_connection_reused(self):
+        self.assertEqual([u'1'], self.conn._sendSlaveRequest(self.slave, ['QUERY_RECORDER 1', 'IS_RECORDING']))
+        self.assertEqual([u'0'], self.conn._sendSlaveRequest(self.slave, ['QUERY_RECORDER 1', 'IS_RECORDING']))
+        self.assertEqual(1, len(self.created))
+        self.assertEqual(1, pool.pools['slavePool'].available())
+
+    def test_sendSlaveRequest_When_request_fails_Then_connection_discarded(self):
+        self.conn._sendSlaveRequest(self.slave, ['QUERY_RECORDER 1', 'IS_RECORDING'])
+        def reset(numBytes):
+            raise socket.error(104, 'Connection reset by peer')
+        self.created[0].recv = reset
+        self.assertRaises(socket.error, self.conn._sendSlaveRequest, self.slave, ['QUERY_RECORDER 1', 'IS_RECORDING'])
+        self.assertEqual(0, pool.pools['slavePool'].size())
+
+
+class ProtocolVersionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        self.platform = Mock()
+        when(self.platform).getCacheDir().thenReturn(self.cacheDir)
+        self.master = Backend('master', '127.0.0.1', 6543, True)
+        self.probes = []
+        
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        
+    def probe(self):
+        self.probes.append(1)
+        return 63
+    
+    def newSession(self):
+        ProtocolVersionCache.path = None
+        ProtocolVersionCache.versions = {}
+        
+    def test_get_When_version_cached_Then_backend_probed_only_once(self):
+        self.newSession()
+        self.assertEqual(63, ProtocolVersionCache.get(self.platform, self.master, self.probe))
+        self.assertEqual(63, ProtocolVersionCache.get(self.platform, self.master, self.probe))
+        self.assertEqual(1, len(self.probes))
+        
+        self.assertEqual(63, ProtocolVersionCache.get(self.platform, Backend('master', '10.0.0.2', 6543, True), self.probe))
+        self.assertEqual(2, len(self.probes))
+
+    def test_get_When_new_session_Then_version_loaded_from_cache_dir(self):
+        self.newSession()
+        ProtocolVersionCache.get(self.platform, self.master, self.probe)
+        self.newSession()
+        self.assertEqual(63, ProtocolVersionCache.get(self.platform, self.master, self.probe))
+        self.assertEqual(1, len(self.probes))
+        
+    def test_connect_When_backend_rejects_cached_version_Then_renegotiate_with_version_from_reject(self):
+        self.newSession()
+        ProtocolVersionCache.put(self.platform, self.master, 62)
+        conn = unconnectedConnection()
+        conn.platform = self.platform
+        conn.master = self.master
+        sockets = [CannedSocket(cannedReply([u'REJECT', u'63'])), CannedSocket(cannedReply([u'ACCEPT', u'63']))]
+        opened = list(sockets)
+        conn._openSocket = lambda backend: opened.pop(0)
+        conn.getServerVersion = lambda: self.fail('Should not probe')
+        
+        self.assertTrue(conn._connectAndNegotiate(self.master) is sockets[1])
+        self.assertEqual(63, ProtocolVersionCache.get(self.platform, self.master, self.probe))
+        self.assertEqual(63, conn.protocol.version())
+        self.assertEqual([], self.probes)
+
+
 class ConnectionTest(unittest.TestCase):
 
     def setUp(self):
@@ -135,6 +645,16 @@ class ConnectionTest(unittest.TestCase):
         log.debug('Num Recordings = %s' % len(recordings))
         self.assertTrue(len(recordings) > 0)
 
+    def test_iterAllRecordings_Same_as_getAllRecordings(self):
+        streamed = list(self.conn.iterAllRecordings())
+        self.assertEquals(len(self.conn.getAllRecordings()), len(streamed))
+        
+    def test_iterAllRecordings_When_closed_early_Then_connection_still_usable(self):
+        recordings = self.conn.iterAllRecordings()
+        recordings.next()
+        recordings.close()
+        self.assertFalse(self.conn.getUptime() is None)
+
     def test_getRecordings_AllRecordingGroupsAndTitles(self):
         recordings = self.conn.getRecordings()
         log.debug('Num Recordings = %s' % len(recordings))
@@ -18,22 +18,516 @@
 #
 import datetime
 import mythbox.mythtv.protocol as protocol
+import shutil
+import tempfile
 import time
 import unittest2 as unittest
 import util_mock
 import mythboxtest
 
 from mockito import Mock
-from mythbox.mythtv.db import MythDatabase
+from mythbox.bus import Event
+from mythbox.mythtv.db import MythDatabase, Statement, PreparedStatement, SettingsSnapshot, FramerateCache, \
+    MarkupCache, columnIndex, settingsSnapshot, toFramerate
+from mythbox.mythtv.enums import JobType, MarkType, RecordingStatus
+from mythbox.mythtv.domain import Channel, TVProgram
+from mysql.connector.conversion import MySQLConverter
+from mysql.connector.errors import InternalError
 from mythbox.mythtv.domain import RecordedProgram
 from mythbox.platform import Platform
 from mythbox.settings import MythSettings
 from mythbox.util import OnDemandConfig
-from mockito.mockito import when
+from mockito.mockito import when, verify
 
 log = mythboxtest.getLogger('mythbox.unittest')
 
 
+class StatementTest(unittest.TestCase):
+
+    class FakeConn(object):
+        charset = 'utf8'
+        converter = MySQLConverter('utf8', True)
+
+    class FakeCursor(object):
+        with_rows = True
+        def __init__(self, rows):
+            self.rows = rows
+            self.executed = []
+        def execute(self, sql):
+            self.executed.append(sql)
+        def fetchall(self):
+            return self.rows
+
+    def test_bind_Converts_escapes_and_quotes_values(self):
+        s = Statement('test', u'select * from t where a = %(a)s and b = %(b)s and c = %(a)s and d like \'x%%\'')
+        ps = PreparedStatement(self.FakeConn(), s)
+        self.assertEqual(["a", "b", "a"], ps.names)
+        self.assertEqual("select * from t where a = 'it\\'s' and b = NULL and c = 'it\\'s' and d like 'x%'", ps.bind({'a': "it's", 'b': None}))
+
+    def test_bind_ListBindsAsCommaSeparatedValues(self):
+        ps = PreparedStatement(self.FakeConn(), Statement('test', 'select * from t where id in (%(ids)s)'))
+        self.assertEqual('select * from t where id in (1,2,3)', ps.bind({'ids': [1, 2, 3]}))
+        self.assertEqual('select * from t where id in (NULL)', ps.bind({'ids': []}))
+
+    def test_bind_DatetimeBindsAsQuotedTimestamp(self):
+        ps = PreparedStatement(self.FakeConn(), Statement('test', 'select * from t where d = %(d)s'))
+        self.assertEqual("select * from t where d = '2013-01-02 03:04:05'", ps.bind({'d': datetime.datetime(2013, 1, 2, 3, 4, 5)}))
+
+    def test_bind_MissingParamRaisesKeyError(self):
+        ps = PreparedStatement(self.FakeConn(), Statement('test', 'select * from t where a = %(a)s'))
+        self.assertRaises(KeyError, ps.bind, {})
+
+    def test_execute_ReturnsRowsAndRecordsCountAndTimings(self):
+        s = Statement('test', 'select * from t where a = %(a)s')
+        ps = PreparedStatement(self.FakeConn(), s)
+        cursor = self.FakeCursor([(1,), (2,)])
+        self.assertEqual([(1,), (2,)], ps.execute(cursor, {'a': 1}))
+        self.assertEqual([(1,), (2,)], ps.execute(cursor, {'a': 2}))
+        self.assertEqual(['select * from t where a = 1', 'select * from t where a = 2'], cursor.executed)
+        stats = s.stats()
+        self.assertEqual(2, stats['count'])
+        self.assertTrue(stats['maxSecs'] <= stats['totalSecs'])
+
+    def test_prepare_CachesStatementPerConnection(self):
+        db = MythDatabase.__new__(MythDatabase)
+        db.conn = self.FakeConn()
+        db._prepared = {}
+        s = Statement('test', 'select 1')
+        self.assertTrue(db.prepare(s) is db.prepare(s))
+        other = MythDatabase.__new__(MythDatabase)
+        other.conn = self.FakeConn()
+        other._prepared = {}
+        self.assertFalse(db.prepare(s) is other.prepare(s))
+
+
+class RecordRowsTest(unittest.TestCase):
+
+    guideColumns = ['chanid', 'channum', 'callsign', 'icon', 'channame', 'starttime', 'endtime', 'title', 'subtitle', 
+                    'description', 'showtype', 'originalairdate', 'category', 'category_type', 'seriesid', 'programid', 'hdtv']
+
+    class FakeCursor(object):
+        def __init__(self, columns):
+            self.description = [(c, 253, None, None, None, None, 1, 0) for c in columns]
+
+    def guideRows(self, n):
+        base = datetime.datetime(2013, 1, 1)
+        return [(1000 + i % 500, str(i % 500), 'WXYZ', None, 'NBC', base + datetime.timedelta(minutes=30 * (i / 500)), 
+                 base + datetime.timedelta(minutes=30 * (i / 500 + 1)), u'Title %d' % i, u'Subtitle', u'Description', 
+                 '', None, u'Comedy', u'series', 'EP0001', 'EP0001001', 0) for i in xrange(n)]
+
+    def test_columnIndex(self):
+        self.assertEqual({'chanid': 0, 'title': 1}, columnIndex(self.FakeCursor(['chanid', 'title'])))
+
+    def test_toRecords_SameFieldsAsToDict(self):
+        cursor = self.FakeCursor(self.guideColumns)
+        rows = self.guideRows(3)
+        records = MythDatabase.toRecords(cursor, rows)
+        for row, record in zip(rows, records):
+            d = MythDatabase.toDict(cursor, row)
+            for column in self.guideColumns:
+                self.assertEqual(d[column], record[column])
+        self.assertTrue(records[0]._index is records[-1]._index)
+
+    def test_toRecords_performance(self):
+        cursor = self.FakeCursor(self.guideColumns)
+        rows = self.guideRows(50000)
+        translator = Mock()
+
+        def viaDicts():
+            return [TVProgram(MythDatabase.toDict(cursor, row), translator) for row in rows]
+
+        def viaRecords():
+            return [TVProgram(record, translator) for record in MythDatabase.toRecords(cursor, rows)]
+
+        for build in (viaDicts, viaRecords):
+            start = time.time()
+            programs = build()
+            showsByChannel = {}
+            for p in programs:
+                showsByChannel.setdefault(p.getChannelId(), []).append(p)
+            elapsed = max(time.time() - start, 0.000001)
+            self.assertEqual(500, len(showsByChannel))
+            self.assertEqual(u'Title 49999', programs[-1].title())
+            log.debug('%s: 50k guide rows in %2.3f secs (%d rows/sec)' % (build.__name__, elapsed, len(rows) / elapsed))
+
+
+class TVGuideDataTest(unittest.TestCase):
+
+    class FakeCursor(object):
+        with_rows = True
+        def __init__(self, columns, rows):
+            self.description = [(c, 253, None, None, None, None, 1, 0) for c in columns]
+            self.rows = rows
+            self.executed = []
+            self.unread = False
+        def execute(self, sql):
+            if self.unread:
+                raise InternalError('Unread result found.')
+            self.executed.append(sql)
+            self.unread = True
+        def fetchone(self):
+            if not self.rows:
+                self.unread = False
+                return None
+            return self.rows.pop(0)
+        def __iter__(self):
+            return iter(self.fetchone, None)
+        def fetchall(self):
+            rows, self.rows, self.unread = self.rows, [], False
+            return rows
+        def _have_unread_result(self):
+            return self.unread
+        def close(self):
+            pass
+
+    class FakeConn(object):
+        charset = 'utf8'
+        converter = MySQLConverter('utf8', True)
+        def __init__(self, cursor):
+            self._cursor = cursor
+        def cursor(self, *args):
+            return self._cursor
+
+    def setUp(self):
+        self.channels = [Channel({'chanid':chanId, 'channum':str(chanId), 'callsign':'C%d' % chanId, 'name':'C', 'cardid':1}) for chanId in (1001, 1002, 1003)]
+        self.start = datetime.datetime(2013, 1, 1, 20)
+        self.end = datetime.datetime(2013, 1, 1, 22)
+
+    def db(self, rows):
+        self.cursor = self.FakeCursor(['chanid', 'starttime', 'endtime', 'title'], rows)
+        db = MythDatabase.__new__(MythDatabase)
+        db.conn = self.FakeConn(self.cursor)
+        db._prepared = {}
+        db.translator = Mock()
+        return db
+
+    def test_getTVGuideData_GroupsStreamedRowsByChannelInSqlOrder(self):
+        t = lambda h, m=0: datetime.datetime(2013, 1, 1, h, m)
+        rows = [(1001L, t(19), t(20, 30), u'a'), (1001L, t(20, 30), t(21), u'b'), (1001L, t(21), t(23), u'c'),
+                (1003L, t(20), t(22), u'd')] + [(1003L, t(21, 59), t(22, 30), u'e%d' % i) for i in xrange(1000)]
+        db = self.db(rows)
+
+        showsByChannel = db.getTVGuideData(self.start, self.end, self.channels)
+
+        self.assertEqual([u'a', u'b', u'c'], [p.title() for p in showsByChannel[self.channels[0]]])
+        self.assertEqual([], showsByChannel[self.channels[1]])
+        self.assertEqual(1001, len(showsByChannel[self.channels[2]]))
+        self.assertEqual(u'e999', showsByChannel[self.channels[2]][-1].title())
+
+    def test_streamRecords_When_consumer_stops_early_Then_unread_rows_drained(self):
+        t = lambda h: datetime.datetime(2013, 1, 1, h)
+        db = self.db([(1001L, t(19), t(20), u'a'), (1001L, t(20), t(21), u'b'), (1001L, t(21), t(22), u'c')])
+        db.cursor = self.cursor
+        records = db.streamRecords(Statement('test', 'select * from program'))
+        self.assertEqual(u'a', records.next()['title'])
+        records.close()
+        self.assertFalse(self.cursor.unread)
+        self.assertEqual([], list(db.streamRecords(Statement('test', 'select * from program'))))
+
+    def test_getTVGuideData_UsesOverlapPredicateAndSkipsZeroLengthPrograms(self):
+        db = self.db([])
+        db.getTVGuideData(self.start, self.end, self.channels)
+        sql = ' '.join(self.cursor.executed[0].split())
+        self.assertTrue("p.starttime < '2013-01-01 22:00:00' and p.endtime > '2013-01-01 20:00:00'" in sql, sql)
+        self.assertTrue('p.starttime != p.endtime' in sql, sql)
+        chanIds = sql[sql.index('c.chanid in (') + len('c.chanid in ('):].split(')')[0]
+        self.assertEqual(['1001', '1002', '1003'], sorted(chanIds.split(',')))
+
+
+class SettingsSnapshotTest(unittest.TestCase):
+
+    class FakeDatabase(MythDatabase):
+        def __init__(self, rows):
+            self._master = None
+            self._slaves = None
+            self.rows = rows
+            self.loads = 0
+        def loadSettings(self):
+            self.loads += 1
+            return self.rows
+
+    rows = [
+        ('MasterServerIP',    '10.0.0.1', None),
+        ('MasterServerPort',  '6543',     None),
+        ('UserJob1',          'job1.sh',  None),
+        ('UserJobDesc1',      'Job One',  None),
+        ('BackendServerIP',   '10.0.0.1', 'master'),
+        ('BackendServerPort', '6543',     'master'),
+        ('BackendServerIP',   '10.0.0.3', 'slave2'),
+        ('BackendServerPort', '6544',     'slave2'),
+        ('BackendServerIP',   '10.0.0.2', 'slave1'),
+        ('BackendServerPort', '6545',     'slave1'),
+        ('RecordFilePrefix',  '/myth',    'slave1')]
+
+    def setUp(self):
+        settingsSnapshot.invalidate()
+        self.db = self.FakeDatabase(self.rows)
+
+    def tearDown(self):
+        settingsSnapshot.invalidate()
+
+    def test_getMythSetting_ServedFromOneLoad(self):
+        self.assertEqual('job1.sh', self.db.getMythSetting('UserJob1'))
+        self.assertEqual('/myth', self.db.getMythSetting('RecordFilePrefix'))
+        self.assertEqual('/myth', self.db.getMythSetting('RecordFilePrefix', 'slave1'))
+        self.assertTrue(self.db.getMythSetting('RecordFilePrefix', 'slave2') is None)
+        self.assertTrue(self.db.getMythSetting('bogus') is None)
+        userJobs = self.db.getUserJobs()
+        self.assertEqual('Job One', [j for j in userJobs if j.jobType == JobType.USERJOB1][0].desc)
+        self.assertEqual(1, self.db.loads)
+
+    def test_getMythSetting_ReloadsWhenOlderThanTtl(self):
+        self.db.getMythSetting('UserJob1')
+        settingsSnapshot.loadedAt -= settingsSnapshot.ttlSecs + 1
+        self.db.getMythSetting('UserJob1')
+        self.assertEqual(2, self.db.loads)
+
+    def test_onEvent_InvalidatesOnSettingsChanges(self):
+        snapshot = SettingsSnapshot()
+        snapshot.refresh(self.db)
+        snapshot.onEvent({'id': Event.SETTING_CHANGED, 'tag': 'feeds_twitter', 'old': 'a', 'new': 'b'})
+        self.assertFalse(snapshot.isStale())
+        snapshot.onEvent({'id': Event.MYTH_SETTINGS_CHANGED})
+        self.assertTrue(snapshot.isStale())
+        snapshot.refresh(self.db)
+        snapshot.onEvent({'id': Event.SETTING_CHANGED, 'tag': 'mysql_host', 'old': 'a', 'new': 'b'})
+        self.assertTrue(snapshot.isStale())
+
+    def test_getBackends_FromSnapshot(self):
+        master = self.db.getMasterBackend()
+        self.assertEqual(('master', '10.0.0.1', 6543, True), (master.hostname, master.ipAddress, master.port, master.master))
+        slaves = self.db.getSlaveBackends()
+        self.assertEqual([('slave1', '10.0.0.2', 6545), ('slave2', '10.0.0.3', 6544)], [(s.hostname, s.ipAddress, s.port) for s in slaves])
+        self.assertTrue(all([s.slave for s in slaves]))
+        self.assertEqual(1, self.db.loads)
+
+
+def mockRecording(chanId, hour, status=RecordingStatus.RECORDED, second=0):
+    p = Mock()
+    when(p).getChannelId().thenReturn(chanId)
+    when(p).recstarttimets().thenReturn(int(time.mktime(datetime.datetime(2013, 1, 1, hour, 0, second).timetuple())))
+    when(p).getRecordingStatus().thenReturn(status)
+    return p
+
+
+class FramerateCacheTest(unittest.TestCase):
+
+    class FakeDatabase(object):
+        def __init__(self, framerates):
+            self.framerates = framerates
+            self.queries = 0
+        def getFramerates(self):
+            self.queries += 1
+            return self.framerates
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        self.platform = Mock()
+        when(self.platform).getCacheDir().thenReturn(self.cacheDir)
+        self.newSession()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+        self.newSession()
+
+    def newSession(self):
+        FramerateCache.path = None
+        FramerateCache.framerates = {}
+        FramerateCache.unresolved = {}
+
+    def program(self, chanId, hour, status=RecordingStatus.RECORDED, second=0):
+        return mockRecording(chanId, hour, status, second)
+
+    def test_toFramerate(self):
+        self.assertEqual(29.97, toFramerate(None, None))
+        self.assertEqual(29.97, toFramerate(30.1, 29.5))
+        self.assertEqual(59.94, toFramerate(60.0, 0))
+        self.assertEqual(24.0, toFramerate(23.0, 23.9))
+        self.assertEqual(50.0, toFramerate(49.0, 50.0))
+
+    def test_resolve_CachesFinishedRecordingsWithOneQueryAndPersists(self):
+        programs = [self.program(1001, 20), self.program(1002, 21), self.program(1003, 22, RecordingStatus.RECORDING)]
+        db = self.FakeDatabase({
+            (1001, datetime.datetime(2013, 1, 1, 20)): 59.94,
+            (1002, datetime.datetime(2013, 1, 1, 21)): 29.97,
+            (1003, datetime.datetime(2013, 1, 1, 22)): 24.0})
+
+        self.assertEqual(2, FramerateCache.resolve(self.platform, db, programs))
+        self.assertEqual(0, FramerateCache.resolve(self.platform, db, programs))
+        self.assertEqual(1, db.queries)
+
+        self.newSession()
+        self.assertEqual(59.94, FramerateCache.get(self.platform, programs[0]))
+        self.assertEqual(29.97, FramerateCache.get(self.platform, programs[1]))
+        self.assertTrue(FramerateCache.get(self.platform, programs[2]) is None)
+
+    def test_resolve_DropsRecordingsNoLongerPresent(self):
+        deleted, kept, new = self.program(1001, 20), self.program(1002, 21), self.program(1003, 22)
+        FramerateCache.put(self.platform, deleted, 24.0)
+        FramerateCache.put(self.platform, kept, 29.97)
+        db = self.FakeDatabase({(1003, datetime.datetime(2013, 1, 1, 22)): 59.94})
+
+        self.assertEqual(1, FramerateCache.resolve(self.platform, db, [kept, new]))
+        self.assertTrue(FramerateCache.get(self.platform, deleted) is None)
+        self.assertEqual(29.97, FramerateCache.get(self.platform, kept))
+        self.assertEqual(59.94, FramerateCache.get(self.platform, new))
+
+
+    def test_resolve_When_no_seek_marks_Then_not_cached_and_retried_later(self):
+        programs = [self.program(1001, 20), self.program(1002, 21)]
+        db = self.FakeDatabase({(1001, datetime.datetime(2013, 1, 1, 20)): 59.94})
+
+        self.assertEqual(1, FramerateCache.resolve(self.platform, db, programs))
+        self.assertEqual(0, FramerateCache.resolve(self.platform, db, programs))
+        self.assertEqual(1, db.queries)
+        self.assertTrue(FramerateCache.get(self.platform, programs[1]) is None)
+
+        # seek table built since
+        db.framerates[(1002, datetime.datetime(2013, 1, 1, 21))] = 24.0
+        FramerateCache.unresolved[FramerateCache.key(programs[1])] -= FramerateCache.retryAfterSecs + 1
+        self.assertEqual(1, FramerateCache.resolve(self.platform, db, programs))
+        self.assertEqual(24.0, FramerateCache.get(self.platform, programs[1]))
+
+
+    def test_resolve_When_recordings_differ_only_in_seconds_Then_keyed_apart(self):
+        programs = [self.program(1001, 20), self.program(1001, 20, second=30)]
+        db = self.FakeDatabase({
+            (1001, datetime.datetime(2013, 1, 1, 20, 0, 0)): 59.94,
+            (1001, datetime.datetime(2013, 1, 1, 20, 0, 30)): 24.0})
+
+        FramerateCache.resolve(self.platform, db, programs)
+        self.assertEqual(59.94, FramerateCache.get(self.platform, programs[0]))
+        self.assertEqual(24.0, FramerateCache.get(self.platform, programs[1]))
+        self.assertEqual(FramerateCache.key(programs[1]), MarkupCache.key(programs[1]))
+
+
+class MarkupCacheTest(unittest.TestCase):
+
+    def program(self, chanId, hour):
+        return mockRecording(chanId, hour)
+
+    def test_getRecordedMarkup_GroupsMarksByRecording(self):
+        t = lambda h: datetime.datetime(2013, 1, 1, h)
+        cursor = TVGuideDataTest.FakeCursor(['chanid', 'starttime', 'type', 'mark'], [
+            (1001L, t(20), 4, 100L), (1001L, t(20), 5, 200L), (1001L, t(20), 4, 300L), (1001L, t(20), 5, 400L),
+            (1002L, t(21), 4, 50L), (1002L, t(21), 5, 60L)])
+        db = MythDatabase.__new__(MythDatabase)
+        db.conn = TVGuideDataTest.FakeConn(cursor)
+        db._prepared = {}
+
+        markup = db.getRecordedMarkup()
+
+        self.assertEqual({(1001, t(20)): [(4, 100), (5, 200), (4, 300), (5, 400)], (1002, t(21)): [(4, 50), (5, 60)]}, markup)
+        self.assertTrue('type in (4,5)' in cursor.executed[0], cursor.executed[0])
+
+    def test_get_AfterOneLoad(self):
+        db = Mock()
+        when(db).getRecordedMarkup().thenReturn({(1001, datetime.datetime(2013, 1, 1, 20)): [
+            (MarkType.COMM_START, 100), (MarkType.COMM_END, 200)]})
+        cache = MarkupCache()
+        p1, p2 = self.program(1001, 20), self.program(1002, 20)
+
+        self.assertTrue(cache.get(p1) is None)
+        cache.load(db)
+        cache.load(db)
+        self.assertEqual([(MarkType.COMM_START, 100), (MarkType.COMM_END, 200)], cache.get(p1))
+        self.assertTrue(cache.get(p2) is None)
+        verify(db, 1).getRecordedMarkup()
+
+    def test_onEvent_InvalidatesOnCommFlagging(self):
+        cache = MarkupCache()
+        cache.marks = {}
+        cache.onEvent({'id': Event.SCHEDULER_RAN})
+        self.assertEqual({}, cache.marks)
+        cache.onEvent({'id': Event.COMMFLAG_START})
+        self.assertTrue(cache.marks is None)
+        cache.marks = {}
+        cache.onEvent({'id': Event.COMMFLAG_UPDATE})
+        self.assertTrue(cache.marks is None)
+
+
+class JobQueueWritesTest(unittest.TestCase):
+
+    class FakeCursor(object):
+        def __init__(self, lastrowid, ids):
+            self.lastrowid = lastrowid
+            self.ids = ids
+            self.rowcount = 0
+            self.executed = []
+        def execute(self, sql, args):
+            self.executed.append((' '.join(sql.split()), args))
+        def fetchall(self):
+            return [(id,) for id in self.ids]
+        def close(self):
+            pass
+
+    def db(self, lastrowid=None, ids=()):
+        self.cursor = self.FakeCursor(lastrowid, ids)
+        db = MythDatabase.__new__(MythDatabase)
+        db.conn = TVGuideDataTest.FakeConn(self.cursor)
+        return db
+
+    def job(self, id=None, scheduledRunTime=None):
+        job = Mock()
+        job.id, job.channelId, job.startTime, job.jobType = id, 1001, datetime.datetime(2013, 1, 1, 20), JobType.COMMFLAG
+        job.insertTime, job.hostname, job.jobStatus, job.comment = None, u'', 1, u''
+        job.scheduledRunTime = scheduledRunTime
+        return job
+
+    def test_addJobs_InsertsAllRowsInOneStatementAndAssignsIds(self):
+        db = self.db(lastrowid=40, ids=[40, 43, 44])
+        jobs = [self.job() for i in xrange(3)]
+        db.addJobs(jobs)
+        self.assertEqual(2, len(self.cursor.executed))
+        sql, args = self.cursor.executed[0]
+        self.assertEqual(3, sql.count('(%s, %s, %s, %s, %s, %s, %s, %s)'))
+        self.assertEqual(24, len(args))
+        sql, args = self.cursor.executed[1]
+        self.assertTrue(sql.startswith('select id from jobqueue where id >= %s and (chanid, starttime, type, inserttime) in ('), sql)
+        self.assertEqual(13, len(args))
+        self.assertEqual(40, args[0])
+        self.assertEqual([40, 43, 44], [job.id for job in jobs])
+
+    def test_addJobs_When_ids_not_read_back_Then_not_assigned(self):
+        db = self.db(lastrowid=40, ids=[40])
+        jobs = [self.job() for i in xrange(2)]
+        db.addJobs(jobs)
+        self.assertEqual([None, None], [job.id for job in jobs])
+
+    def test_addJobs_When_one_job_Then_lastrowid_used_without_read_back(self):
+        db = self.db(lastrowid=40)
+        job = self.job()
+        db.addJob(job)
+        self.assertEqual(1, len(self.cursor.executed))
+        self.assertEqual(40, job.id)
+
+    def test_addJobs_When_insertTime_has_microseconds_Then_truncated_to_seconds(self):
+        db = self.db(lastrowid=40, ids=[40, 41])
+        jobs = [self.job() for i in xrange(2)]
+        for job in jobs:
+            job.insertTime = datetime.datetime(2013, 1, 1, 19, 30, 15, 654321)
+        db.addJobs(jobs)
+        insertTime = datetime.datetime(2013, 1, 1, 19, 30, 15)
+        self.assertEqual([insertTime, insertTime], self.cursor.executed[0][1][3::8])
+        self.assertEqual([insertTime, insertTime], self.cursor.executed[1][1][4::4])
+        self.assertEqual([40, 41], [job.id for job in jobs])
+
+    def test_addJobs_NothingToAdd(self):
+        db = self.db()
+        db.addJobs([])
+        self.assertEqual([], self.cursor.executed)
+
+    def test_updateJobScheduledRunTimes_OneStatement(self):
+        db = self.db()
+        t1, t2 = datetime.datetime(2013, 1, 1, 20), datetime.datetime(2013, 1, 1, 21)
+        db.updateJobScheduledRunTimes([self.job(7, t1), self.job(3, t2)])
+        self.assertEqual(1, len(self.cursor.executed))
+        sql, args = self.cursor.executed[0]
+        self.assertEqual('update jobqueue set schedruntime = case id when %s then %s when %s then %s end where (id, starttime) in ((%s, %s),(%s, %s))', sql)
+        start = datetime.datetime(2013, 1, 1, 20)
+        self.assertEqual([7, t1, 3, t2, 7, start, 3, start], args)
+
+
 class MythDatabaseTest(unittest.TestCase):
 
     def setUp(self):
@@ -181,6 +675,12 @@ class MythDatabaseTest(unittest.TestCase):
         self.assertEquals(1, len(actualSchedules))
         self.assertEquals(expectedSchedule.getScheduleId(), actualSchedules.pop().getScheduleId())
 
+    def test_getRecordedCounts(self):
+        counts = self.db.getRecordedCounts()
+        for title, count in counts:
+            log.debug('%s recorded %d times' % (title, count))
+            self.assertTrue(count > 0)
+
     def test_getJobs_All(self):
         when(self.domainCache).getUserJobs().thenReturn(self.db.getUserJobs())
         jobs = self.db.getJobs()
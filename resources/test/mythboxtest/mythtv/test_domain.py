@@ -17,6 +17,7 @@
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 import datetime
+import os
 import time
 import unittest2 as unittest
 import mythboxtest
@@ -28,14 +29,16 @@ from mythbox.mythtv import protocol
 from mythbox.mythtv.protocol import protocols
 
 from mythbox.mythtv.domain import ctime2MythTime, dbTime2MythTime, Backend, \
-     Channel, CommercialBreak, Job, UserJob, TVProgram, Program, RecordedProgram, \
-     RecordingSchedule, Tuner, StatusException, frames2seconds, seconds2frames
+     Channel, CommercialBreak, Job, JobQueue, UserJob, TVProgram, Program, RecordedProgram, \
+     Record, RecordingSchedule, Tuner, StatusException, frames2seconds, seconds2frames
 
+from mythbox.mythtv.db import FramerateCache, markupCache
 from mythbox.mythtv.enums import CheckForDupesIn, CheckForDupesUsing, FlagMask, \
-     EpisodeFilter, JobStatus, JobType
+     EpisodeFilter, JobStatus, JobType, MarkType, RecordingStatus
 
 from mythbox.platform import Platform
-from mythboxtest import TEST_PROTOCOL
+from mythboxtest import TEST_PROTOCOL, peakMemoryKB
+from odict import odict
 
 log = mythboxtest.getLogger('mythbox.unittest')
  
@@ -137,6 +140,15 @@ class ChannelTest(unittest.TestCase):
         channel = Channel({'chanid':9, 'channum':'23_1', 'callsign':'WXYZ', 'name':'NBC9', 'cardid':4})
         log.debug(channel)
         self.assertTrue(channel.getIconPath() is None)
+
+    def test_constructor_Record(self):
+        index = {'chanid':0, 'channum':1, 'callsign':2, 'name':3, 'icon':4, 'cardid':5}
+        row = (9, '23_1', 'WXYZ', 'NBC9', 'none', 4)
+        channel = Channel(Record(index, row))
+        self.assertEqual(9, channel.getChannelId())
+        self.assertEqual('WXYZ', channel.getCallSign())
+        self.assertTrue(channel.getIconPath() is None)
+        self.assertEqual('none', row[4])
         
     def test_getSortableChannelNumber_When_channel_number_is_already_sortable_Then_return_channel_number(self):
         channel = Channel({'chanid':9, 'channum':'23', 'callsign':'WXYZ', 'name':'NBC9', 'cardid':4})
@@ -159,6 +171,25 @@ class ChannelTest(unittest.TestCase):
         self.assertEqual(9, number)
 
 
+class RecordTest(unittest.TestCase):
+
+    def test_tuple_values_copied_on_first_set(self):
+        row = (1, 'a')
+        r = Record({'id':0, 'name':1}, row)
+        self.assertTrue(r._values is row)
+        r['name'] = 'b'
+        self.assertEqual('b', r['name'])
+        self.assertEqual((1, 'a'), row)
+        self.assertEqual([1, 'b'], r.values())
+
+    def test_list_values_copied(self):
+        data = [1, 'a', 'extra']
+        r = Record({'id':0, 'name':1}, data)
+        r['id'] = 2
+        self.assertEqual([1, 'a', 'extra'], data)
+        self.assertEqual([('id', 2), ('name', 'a')], r.items())
+
+
 class TVProgramTest(unittest.TestCase):
 
     def setUp(self):
@@ -191,6 +222,22 @@ class TVProgramTest(unittest.TestCase):
         p = TVProgram({'starttime': datetime.datetime(2008, 11, 21, 14)}, self.translator)
         self.assertEqual('20081121140000', p.starttime())
 
+    def test_starttimeAsTime_Parsed_only_once(self):
+        program = TVProgram(self.data, self.translator)
+        self.assertTrue(program.starttimeAsTime() is program.starttimeAsTime())
+        self.assertTrue(program.endtimeAsTime() is program.endtimeAsTime())
+        self.assertEqual(time.mktime(datetime.datetime(2008, 11, 21, 14).timetuple()), program.starttimeAsEpoch())
+        self.assertEqual(program.starttimeAsEpoch(), program.endtimeAsEpoch())
+
+    def test_sortKeys(self):
+        p1 = TVProgram({'title':'Bonanza', 'channum':'9_1', 'starttime':datetime.datetime(2008, 11, 21, 15)}, self.translator)
+        p2 = TVProgram({'title':'Bonanza', 'channum':'10', 'starttime':datetime.datetime(2008, 11, 21, 14)}, self.translator)
+        p3 = TVProgram({'title':'Alf',     'channum':'9',  'starttime':datetime.datetime(2008, 11, 21, 16)}, self.translator)
+        programs = [p1, p2, p3]
+        self.assertEqual([p2, p1, p3], sorted(programs, key=TVProgram.dateSortKey))
+        self.assertEqual([p3, p2, p1], sorted(programs, key=TVProgram.titleSortKey))
+        self.assertEqual([p3, p1, p2], sorted(programs, key=TVProgram.channelSortKey))
+
     def test_eq_Make_sure_bidirectional_equivalence_to_RecordedProgram_works(self):
         tv = TVProgram(self.data, self.translator)
         recorded = RecordedProgram(pdata({'channum':'23','starttime': socketDateTime(2008, 11, 21, 14, 0, 0)}), Mock(), Mock(), Mock(), self.protocol, Mock())
@@ -224,6 +271,32 @@ class RecordedProgramTest(unittest.TestCase):
         self.assertEqual('p1', mydict[p1])
         self.assertEqual('p2', mydict[p2])
          
+    def test_getFPS_When_recording_finished_Then_read_from_framerate_cache_first(self):
+        FramerateCache.path = None
+        FramerateCache.framerates = {}
+        db = Mock()
+        data = pdata({'chanid':'1001', 'starttime':socketDateTime(2008, 11, 21, 14, 0, 0), 'recstatus':str(RecordingStatus.RECORDED)})
+        p1 = RecordedProgram(data, db=db, **self.pkwargs)
+        when(db).findFramerate(p1).thenReturn(59.94)
+        self.assertEqual(59.94, p1.getFPS())
+        
+        p2 = RecordedProgram(data, db=db, **self.pkwargs)
+        self.assertEqual(59.94, p2.getFPS())
+        verify(db, 1).findFramerate(p1)  # p1 == p2 so this also checks p2 wasn't looked up
+        FramerateCache.framerates = {}
+
+    def test_getFPS_When_no_seek_table_Then_default_not_put_in_framerate_cache(self):
+        FramerateCache.path = None
+        FramerateCache.framerates = {}
+        db = Mock()
+        data = pdata({'chanid':'1001', 'starttime':socketDateTime(2008, 11, 21, 14, 0, 0), 'recstatus':str(RecordingStatus.RECORDED)})
+        p1 = RecordedProgram(data, db=db, **self.pkwargs)
+        when(db).findFramerate(p1).thenReturn(None)
+        self.assertEqual(29.97, p1.getFPS())
+        self.assertEqual(29.97, p1.getFPS())
+        verify(db, 1).findFramerate(p1)
+        self.assertTrue(FramerateCache.get(self.platform, p1) is None)
+        
     def test_hasBookmark_False(self):
         p = RecordedProgram(pdata(), **self.pkwargs)
         p.setProgramFlags(FlagMask.FL_AUTOEXP)
@@ -262,6 +335,41 @@ class RecordedProgramTest(unittest.TestCase):
         self.assertEqual(commBreaks, result)
         verify(self.conn).getCommercialBreaks(p)
 
+    def cachedMarkupProgram(self, marks):
+        db = Mock()
+        p = RecordedProgram(pdata({'chanid':'1001', 'recstartts':socketDateTime(2008, 11, 21, 14, 0, 0), 
+                                   'programflags':FlagMask.FL_COMMFLAG | FlagMask.FL_BOOKMARK}), db=db, **self.pkwargs)
+        when(db).getFramerate(p).thenReturn(10.0)
+        markupCache.marks = {markupCache.key(p): marks}
+        return p
+
+    def test_getCommercials_When_markup_cached_Then_backend_not_asked(self):
+        p = self.cachedMarkupProgram([
+            (MarkType.COMM_START, 100), (MarkType.COMM_END, 200), (MarkType.COMM_START, 600), (MarkType.COMM_END, 900)])
+        try:
+            self.assertEqual([(10.0, 20.0), (60.0, 90.0)], [(b.start, b.end) for b in p.getCommercials()])
+            verify(self.conn, 0).getCommercialBreaks(p)
+        finally:
+            markupCache.invalidate()
+
+    def test_getCommercials_When_unmatched_marks_Then_later_breaks_still_paired(self):
+        p = self.cachedMarkupProgram([
+            (MarkType.COMM_START, 50), (MarkType.COMM_START, 100), (MarkType.COMM_END, 200), 
+            (MarkType.COMM_END, 300), (MarkType.COMM_START, 600), (MarkType.COMM_END, 900)])
+        try:
+            self.assertEqual([(10.0, 20.0), (60.0, 90.0)], [(b.start, b.end) for b in p.getCommercials()])
+        finally:
+            markupCache.invalidate()
+
+    def test_getBookmark_When_markup_cached_Then_backend_still_asked(self):
+        p = self.cachedMarkupProgram([(MarkType.COMM_START, 100), (MarkType.COMM_END, 200)])
+        when(self.conn).getBookmark(p).thenReturn(250)
+        try:
+            self.assertEqual(25.0, p.getBookmark())
+            verify(self.conn, 1).getBookmark(p)
+        finally:
+            markupCache.invalidate()
+
     def test_eq_True_self(self):
         p = RecordedProgram(pdata({'channum':'99', 'starttime':999999}), **self.pkwargs)
         self.assertEqual(p, p)
@@ -335,6 +443,59 @@ class RecordedProgramTest(unittest.TestCase):
         self.assertEqual('2008-10-10', rp.originalAirDate())
         self.assertTrue(rp.hasOriginalAirDate())
 
+    def test_data_Same_as_constructor_data(self):
+        data = pdata({'title':'Seinfeld', 'channum':'23'})
+        p = RecordedProgram(data, **self.pkwargs)
+        self.assertEqual(data, p.data())
+        p.setChannelId(99)
+        self.assertEqual('0', data[self.protocol.fieldIndex()['chanid']])
+        self.assertEqual(99, p.getChannelId())
+        self.assertEqual(self.protocol.recordFields(), p._data.keys())
+
+    def test_season_When_field_not_in_protocol_Then_default_to_zero(self):
+        p = RecordedProgram(pdata(protocolVersion=40), self.settings, self.translator, self.platform, protocols[40], self.conn)
+        self.assertFalse('season' in p._data)
+        self.assertEqual('0', p.season())
+        self.assertEqual('0', p.episode())
+        
+    def test_sort_by_date_performance(self):
+        base = socketDateTime(2008, 11, 21, 14, 0, 0)
+        programs = [RecordedProgram(pdata({'starttime':base + (i * 7919 % 10000) * 1800, 'endtime':base + (i * 7919 % 10000) * 1800 + 1800}), **self.pkwargs) for i in xrange(10000)]
+        
+        start = time.time()
+        for i in xrange(5):
+            programs.sort(key=RecordedProgram.dateSortKey, reverse=i % 2)
+        log.debug('Sorting 10k recordings 5 times by date took %s secs' % (time.time() - start))
+        
+        starttimes = [p.starttimeAsTime() for p in programs]
+        self.assertEqual(sorted(starttimes), starttimes)
+        
+    def test_constructor_performance(self):
+        
+        class OdictRecordedProgram(RecordedProgram):
+            """RecordedProgram as it was before records were backed by a shared field index"""
+            def __init__(self, data, settings, translator, platform, protocol, conn=None, db=None):
+                RecordedProgram.__init__(self, data, settings, translator, platform, protocol, conn, db)
+                self._data = odict()
+                for key, value in zip(self.protocol.recordFields(), data):
+                    self._data[key] = value
+
+        def build(cls, n):
+            data = pdata({'title':u'Seinfeld', 'channum':u'23'})
+            return [cls(list(data), **self.pkwargs) for i in xrange(n)]
+        
+        n = 5000
+        for cls in (OdictRecordedProgram, RecordedProgram):
+            start = time.time()
+            programs = build(cls, n)
+            elapsed = max(time.time() - start, 0.000001)
+            self.assertEqual(u'Seinfeld', programs[-1].title())
+            del programs
+            log.debug('%s: %d programs/sec' % (cls.__name__, n / elapsed))
+            if hasattr(os, 'fork'):
+                kb = peakMemoryKB(build, cls, n)
+                log.debug('%s: %d bytes/program' % (cls.__name__, kb * 1024 / n))
+
 
 class TunerTest(unittest.TestCase):
 
@@ -470,6 +631,13 @@ class RecordingScheduleTest(unittest.TestCase):
         self.assertEqual(EpisodeFilter.NONE, schedule.getEpisodeFilter())
         self.assertEqual(CheckForDupesIn.PREVIOUS_RECORDINGS, schedule.getCheckForDupesIn())
 
+    def test_numRecorded_None_until_counted(self):
+        schedule = RecordingSchedule({'recordid' : 1, 'title' : 'Seinfeld'}, Mock())
+        self.assertTrue(schedule.numRecorded() is None)
+        schedule.setNumRecorded(5)
+        self.assertEqual(5, schedule.numRecorded())
+        self.assertEqual(5, copy.copy(schedule).numRecorded())
+
     def test_hashable(self):
         s1 = RecordingSchedule({'recordid' : 1}, Mock())
         s2 = RecordingSchedule({'recordid' : 2}, Mock())
@@ -497,6 +665,17 @@ class JobTest(unittest.TestCase):
         self.translator = Mock()
         self.deps = {'settings':Mock(), 'translator':self.translator, 'platform':Mock(), 'protocol':TEST_PROTOCOL, 'conn':Mock()}
 
+    def test_fromRecord(self):
+        columns = ['id', 'chanid', 'starttime', 'inserttime', 'type', 'cmds', 'flags', 'status', 'statustime', 'hostname', 'comment', 'schedruntime']
+        now = datetime.datetime.now()
+        row = (5L, 1010L, now, now, JobType.COMMFLAG, None, 0, JobStatus.QUEUED, now, u'host', u'', now)
+        job = Job.fromRecord(Record(dict([(c, i) for i, c in enumerate(columns)]), row), self.translator, None)
+        self.assertEqual(5, job.id)
+        self.assertEqual(1010, job.channelId)
+        self.assertEqual(JobStatus.QUEUED, job.jobStatus)
+        self.assertEqual(u'host', job.hostname)
+        self.assertEqual(now, job.scheduledRunTime)
+
     def test_moveToFrontOfQueue_Raises_Exeption_When_Job_Not_Queued(self):
         job = self.createJob(jobStatus=JobStatus.FINISHED)
         try:
@@ -586,6 +765,7 @@ class JobTest(unittest.TestCase):
             self.assertEqual(2000 + (i+2), j.scheduledRunTime.year)
         log.debug('current job = %s' % job)
         self.assertEqual(2001, job.scheduledRunTime.year)
+        verify(db, 1).updateJobScheduledRunTimes([job] + jobs[:-1])
            
     def test_getPositionInQueue_Position_Is_7_of_10(self):
         # Setup
@@ -763,6 +943,71 @@ class JobTest(unittest.TestCase):
             domainCache=domainCache)        
 
 
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.translator = Mock()
+        self.t = lambda h: datetime.datetime(2013, 1, 1, h)
+        self.master = Backend('master', '10.0.0.1', '6543', True)
+        self.slave = Backend('slave', '10.0.0.2', '6543', False)
+
+    def job(self, id, status, chanId, hour, hostname=u'', conn=None):
+        return Job(id=id, channelId=chanId, startTime=self.t(hour), insertTime=None, jobType=JobType.COMMFLAG, 
+                   cmds=None, flags=None, jobStatus=status, statusTime=None, hostname=hostname, comment=None, 
+                   scheduledRunTime=None, translator=self.translator, domainCache=None, conn=conn)
+
+    def recording(self, chanId, hour):
+        r = Mock()
+        when(r).getChannelId().thenReturn(chanId)
+        when(r).starttimeAsTime().thenReturn(self.t(hour))
+        return r
+
+    def test_load_ResolvesPositionsProgramsAndBackendsInOnePass(self):
+        running = [self.job(1, JobStatus.RUNNING, 1001, 20, u'SLAVE')]
+        queued = [self.job(i, JobStatus.QUEUED, 1001, i) for i in xrange(2, 12)]
+        recordings = [self.recording(1001, h) for h in xrange(1, 21)]
+        db, domainCache = Mock(), Mock()
+        when(db).getJobs(jobStatus=JobStatus.RUNNING).thenReturn(running)
+        when(db).getJobs(jobStatus=JobStatus.QUEUED).thenReturn(queued)
+        when(db).getBackends().thenReturn([self.master, self.slave])
+        when(domainCache).getAllRecordings().thenReturn(recordings)
+
+        jobQueue = JobQueue.load(db, domainCache)
+
+        self.assertEqual(running + queued, jobQueue.jobs())
+        self.assertEqual((1, 10), jobQueue.getPositionInQueue(queued[0]))
+        self.assertEqual((10, 10), jobQueue.getPositionInQueue(queued[-1]))
+        self.assertRaises(StatusException, jobQueue.getPositionInQueue, running[0])
+        self.assertTrue(jobQueue.getProgram(running[0]) is recordings[19])
+        self.assertTrue(jobQueue.getProgram(queued[0]) is recordings[1])
+        self.assertEqual(self.slave, jobQueue.getBackend(running[0]))
+        self.assertEqual(self.master, jobQueue.getBackend(queued[0]))
+        verify(db, 1).getJobs(jobStatus=JobStatus.QUEUED)
+        verify(domainCache, 0).getAllRecordings(force=True)
+
+    def test_load_AsksBackendForRecordingsNotCached(self):
+        conn = Mock()
+        queued = [self.job(1, JobStatus.QUEUED, 1001, 20, conn=conn), 
+                  self.job(2, JobStatus.QUEUED, 1002, 20, conn=conn),
+                  self.job(3, JobStatus.QUEUED, 1003, 20, conn=conn)]
+        cached, liveTV = self.recording(1001, 20), self.recording(1002, 20)
+        db, domainCache = Mock(), Mock()
+        when(db).getJobs(jobStatus=JobStatus.RUNNING).thenReturn([])
+        when(db).getJobs(jobStatus=JobStatus.QUEUED).thenReturn(queued)
+        when(db).getBackends().thenReturn([self.master])
+        when(domainCache).getAllRecordings().thenReturn([cached])
+        when(conn).getRecording(1002, self.t(20)).thenReturn(liveTV)
+        when(conn).getRecording(1003, self.t(20)).thenReturn(None)
+
+        jobQueue = JobQueue.load(db, domainCache)
+
+        self.assertTrue(jobQueue.getProgram(queued[0]) is cached)
+        self.assertTrue(jobQueue.getProgram(queued[1]) is liveTV)
+        self.assertTrue(jobQueue.getProgram(queued[2]) is None)
+        verify(conn, 0).getRecording(1001, self.t(20))
+        verify(domainCache, 0).getAllRecordings(force=True)
+
+
 class BackendTest(unittest.TestCase):
 
     def test_eq_True_by_reference(self):
@@ -17,13 +17,14 @@
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 import mythboxtest
+import socket
 import time
 import unittest2 as unittest
 import util_mock
 
 from mockito import Mock
 from mythbox import pool
-from mythbox.mythtv.db import MythDatabaseFactory
+from mythbox.mythtv.db import MythDatabaseFactory, inject_db
 from mythbox.platform import Platform
 from mythbox.settings import MythSettings
 from mythbox.util import run_async, OnDemandConfig
@@ -148,3 +149,109 @@ class InjectConnDecoratorTest(unittest.TestCase):
         self.assertEquals(1, self.connPool.available())
         self.assertEquals(1, self.connPool.size())
         self.connPool.shrink()
+
+
+class CountingFactory(pool.PoolableFactory):
+    
+    def __init__(self):
+        self.created = 0
+        self.destroyed = 0
+        
+    def create(self):
+        self.created += 1
+        return Mock()
+    
+    def destroy(self, resource):
+        self.destroyed += 1
+
+
+class OfflineClient(object):
+    
+    def __init__(self):
+        self.failures = []
+        
+    def plain(self):
+        return 1
+    
+    @inject_conn
+    def outer(self):
+        return self.inner()
+    
+    @inject_conn
+    def inner(self):
+        return self.conn()
+    
+    @inject_conn
+    def resetOnce(self):
+        if self.failures:
+            raise self.failures.pop(0)
+        return self.conn()
+
+    @inject_conn
+    def whileAcquired(self, f):
+        return f()
+
+    @inject_db
+    def outerDb(self):
+        return self.innerDb()
+    
+    @inject_db
+    def innerDb(self):
+        return self.db()
+        
+
+class InjectOverheadTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.connFactory = CountingFactory()
+        self.dbFactory = CountingFactory()
+        self.previous = dict(pool.pools)
+        self.connPool = pool.pools['connPool'] = pool.Pool(self.connFactory)
+        self.dbPool = pool.pools['dbPool'] = pool.Pool(self.dbFactory)
+        self.client = OfflineClient()
+        
+    def tearDown(self):
+        pool.pools.clear()
+        pool.pools.update(self.previous)
+
+    def test_nested_calls_share_one_resource_which_is_checked_in_when_outermost_call_returns(self):
+        self.assertTrue(self.client.outer() is self.client.outer())
+        self.assertTrue(self.client.outerDb() is self.client.outerDb())
+        self.assertEquals(1, self.connFactory.created)
+        self.assertEquals(1, self.connPool.available())
+        self.assertEquals(1, self.dbFactory.created)
+        self.assertEquals(1, self.dbPool.available())
+        
+    def test_When_connection_reset_Then_discarded_and_call_retried_on_new_connection(self):
+        self.client.failures.append(socket.error(104, 'Connection reset by peer'))
+        self.assertTrue(self.client.resetOnce() is not None)
+        self.assertEquals(2, self.connFactory.created)
+        self.assertEquals(1, self.connFactory.destroyed)
+        self.assertEquals(1, self.connPool.size())
+
+    def test_When_connection_reset_Then_other_idle_connections_kept(self):
+        self.connPool.grow(3)
+        self.client.failures.append(socket.error(104, 'Connection reset by peer'))
+        self.client.resetOnce()
+        self.assertEquals(1, self.connFactory.destroyed)
+        self.assertEquals(2, self.connPool.available())
+        self.assertEquals(2, self.connPool.size())
+
+    def test_When_connection_reset_twice_Then_gives_up(self):
+        self.client.failures.extend([socket.error(104, 'Connection reset by peer'), socket.error(32, 'Broken pipe')])
+        self.assertRaises(socket.error, self.client.resetOnce)
+        self.assertEquals(0, self.connPool.size())
+        
+    def test_per_call_overhead(self):
+        n = 100000
+        def timeit(f):
+            start = time.time()
+            for i in xrange(n):
+                f()
+            return (time.time() - start) / n * 1000000  # usecs
+        
+        plain = timeit(self.client.plain)
+        outermost = timeit(self.client.inner)
+        nested = self.client.whileAcquired(lambda: timeit(self.client.inner))
+        
+        log.info('Per call: undecorated %2.2f usecs, @inject_conn nested %2.2f usecs, @inject_conn outermost (checkout + checkin) %2.2f usecs' % (plain, nested, outermost))
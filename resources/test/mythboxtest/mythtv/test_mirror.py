@@ -0,0 +1,159 @@
+#
+#  MythBox for XBMC - http://mythbox.googlecode.com
+#  Copyright (C) 2013 analogue@yahoo.com
+# 
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import datetime
+import logging
+import shutil
+import tempfile
+import threading
+import unittest2 as unittest
+
+from mockito import Mock, when
+from mythbox.bus import Event
+from mythbox.mythtv.domain import TVProgram
+from mythbox.mythtv.mirror import GuideMirror
+
+log = logging.getLogger('mythbox.unittest')
+
+
+class GuideMirrorTest(unittest.TestCase):
+
+    class FakeDatabase(object):
+        """Serves the guide mirror queries from an in-memory program table"""
+        def __init__(self, channels, programs):
+            self.channels = channels
+            self.programs = programs
+            self.lastRunEnd = '2013-01-01T05:00:00'
+            self.fetched = []
+        def getMythSetting(self, key):
+            return self.lastRunEnd
+        def getGuideChannels(self):
+            return self.channels
+        def getGuideChecksums(self, startTime, endTime):
+            checksums = {}
+            for p in self.programs:
+                if startTime <= p[1] < endTime:
+                    count, checksum = checksums.get((p[0], p[1].date()), (0, 0))
+                    checksums[(p[0], p[1].date())] = (count + 1, checksum + hash(p) % 100000)
+            return checksums
+        def getGuidePrograms(self, chanIds, startTime, endTime):
+            self.fetched.append((sorted(chanIds), startTime))
+            return [p for p in self.programs if p[0] in chanIds and startTime <= p[1] < endTime]
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        platform = Mock()
+        when(platform).getCacheDir().thenReturn(self.cacheDir)
+        self.mirror = GuideMirror(platform)
+        self.today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        channels = [(1001, u'1', u'ABC', None, u'ABC East', 1), (1002, u'2', u'NBC', None, u'NBC East', 1), (1003, u'3', u'X', None, u'Hidden', 0)]
+        programs = []
+        for chanId in (1001, 1002, 1003):
+            for day in xrange(-1, 3):
+                for hour in xrange(0, 24, 2):
+                    start = self.today + datetime.timedelta(days=day, hours=hour)
+                    programs.append(self.program(chanId, start, u'Show %d' % hour))
+        self.db = self.FakeDatabase(channels, programs)
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def program(self, chanId, start, title):
+        return (chanId, start, start + datetime.timedelta(hours=2), title, u'sub', u'desc', None, 
+                datetime.date(2001, 2, 3), u'Comedy', u'series', u'EP1', u'SH1', 0)
+
+    def test_sync_CopiesProgramsAndServesGuideRows(self):
+        self.assertEqual(len(self.db.programs), self.mirror.sync(self.db))
+        self.assertTrue(self.mirror.current)
+
+        start, end = self.today + datetime.timedelta(hours=21), self.today + datetime.timedelta(days=1, hours=1)
+        records = self.mirror.getTVGuideRecords(start, end, [1001, 1002, 1003])
+
+        # 20:00, 22:00, 00:00 for each visible channel in chanid, starttime order
+        self.assertEqual([1001] * 3 + [1002] * 3, [r['chanid'] for r in records])
+        self.assertEqual([start.replace(hour=20), start.replace(hour=22), end.replace(hour=0)], [r['starttime'] for r in records[:3]])
+        program = TVProgram(records[0], Mock())
+        self.assertEqual(u'Show 20', program.title())
+        self.assertEqual(u'ABC', program.getCallSign())
+        self.assertEqual(datetime.date(2001, 2, 3), records[0]['originalairdate'])
+
+    def test_sync_OnlyCopiesChangedChannelDays(self):
+        self.mirror.sync(self.db)
+        self.db.fetched = []
+        self.assertEqual(0, self.mirror.sync(self.db))
+        self.assertEqual([], self.db.fetched)
+
+        tomorrow = self.today + datetime.timedelta(days=1)
+        self.db.programs = [p for p in self.db.programs if not (p[0] == 1002 and p[1] == tomorrow)]
+        self.db.programs.append(self.program(1002, tomorrow, u'Breaking News'))
+        self.db.programs = [p for p in self.db.programs if not (p[0] == 1001 and p[1].date() == self.today.date())]
+        
+        self.assertEqual(12, self.mirror.sync(self.db))
+        self.assertEqual([([1002], tomorrow)], self.db.fetched)
+        records = self.mirror.getTVGuideRecords(tomorrow, tomorrow + datetime.timedelta(hours=1), [1001, 1002])
+        self.assertEqual([u'Show 0', u'Breaking News'], [r['title'] for r in records])
+        self.assertEqual([], self.mirror.getTVGuideRecords(self.today + datetime.timedelta(hours=12), self.today + datetime.timedelta(hours=13), [1001]))
+
+    def test_getTVGuideRecords_When_sync_in_progress_Then_last_sync_served_without_waiting(self):
+        self.mirror.sync(self.db)
+        tomorrow = self.today + datetime.timedelta(days=1)
+        self.db.programs = [p for p in self.db.programs if not (p[0] == 1002 and p[1] == tomorrow)]
+        self.db.programs.append(self.program(1002, tomorrow, u'Breaking News'))
+
+        syncing, finish = threading.Event(), threading.Event()
+        getGuidePrograms = self.db.getGuidePrograms
+        def slowGetGuidePrograms(*args):
+            syncing.set()
+            finish.wait(5)
+            return getGuidePrograms(*args)
+        self.db.getGuidePrograms = slowGetGuidePrograms
+        t = threading.Thread(target=self.mirror.sync, args=(self.db,))
+        t.start()
+        try:
+            self.assertTrue(syncing.wait(5))
+            records = self.mirror.getTVGuideRecords(tomorrow, tomorrow + datetime.timedelta(hours=1), [1002])
+            self.assertEqual([u'Show 0'], [r['title'] for r in records])
+            self.assertFalse(finish.isSet())
+        finally:
+            finish.set()
+            t.join()
+        records = self.mirror.getTVGuideRecords(tomorrow, tomorrow + datetime.timedelta(hours=1), [1002])
+        self.assertEqual([u'Breaking News'], [r['title'] for r in records])
+
+    def test_covers_FallsBehindWhenMythfilldatabaseRuns(self):
+        start, end = self.today, self.today + datetime.timedelta(hours=2)
+        self.mirror.sync(self.db)
+        self.assertTrue(self.mirror.covers(self.db, start, end))
+        self.assertFalse(self.mirror.covers(self.db, start - datetime.timedelta(hours=1), end))
+        self.assertFalse(self.mirror.covers(self.db, start, start + datetime.timedelta(days=15)))
+
+        self.db.lastRunEnd = '2013-01-02T05:00:00'
+        self.mirror.lastChecked -= self.mirror.checkEverySecs + 1
+        self.mirror.syncInBackground = lambda: None
+        self.assertFalse(self.mirror.covers(self.db, start, end))
+        self.assertFalse(self.mirror.current)
+
+    def test_onEvent_SchedulerRan(self):
+        self.mirror.syncInBackground = lambda: None
+        self.mirror.current = True
+        self.mirror.onEvent({'id': Event.SCHEDULE_CHANGED})
+        self.assertTrue(self.mirror.current)
+        self.mirror.onEvent({'id': Event.SCHEDULER_RAN})
+        self.assertFalse(self.mirror.current)
@@ -1,9 +1,15 @@
 from unittest2 import TestCase
-from mythbox.mythtv.protocol import Protocol40
+from mythbox.mythtv.protocol import Protocol40, Protocol66
 
 
 class Protocol40Test(TestCase):
         
+    def test_readLongAt(self):
+        reply = ['2', '4', '1', '3', '5', '0', '7']
+        self.assertEquals((0x100000003, 4), Protocol40().readLongAt(reply, 2))
+        self.assertEquals((3L, 4), Protocol66().readLongAt(reply, 3))
+        self.assertEquals(7, len(reply))
+        
     def test_decodeLongLong(self):
         p = Protocol40()
         self.assertEquals(0, p.decodeLongLong(0, 0))
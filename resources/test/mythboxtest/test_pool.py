@@ -18,10 +18,11 @@
 #
 
 import mythboxtest
+import threading
 import time
 import unittest
 
-from mythbox.pool import PoolableFactory, Pool, EvictingPool
+from mythbox.pool import PoolableFactory, Pool, EvictingPool, KeyedPool, PoolTimeout, WarmUp
 from mythbox.util import run_async
 
 log = mythboxtest.getLogger('mythbox.unittest')
@@ -205,15 +206,273 @@ class PoolTest(unittest.TestCase):
         self.assertEquals(1, p.available())
         
 
+class BoundedPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.p = Pool(WidgetFactory(), maxSize=2)
+        
+    def checkoutAsync(self, served, name):
+        def checkout():
+            w = self.p.checkout()
+            served.append(name)
+            time.sleep(0.05)
+            self.p.checkin(w)
+        t = threading.Thread(target=checkout)
+        t.start()
+        return t
+    
+    def test_checkout_When_full_Then_blocks_until_checkin(self):
+        w1 = self.p.checkout()
+        self.p.checkout()
+        served = []
+        t = self.checkoutAsync(served, 'waiter')
+        time.sleep(0.1)
+        self.assertEquals([], served)
+        self.p.checkin(w1)
+        t.join()
+        self.assertEquals(['waiter'], served)
+        self.assertEquals(2, self.p.size())
+        self.assertEquals(1, self.p.stats()['waits'])
+
+    def test_checkout_When_full_for_longer_than_timeout_Then_raises(self):
+        self.p.checkout()
+        self.p.checkout()
+        start = time.time()
+        self.assertRaises(PoolTimeout, self.p.checkout, 0.2)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEquals(1, self.p.stats()['timeouts'])
+        self.assertEquals(0, self.p.stats()['waiting'])
+
+    def test_checkout_When_many_waiting_Then_served_in_order_of_arrival(self):
+        held = [self.p.checkout(), self.p.checkout()]
+        served = []
+        threads = []
+        for i in xrange(5):
+            threads.append(self.checkoutAsync(served, i))
+            # don't start the next waiter until this one is queued so arrival order is known
+            while self.p.stats()['waiting'] < i + 1:
+                time.sleep(0.001)
+        # hand a single widget down the line so each waiter records being served before the next one can be
+        self.p.checkin(held[0])
+        for t in threads:
+            t.join()
+        self.p.checkin(held[1])
+        self.assertEquals(range(5), served)
+        
+    def test_stats(self):
+        ws = [self.p.checkout(), self.p.checkout()]
+        self.p.discard(ws[0])
+        self.p.checkin(ws[1])
+        self.p.grow(10)
+        stats = self.p.stats()
+        self.assertEquals(2, stats['highWater'])
+        self.assertEquals(3, stats['created'])
+        self.assertEquals(1, stats['destroyed'])
+        self.assertEquals(2, stats['size'])
+        self.assertEquals(2, stats['maxSize'])
+        self.assertEquals(0, stats['waits'])
+        
+
+class ValidatingWidgetFactory(WidgetFactory):
+    
+    def __init__(self):
+        WidgetFactory.__init__(self)
+        self.dead = set()
+        
+    def validate(self, widget):
+        return widget not in self.dead
+    
+
+class ValidatingPoolTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.factory = ValidatingWidgetFactory()
+        self.p = Pool(self.factory, validateAfterSecs=0)
+        self.widgets = [self.p.checkout() for i in xrange(3)]
+        for w in self.widgets:
+            self.p.checkin(w)
+        time.sleep(0.01)
+        
+    def test_checkout_When_idle_resource_dead_Then_only_that_one_evicted(self):
+        self.factory.dead.add(self.widgets[2])
+        w = self.p.checkout()
+        self.assertTrue(w is self.widgets[1])
+        self.assertEquals(1, self.p.numEvicted)
+        self.assertEquals(2, self.p.numValidated)
+        self.assertEquals(1, self.p.available())
+        self.assertEquals(2, self.p.size())
+        
+    def test_checkout_When_all_idle_resources_dead_Then_recreated(self):
+        self.factory.dead.update(self.widgets)
+        w = self.p.checkout()
+        self.assertFalse(w in self.widgets)
+        self.assertEquals(3, self.p.numEvicted)
+        self.assertEquals(1, self.p.numRecreated)
+        self.assertEquals(1, self.p.size())
+        
+    def test_checkout_When_idle_for_less_than_validateAfterSecs_Then_not_validated(self):
+        self.p.validateAfterSecs = 60
+        self.factory.dead.update(self.widgets)
+        self.assertTrue(self.p.checkout() is self.widgets[2])
+        self.assertEquals(0, self.p.numValidated)
+
+    def test_discard_Then_only_discarded_resource_destroyed(self):
+        w = self.p.checkout()
+        self.p.discard(w)
+        self.assertEquals(2, self.p.available())
+        self.p.checkout()
+        self.p.checkout()
+        self.p.checkout()
+        self.assertEquals(1, self.p.numEvicted)
+        self.assertEquals(1, self.p.numRecreated)
+
+
+class SlowWidgetFactory(WidgetFactory):
+    
+    def __init__(self, delay):
+        WidgetFactory.__init__(self)
+        self.delay = delay
+        self.destroyed = 0
+        
+    def create(self):
+        time.sleep(self.delay)
+        return WidgetFactory.create(self)
+    
+    def destroy(self, widget):
+        self.destroyed += 1
+        
+
+class SlowCreatePoolTest(unittest.TestCase):
+
+    def test_checkout_When_creating_resource_Then_pool_not_locked(self):
+        p = Pool(SlowWidgetFactory(0.5), maxSize=2)
+        p.add(Widget(0))
+        w = p.checkout()
+        t = threading.Thread(target=p.checkout)
+        t.start()
+        time.sleep(0.1)
+        start = time.time()
+        p.checkin(w)
+        self.assertTrue(p.checkout() is w)
+        self.assertTrue(time.time() - start < 0.3)
+        t.join()
+        self.assertEquals(2, p.size())
+
+    def test_checkout_When_create_fails_Then_slot_given_back(self):
+        factory = WidgetFactory()
+        p = Pool(factory, maxSize=1)
+        def fail():
+            raise Exception('connect failed')
+        factory.create = fail
+        self.assertRaises(Exception, p.checkout)
+        self.assertEquals(0, p.size())
+        factory.create = lambda: Widget(1)
+        self.assertEquals(1, p.checkout(0.1).cnt)
+
+
+class WarmUpTest(unittest.TestCase):
+    
+    def test_start_Then_resources_created_concurrently(self):
+        p = Pool(SlowWidgetFactory(0.5))
+        warmUp = WarmUp(p, 5).start()
+        warmUp.join()
+        self.assertTrue(warmUp.isDone())
+        self.assertEquals(5, warmUp.numCreated)
+        self.assertEquals(5, p.available())
+        self.assertTrue(warmUp.elapsed < 2.0, 'Took %2.2f secs' % warmUp.elapsed)
+        log.debug('Warmed up 5 resources taking 0.5 secs each in %2.2f secs' % warmUp.elapsed)
+        
+    def test_start_When_pool_already_at_min_size_Then_nothing_created(self):
+        p = Pool(WidgetFactory())
+        p.grow(2)
+        warmUp = WarmUp(p, 2).start()
+        self.assertTrue(warmUp.isDone())
+        self.assertEquals([], warmUp.workers)
+        self.assertEquals(2, p.size())
+
+    def test_cancel_Then_resources_in_progress_thrown_away(self):
+        factory = SlowWidgetFactory(0.5)
+        p = Pool(factory)
+        warmUp = WarmUp(p, 3).start()
+        warmUp.cancel()
+        warmUp.join()
+        self.assertEquals(0, p.size())
+        self.assertEquals(0, warmUp.numCreated)
+        
+    def test_start_When_evicting_pool_Then_warmed_up_resources_evicted_when_idle(self):
+        p = EvictingPool(WidgetFactory(), maxAgeSecs=1, reapEverySecs=1)
+        try:
+            WarmUp(p, 2).start().join()
+            self.assertEquals(2, p.available())
+            self.assertTrue(p.timer is not None)
+        finally:
+            timer = p.timer
+            p.shutdown()
+            timer.join(1)
+
+
+class KeyedPoolTest(unittest.TestCase):
+    
+    def test_checkout_When_different_keys_Then_resources_not_shared(self):
+        p = KeyedPool(lambda key: Pool(WidgetFactory()))
+        a = p.checkout('a')
+        p.checkin('a', a)
+        self.assertTrue(a is p.checkout('a'))
+        b = p.checkout('b')
+        self.assertFalse(a is b)
+        self.assertEquals(2, p.size())
+        self.assertEquals(0, p.available())
+        
+        p.checkin('b', b)
+        p.discard('a', a)
+        self.assertEquals(1, p.size())
+        self.assertEquals(1, p.available())
+        
+        p.shutdown()
+        self.assertRaises(Exception, p.checkout, 'a')
+
+
 class EvictingPoolTest(unittest.TestCase):
     
-    def test_When_instantiated_and_no_interactions_Then_evictor_exits_gracefully(self):
+    def test_When_instantiated_and_no_interactions_Then_no_timer_running(self):
         p = EvictingPool(WidgetFactory(), maxAgeSecs=60, reapEverySecs=2)
-        time.sleep(1)
-        self.assertTrue(p.evictorThread.isAlive())
+        self.assertTrue(p.timer is None)
+        p.shutdown()
+        self.assertTrue(p.timer is None)
+
+    def test_When_idle_resources_Then_timer_runs_only_until_they_are_evicted(self):
+        p = EvictingPool(WidgetFactory(), maxAgeSecs=1, reapEverySecs=1)
+        try:
+            p.checkin(p.checkout())
+            self.assertTrue(p.timer.isAlive())
+            timer = p.timer
+            timer.join(3)
+            self.assertEquals(0, p.available())
+            self.assertTrue(p.timer is None)
+        finally:
+            p.shutdown()
+
+    def test_shutdown_Then_pending_timer_cancelled(self):
+        p = EvictingPool(WidgetFactory(), maxAgeSecs=60, reapEverySecs=1)
+        p.grow(1)
+        timer = p.timer
         p.shutdown()
-        time.sleep(2)
-        self.assertFalse(p.evictorThread.isAlive())
+        timer.join(1)
+        self.assertFalse(timer.isAlive())
+        
+    def test_When_no_timer_Then_expired_resources_evicted_lazily_on_checkout(self):
+        p = EvictingPool(WidgetFactory(), maxAgeSecs=1, reapEverySecs=None)
+        try:
+            w = p.checkout()
+            p.checkin(w)
+            self.assertTrue(p.timer is None)
+            time.sleep(1.1)
+            self.assertEquals(1, p.available())
+            self.assertFalse(p.checkout() is w)
+            self.assertEquals(1, p.numEvictions)
+            self.assertEquals(1, p.size())
+        finally:
+            p.shutdown()
 
     def test_When_lt_maxAge_Then_resource_not_evicted(self):
         p = EvictingPool(WidgetFactory(), maxAgeSecs=5, reapEverySecs=1)
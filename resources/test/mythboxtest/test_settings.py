@@ -111,6 +111,39 @@ class MythSettingsTest(unittest.TestCase):
         self.assertEquals(3, len(dirs))
         self.assertEquals(['a','b','c'], dirs)
 
+    def test_getTransferStreams_When_backend_has_override_Then_use_it_otherwise_use_default(self):
+        when(self.platform).getScriptDataDir().thenReturn(self.sandbox)
+        settings = MythSettings(self.platform, self.translator)
+        self.assertEquals(1, settings.getTransferStreams('master'))
+        settings.put('transfer_streams', '2, slave1=4,slave2=1')
+        self.assertEquals(2, settings.getTransferStreams('master'))
+        self.assertEquals(4, settings.getTransferStreams('slave1'))
+        self.assertEquals(1, settings.getTransferStreams('slave2'))
+
+    def test_getTransferStreams_When_not_a_number_Then_one(self):
+        when(self.platform).getScriptDataDir().thenReturn(self.sandbox)
+        settings = MythSettings(self.platform, self.translator)
+        settings.put('transfer_streams', 'two')
+        self.assertEquals(1, settings.getTransferStreams('master'))
+        settings.put('transfer_streams', '2,slave1=four')
+        self.assertEquals(1, settings.getTransferStreams('slave1'))
+
+    def test_getPoolMinSize_When_not_a_number_Then_zero(self):
+        when(self.platform).getScriptDataDir().thenReturn(self.sandbox)
+        settings = MythSettings(self.platform, self.translator)
+        self.assertEquals(2, settings.getPoolMinSize())
+        settings.put('pool_min_size', 'bogus')
+        self.assertEquals(0, settings.getPoolMinSize())
+
+    def test_getPoolMaxSize_When_not_set_or_not_a_number_Then_unbounded(self):
+        when(self.platform).getScriptDataDir().thenReturn(self.sandbox)
+        settings = MythSettings(self.platform, self.translator)
+        self.assertTrue(settings.getPoolMaxSize() is None)
+        settings.put('pool_max_size', '8')
+        self.assertEquals(8, settings.getPoolMaxSize())
+        settings.put('pool_max_size', '')
+        self.assertTrue(settings.getPoolMaxSize() is None)
+
     def test_verifyMySQLConnectivity_OK(self):
         when(self.platform).getScriptDataDir().thenReturn(self.sandbox)
         settings = MythSettings(self.platform, self.translator)
@@ -22,6 +22,7 @@ import mythboxtest.test_platform
 import mythboxtest.test_util
 import mythboxtest.test_log
 import mythboxtest.mythtv.test_db
+import mythboxtest.mythtv.test_mirror
 import mythboxtest.mythtv.test_conn
 import mythboxtest.mythtv.test_inject_conn
 import mythboxtest.mythtv.test_domain
@@ -49,6 +50,7 @@ def suite():
     mysuite.addTest(unittest.findTestCases(mythboxtest.test_util))
     mysuite.addTest(unittest.findTestCases(mythboxtest.test_log))
     mysuite.addTest(unittest.findTestCases(mythboxtest.mythtv.test_db))
+    mysuite.addTest(unittest.findTestCases(mythboxtest.mythtv.test_mirror))
     mysuite.addTest(unittest.findTestCases(mythboxtest.mythtv.test_conn))
     mysuite.addTest(unittest.findTestCases(mythboxtest.mythtv.test_inject_conn))
     mysuite.addTest(unittest.findTestCases(mythboxtest.mythtv.test_protocol))